@@ -2,5 +2,6 @@ from .system import System
 from .character import Character
 from .world import World
 from .llm_service import LLMService
+from .session_manager import SessionManager
 
-__all__ = ['System', 'Character', 'World', 'LLMService']
+__all__ = ['System', 'Character', 'World', 'LLMService', 'SessionManager']
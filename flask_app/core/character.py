@@ -1,9 +1,11 @@
 from typing import List, Dict
 import json
-import os
 from .llm_service import LLMService
-from .logger import setup_logger
-from .utils import read_story_file_to_dict
+from .logger import setup_logger, log_text
+from .story_registry import get_story_registry
+from .section_patch import patch_document
+from .structured import ActionPlans
+from .tracing import traced
 
 
 class Character:
@@ -19,15 +21,10 @@ class Character:
         self.llm_service = llm_service
 
         # 读取初始化配置
-        base_dir = os.path.dirname(os.path.dirname(__file__))
-        if story_name:
-            story_path = os.path.join(base_dir, 'story', story_name, 'character_init.txt')
-        else:
-            story_path = os.path.join(base_dir, 'story', 'character_init.txt')
-            
         try:
-            init_data = read_story_file_to_dict(story_path)
-            self.logger.info(f"成功加载角色初始化配置: {story_path}")
+            # 剧本文件由注册表解析并缓存，这里只读取，不修改
+            init_data = get_story_registry().load(story_name, 'character_init.txt')
+            self.logger.info(f"成功加载角色初始化配置: {story_name}")
             self.profile = init_data.get("主角设定","无")
             self.thoughts = init_data.get("主角当前想法", "初次进入这个世界，充满好奇与期待。")
             self.hidden_profile = init_data.get("隐藏补充设定", "无")
@@ -54,27 +51,20 @@ class Character:
 {self.thoughts}
 
 请生成三个候选行动方案，考虑任务影响但不强制服从。每个方案需要包含行动描述和预期结果。每个行动只有一行，不要多行文本。
-行动方案影响时间范围：{time_span_str}
-
-返回格式：
-[行动方案1]: xxxx
-[行动方案2]: yyyy
-[行动方案3]: zzzz"""
+行动方案影响时间范围：{time_span_str}"""
 
-        self.logger.info(f"生成行动方案提示: {prompt}")
+        log_text(self.logger, "生成行动方案提示", prompt)
 
-        response = await self.llm_service.generate_response(prompt)
-
-        self.logger.info(f"生成的行动方案: {response}")
         try:
-            # 解析响应为行动列表
-            actions = [line.split("]: ")[1] for line in response.strip().split('\n') if "[行动方案" in line]
-            self.logger.debug(f"生成的行动方案: {actions}")
+            plans = await self.llm_service.generate_structured(prompt, ActionPlans)
+            actions = plans.actions
+            log_text(self.logger, "生成的行动方案", "\n".join(actions))
             return actions[:3]  # 确保只返回3个方案
         except Exception as e:
             self.logger.error(f"解析行动方案失败: {e}")
             return ["自由行动", "自由行动", "自由行动"]
 
+    @traced()
     async def update_attributes(self, changes: str) -> str:
         """更新角色属性
 
@@ -85,6 +75,23 @@ class Character:
             str: 变更的差异信息
         """
         self.logger.info(f"更新角色属性: {changes}")
+        self.set_profile(await self.compute_profile_update(changes))
+        return changes
+
+    async def compute_profile_update(self, changes: str) -> str:
+        """根据变更计算更新后的角色档案，不修改当前状态
+
+        Args:
+            changes: 变更描述
+
+        Returns:
+            str: 更新后的角色档案
+        """
+        # 优先只让LLM输出受影响的分块，在本地合并
+        updated_profile = await patch_document(self.llm_service, self.profile, changes, "角色档案")
+        if updated_profile is not None:
+            return updated_profile
+        self.logger.warning("分块更新格式不合法，回退到完整重写角色档案")
 
         # 构建提示让LLM更新角色档案
         prompt = f"""
@@ -111,11 +118,12 @@ class Character:
 
         # 使用LLM更新档案
         updated_profile = await self.llm_service.generate_response(prompt)
-        updated_profile = updated_profile.replace("#", "").replace("---", "")
-        self.profile = updated_profile
-        self.logger.debug(f"更新后的档案: {self.profile}")
+        return updated_profile.replace("#", "").replace("---", "")
 
-        return changes
+    def set_profile(self, profile: str):
+        """写入更新后的角色档案"""
+        self.profile = profile
+        log_text(self.logger, "更新后的档案", self.profile)
 
     def get_current_thoughts(self) -> str:
         self.logger.debug(f"获取当前心理活动: {self.thoughts}")
@@ -0,0 +1,99 @@
+from collections import deque
+from typing import Dict
+import asyncio
+import threading
+import time
+
+
+class ConcurrencyLimiter:
+    """跨事件循环（线程）安全的并发限制器
+
+    asyncio.Semaphore只能在单个事件循环内使用，而请求、流式转发和后台任务分别运行在不同的
+    事件循环中，因此这里用线程锁维护计数，排队的协程通过call_soon_threadsafe唤醒。
+    同时记录排队深度和等待时间，供监控使用。
+    """
+
+    def __init__(self, limit: int, name: str = 'limiter'):
+        self.limit = max(1, limit)
+        self.name = name
+        self.in_flight = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        # 统计信息
+        self.max_queue_depth = 0
+        self.total_acquired = 0
+        self.total_queued = 0
+        self.total_wait_seconds = 0.0
+
+    async def acquire(self) -> float:
+        """获取一个并发名额
+
+        Returns:
+            float: 排队等待的秒数
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                self.total_acquired += 1
+                return 0.0
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+            self.total_queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+
+        start = time.monotonic()
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove(waiter)
+                    removed = True
+                except ValueError:
+                    removed = False
+            # 名额已经转交给了这个等待者，但它被取消了，需要归还
+            if not removed and waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+        waited = time.monotonic() - start
+        with self._lock:
+            self.total_acquired += 1
+            self.total_wait_seconds += waited
+        return waited
+
+    def release(self):
+        """归还一个并发名额，有排队者时直接转交"""
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    # 等待者所在的事件循环已经关闭
+                    continue
+            self.in_flight -= 1
+
+    def _grant(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def stats(self) -> Dict[str, float]:
+        """获取统计信息"""
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "queue_depth": len(self._waiters),
+                "max_queue_depth": self.max_queue_depth,
+                "total_acquired": self.total_acquired,
+                "total_queued": self.total_queued,
+                "total_wait_seconds": round(self.total_wait_seconds, 3),
+            }
@@ -0,0 +1,135 @@
+from typing import Any, Callable, Dict, List
+import os
+import re
+
+# 中日韩字符及全角标点，大约每个字符一个token
+_WIDE_CHAR_PATTERN = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef\u3000-\u303f]')
+
+# 提示中动态部分的默认token预算
+DEFAULT_CONTEXT_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '6000'))
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数
+
+    中文字符按每字一个token计，其他字符按每4个字符一个token计，偏保守。
+
+    Args:
+        text: 文本
+
+    Returns:
+        int: 估算的token数
+    """
+    if not text:
+        return 0
+    wide = len(_WIDE_CHAR_PATTERN.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = 'head') -> str:
+    """截断文本使其不超过指定token数
+
+    Args:
+        text: 文本
+        max_tokens: 最大token数
+        keep: 'head'保留开头，'tail'保留结尾
+
+    Returns:
+        str: 截断后的文本
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    # 二分查找能放下的最长长度
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[:mid] if keep == 'head' else text[-mid:]
+        if estimate_tokens(part) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "……" if keep == 'head' else "……" + text[-low:]
+
+
+class ContextBuilder:
+    """按优先级在token预算内组装提示上下文
+
+    每个部分带有优先级（数字越小越优先），build时按优先级依次放入：
+    - 文本部分放不下时按keep方向截断，required部分即使超出预算也会保留
+    - 列表部分（对话轮次、历史事件）从最新的条目开始放，放不下的旧条目被省略
+    """
+
+    def __init__(self, budget: int = None):
+        self.budget = DEFAULT_CONTEXT_BUDGET if budget is None else budget
+        self._sections = []
+        self.used_tokens = 0
+        self.omitted: Dict[str, int] = {}
+
+    def add_text(self, name: str, text: str, priority: int, required: bool = False, keep: str = 'head'):
+        """添加文本部分
+
+        Args:
+            name: 部分名称
+            text: 文本内容
+            priority: 优先级，越小越优先
+            required: 是否必须完整保留
+            keep: 超出预算时保留的方向，'head'或'tail'
+        """
+        self._sections.append({"name": name, "kind": "text", "text": text or "", "priority": priority,
+                               "required": required, "keep": keep})
+        return self
+
+    def add_items(self, name: str, items: List[Any], priority: int,
+                  item_text: Callable[[Any], str] = str,
+                  render: Callable[[List[Any]], str] = None):
+        """添加列表部分，优先保留最新的条目
+
+        Args:
+            name: 部分名称
+            items: 按时间顺序排列的条目
+            priority: 优先级，越小越优先
+            item_text: 用于估算单个条目长度的函数
+            render: 将选中条目渲染为文本的函数，默认逐行拼接
+        """
+        self._sections.append({"name": name, "kind": "items", "items": items, "priority": priority,
+                               "item_text": item_text,
+                               "render": render or (lambda selected: "\n".join(item_text(i) for i in selected))})
+        return self
+
+    def build(self) -> Dict[str, str]:
+        """组装上下文
+
+        Returns:
+            Dict[str, str]: 部分名称到文本的映射
+        """
+        remaining = self.budget
+        result = {}
+        self.omitted = {}
+        for section in sorted(self._sections, key=lambda x: x["priority"]):
+            if section["kind"] == "text":
+                text = section["text"]
+                cost = estimate_tokens(text)
+                if cost > remaining and not section["required"]:
+                    text = truncate_to_tokens(text, remaining, section["keep"])
+                    cost = estimate_tokens(text)
+                    if text != section["text"]:
+                        self.omitted[section["name"]] = 1
+                result[section["name"]] = text
+                remaining -= cost
+            else:
+                selected = []
+                for item in reversed(section["items"]):
+                    cost = estimate_tokens(section["item_text"](item)) + 1
+                    if cost > remaining:
+                        break
+                    selected.append(item)
+                    remaining -= cost
+                selected.reverse()
+                dropped = len(section["items"]) - len(selected)
+                if dropped:
+                    self.omitted[section["name"]] = dropped
+                result[section["name"]] = section["render"](selected) if selected else ""
+        self.used_tokens = self.budget - remaining
+        return result
@@ -0,0 +1,101 @@
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Optional
+import asyncio
+import threading
+import time
+from .logger import setup_logger
+from .tracing import current_span, tracer
+
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """获取进程级的后台事件循环（在守护线程中常驻运行）
+
+    Returns:
+        asyncio.AbstractEventLoop: 后台事件循环
+    """
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='background-jobs', daemon=True)
+            thread.start()
+            _background_loop = loop
+        return _background_loop
+
+
+class SessionJobQueue:
+    def __init__(self, name: str = 'session'):
+        self.logger = setup_logger('SessionJobQueue')
+        """初始化会话级后台任务队列
+
+        同一队列内的任务严格按提交顺序串行执行，不同会话的队列之间互不阻塞。
+
+        Args:
+            name: 队列名称，用于日志
+        """
+        self.name = name
+        self._tail: Optional[Future] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, job_factory: Callable[[], Awaitable], description: str = "") -> Future:
+        """提交后台任务
+
+        Args:
+            job_factory: 返回协程的无参函数，在后台事件循环中调用
+            description: 任务描述，用于日志
+
+        Returns:
+            Future: 任务完成的Future
+        """
+        with self._lock:
+            previous = self._tail
+            self.pending += 1
+            # 后台任务运行在另一个事件循环中，显式记录提交时的span作为父span
+            future = asyncio.run_coroutine_threadsafe(
+                self._run(previous, job_factory, description, current_span(), time.perf_counter()),
+                get_background_loop())
+            self._tail = future
+        self.logger.info(f"[{self.name}] 提交后台任务: {description}，待执行: {self.pending}")
+        return future
+
+    async def _run(self, previous: Optional[Future], job_factory: Callable[[], Awaitable], description: str,
+                   parent=None, submitted_at: float = 0.0):
+        # 等待前一个任务结束，保证同一会话内的顺序
+        if previous is not None:
+            try:
+                await asyncio.wrap_future(previous)
+            except Exception:
+                pass
+        try:
+            with tracer.span("job", parent=parent, description=description,
+                             queue_wait=time.perf_counter() - submitted_at):
+                await job_factory()
+            self.logger.info(f"[{self.name}] 后台任务完成: {description}")
+        except Exception as e:
+            self.logger.error(f"[{self.name}] 后台任务失败: {description}: {e}")
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    async def join(self):
+        """等待已提交的任务全部完成（可在任意事件循环中调用）
+
+        任务执行过程中可能提交新的任务，因此循环等待直到队尾不再变化。
+        """
+        while True:
+            tail = self._tail
+            if tail is None or tail.done():
+                return
+            await asyncio.wrap_future(tail)
+
+    def wait(self, timeout: float = None):
+        """阻塞等待已提交的任务全部完成（在非事件循环线程中调用）"""
+        while True:
+            tail = self._tail
+            if tail is None or tail.done():
+                return
+            tail.result(timeout=timeout)
@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import asyncio
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from .logger import setup_logger
+
+
+class LLMCache:
+    def __init__(self, max_entries: int = 1000, db_path: str = None, max_disk_entries: int = 10000,
+                 flush_interval: float = 1.0, purge_interval: float = 600):
+        self.logger = setup_logger('LLMCache')
+        """初始化LLM结果缓存
+
+        内存层为LRU，可选的SQLite磁盘层用于进程重启后和多进程间复用结果。
+        磁盘层的写入先进入待写队列，由后台线程每flush_interval秒在一个事务中批量提交；
+        读取磁盘层通过aget在线程中进行，不阻塞事件循环。打开时和之后每purge_interval秒清理过期条目，
+        条目数超过max_disk_entries时淘汰最早过期的条目。
+
+        Args:
+            max_entries: 内存层最多缓存的条目数
+            db_path: SQLite文件路径，为空时不启用磁盘层
+            max_disk_entries: 磁盘层最多保留的条目数
+            flush_interval: 批量写入磁盘层的间隔（秒）
+            purge_interval: 清理磁盘层的间隔（秒）
+        """
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (过期时间, 结果)
+        self._pending: Dict[str, tuple] = {}  # 尚未写入磁盘层的条目，key -> (过期时间, 结果)
+        self._lock = threading.Lock()  # 保护内存层、待写队列和统计
+        self._db_lock = threading.Lock()  # 保护SQLite连接，磁盘I/O期间不占用_lock
+        self._db = None
+        self._writer: Optional[threading.Thread] = None
+        self._disk_entries = 0  # 磁盘层条目数（写入后的估计值，清理时重新统计）
+        # 统计信息
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_expires ON llm_cache (expires_at)")
+                self._db.commit()
+                self.logger.info(f"启用LLM磁盘缓存: {db_path}")
+                self.purge_expired()
+            except Exception as e:
+                self.logger.error(f"初始化LLM磁盘缓存失败: {e}")
+                self._db = None
+
+    @staticmethod
+    def make_key(model: str, content: str) -> str:
+        """根据模型和内容生成缓存键"""
+        return hashlib.sha256(f"{model}\0{content}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，未命中或已过期时返回None。会在当前线程读取磁盘层，事件循环中应使用aget"""
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        return self._get_disk(key)
+
+    async def aget(self, key: str) -> Optional[str]:
+        """读取缓存，内存层未命中时在线程中读取磁盘层"""
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        return await asyncio.to_thread(self._get_disk, key)
+
+    def _get_memory(self, key: str) -> Tuple[bool, Optional[str]]:
+        """读取内存层和待写队列，返回(是否已有结论, 结果)；需要继续读取磁盘层时返回(False, None)"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return True, entry[1]
+                del self._memory[key]
+            entry = self._pending.get(key)
+            if entry is not None and entry[0] > now:
+                self.memory_hits += 1
+                self._put_memory(key, entry[1], entry[0])
+                return True, entry[1]
+            if self._db is None:
+                self.misses += 1
+                return True, None
+        return False, None
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is not None and row[1] > time.time():
+                self.disk_hits += 1
+                self._put_memory(key, row[0], row[1])
+                return row[0]
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str, ttl: float):
+        """写入缓存，磁盘层由后台线程批量写入
+
+        Args:
+            key: 缓存键
+            value: 结果
+            ttl: 有效期（秒）
+        """
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._put_memory(key, value, expires_at)
+            if self._db is None:
+                return
+            self._pending[key] = (expires_at, value)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='llm-cache-writer', daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        last_purge = time.monotonic()
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            if time.monotonic() - last_purge >= self.purge_interval:
+                last_purge = time.monotonic()
+                self.purge_expired()
+
+    def flush(self):
+        """把待写队列在一个事务中写入磁盘层"""
+        with self._lock:
+            if self._db is None or not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+        try:
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    [(key, value, expires_at) for key, (expires_at, value) in batch.items()])
+                self._db.commit()
+                self._disk_entries += len(batch)
+                over_limit = self._disk_entries > self.max_disk_entries
+        except Exception as e:
+            self.logger.error(f"写入LLM磁盘缓存失败: {e}")
+            return
+        if over_limit:
+            self.purge_expired()
+
+    def purge_expired(self):
+        """清理磁盘层中已过期的条目，仍超过条目上限时淘汰最早过期的条目"""
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+            count = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            excess = count - self.max_disk_entries
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY expires_at LIMIT ?)", (excess,))
+                count -= excess
+            self._db.commit()
+            self._disk_entries = count
+        if excess > 0:
+            with self._lock:
+                self.disk_evictions += excess
+
+    def _put_memory(self, key: str, value: str, expires_at: float):
+        """写入内存层，调用方需持有锁"""
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        """获取命中统计"""
+        with self._lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "disk_entries": self._disk_entries,
+                "pending_writes": len(self._pending),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / total, 3) if total else 0.0,
+            }
+
+
+_shared_cache: Optional[LLMCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache:
+    """获取进程共享的LLM缓存
+
+    内存层容量、磁盘路径和磁盘层条目上限由LLM_CACHE_SIZE、LLM_CACHE_DB、LLM_CACHE_DISK_SIZE配置
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = LLMCache(
+                max_entries=int(os.getenv('LLM_CACHE_SIZE', '1000')),
+                db_path=os.getenv('LLM_CACHE_DB') or None,
+                max_disk_entries=int(os.getenv('LLM_CACHE_DISK_SIZE', '10000'))
+            )
+            atexit.register(_shared_cache.flush)  # 退出前写入尚未提交的条目
+        return _shared_cache
@@ -1,40 +1,435 @@
-from openai import AsyncOpenAI
+from contextlib import aclosing, asynccontextmanager
+from openai import BadRequestError
 import asyncio
+import json
 import os
+import random
+import time
+from .concurrency import ConcurrencyLimiter
+from .context_builder import estimate_tokens
+from .llm_cache import LLMCache, get_llm_cache
 from .logger import setup_logger
+from .provider_pool import Endpoint, get_provider_pool
+from .single_flight import SingleFlight
+from .tracing import Span, tracer
+from .structured import (JsonStreamParser, StructuredOutput, StructuredOutputError, StructuredStream,
+                         TaskCheck)
+
+# 确定性调用（分类、时间解析等）的默认缓存时间（秒）
+DEFAULT_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', '86400'))
+
+# 结构化输出方式：json_object（默认）、json_schema（接口支持严格schema时），或prompt（只在提示中约束格式）
+STRUCTURED_OUTPUT_MODE = os.getenv('STRUCTURED_OUTPUT_MODE', 'json_object')
+# 接口明确表示不支持response_format后，本进程改为只用提示约束格式
+_response_format_supported = STRUCTURED_OUTPUT_MODE in ('json_object', 'json_schema')
+
+# 全局并发上限，所有会话共享
+_global_limiter = ConcurrencyLimiter(int(os.getenv('LLM_MAX_CONCURRENCY', '32')), 'global')
+
+# 是否合并相同的并发调用（模型、提示和输出格式都相同时共享一次请求），所有会话共享
+LLM_COALESCE = os.getenv('LLM_COALESCE', '1') == '1'
+_single_flight = SingleFlight('llm')
+
+def get_pool_metrics() -> dict:
+    """获取全局并发、各接口健康状态和连接池的统计信息"""
+    endpoints = get_provider_pool().stats()
+    return {
+        "global": _global_limiter.stats(),
+        "clients": sum(endpoint["clients"] for endpoint in endpoints),
+        "endpoints": endpoints,
+        "coalesce": _single_flight.stats(),
+        "cache": get_llm_cache().stats()
+    }
+
+
+def _flight_key(mode: str, model: str, use_small_model: bool, prompt: str, response_format=None) -> str:
+    """相同的调用才会被合并：流式与否、模型、提示和输出格式都相同"""
+    options = json.dumps([mode, use_small_model, response_format], sort_keys=True, default=str)
+    return LLMCache.make_key(f"{model}\0{options}", prompt)
+
+
+async def _replay(head: list, stream):
+    """先产生已读取的chunk，再继续读取流"""
+    for chunk in head:
+        yield chunk
+    async for chunk in stream:
+        yield chunk
 
 
 class LLMService:
     def __init__(self):
         self.logger = setup_logger('LLMService')
-        self.client = AsyncOpenAI(
-            base_url=os.getenv('MODEL_URL', 'https://api.deepseek.com/v1'),
-            api_key=os.getenv('MODEL_KEY', '')
-        )
         self.model = os.getenv('MODEL_NAME', 'deepseek-chat')
         self.small_model = os.getenv('SMALL_MODEL_NAME', 'deepseek-chat')
         self.max_retries = 3
         self.retry_delay = 1  # 初始重试延迟(秒)
+        # 单个会话的并发上限
+        self.session_limiter = ConcurrencyLimiter(int(os.getenv('LLM_SESSION_CONCURRENCY', '4')), 'session')
+        self.pool = get_provider_pool()  # 进程共享的接口池
 
-    async def generate_response(self, prompt, use_small_model=False):
+    @asynccontextmanager
+    async def _acquire_slot(self):
+        """先获取会话名额再获取全局名额，避免单个会话占满全局并发"""
+        session_wait = await self.session_limiter.acquire()
+        try:
+            global_wait = await _global_limiter.acquire()
+            try:
+                queue_wait = session_wait + global_wait
+                if queue_wait > 0.1:
+                    self.logger.info(f"LLM请求排队等待 {queue_wait:.2f}s，全局排队: {_global_limiter.queue_depth}")
+                yield queue_wait
+            finally:
+                _global_limiter.release()
+        finally:
+            self.session_limiter.release()
+
+    def _backoff_delay(self, retries: int) -> float:
+        """指数退避加随机抖动，避免限流时所有请求同时重试"""
+        return self.retry_delay * (2 ** (retries - 1)) * random.uniform(0.5, 1.5)
+
+    async def generate_response(self, prompt, use_small_model=False, cache_ttl=None, cache_key=None,
+                                response_format=None):
+        """生成回复
+
+        Args:
+            prompt: 提示词
+            use_small_model: 是否使用小模型
+            cache_ttl: 结果缓存时间（秒），为None时不缓存。只用于结果仅取决于输入的调用
+            cache_key: 用于计算缓存键的内容，默认为提示词本身（需包含影响结果的状态版本）
+            response_format: 传给接口的response_format，为None时不传
+
+        Returns:
+            str: 模型回复
+        """
         if use_small_model:
             model = self.small_model
         else:
             model = self.model
+
+        with tracer.span("llm.generate", model=model) as span:
+            if cache_ttl is not None:
+                cache = get_llm_cache()
+                key = LLMCache.make_key(model, prompt if cache_key is None else cache_key)
+                cached = await cache.aget(key)
+                if cached is not None:
+                    self.logger.info("LLM缓存命中")
+                    span.set(cache_hit=True)
+                    return cached
+
+            async def request():
+                response = await self._request_completion(model, prompt, span, response_format, use_small_model)
+                if cache_ttl is not None:
+                    cache.set(key, response, cache_ttl)
+                return response
+
+            if not LLM_COALESCE:
+                return await request()
+            return await _single_flight.call(
+                _flight_key("generate", model, use_small_model, prompt, response_format), request, span)
+
+    @staticmethod
+    def _record_usage(span: Span, usage, prompt: str, completion: str):
+        """记录token数，接口没有返回usage时按文本估算"""
+        if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+            span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+        else:
+            span.set(prompt_tokens=estimate_tokens(prompt), completion_tokens=estimate_tokens(completion),
+                     tokens_estimated=True)
+
+    async def _request_completion(self, model, prompt, span: Span, response_format=None, use_small_model=False):
+        """请求模型生成完整回复
+
+        失败时立即换一个接口重试，没有其他可用接口时指数退避后重试同一接口。
+        """
+        extra = {"response_format": response_format} if response_format is not None else {}
+        kind = f"generate:{'small' if use_small_model else 'main'}"
+        tried = []  # 本次请求已经失败过的接口
         retries = 0
         while retries < self.max_retries:
+            endpoint = self.pool.choose(exclude=tried)
+            if endpoint in tried:
+                await asyncio.sleep(self._backoff_delay(retries))  # 指数退避
             try:
-                response = await self.client.chat.completions.create(
-                    model=model,
-                    messages=[{"role": "user", "content": prompt}]
-                )
-                return response.choices[0].message.content
+                async with self._acquire_slot() as queue_wait:
+                    span.incr("queue_wait", queue_wait)
+                    response, endpoint = await self.pool.hedged(
+                        lambda e: e.client().chat.completions.create(
+                            model=e.model_name(model, use_small_model),
+                            messages=[{"role": "user", "content": prompt}],
+                            **extra
+                        ), endpoint, kind, exclude=tried)
+                span.set(endpoint=endpoint.name)
+                content = response.choices[0].message.content
+                self._record_usage(span, getattr(response, "usage", None), prompt, content or "")
+                return content
             except Exception as e:
+                if extra and isinstance(e, BadRequestError):
+                    raise  # 可能是接口不支持response_format，由调用方改为只用提示约束，不重试
                 retries += 1
+                span.set(retries=retries)
+                tried.append(endpoint)
                 if retries == self.max_retries:
                     self.logger.error(f"LLM API Error after {retries} retries: {e}")
                     raise
-                await asyncio.sleep(self.retry_delay * (2 ** (retries - 1)))  # 指数退避
+                self.logger.warning(f"接口{endpoint.name}请求失败，准备重试: {e}")
+
+    async def stream_response(self, prompt, use_small_model=False, cache_ttl=None, cache_key=None,
+                              response_format=None):
+        """流式生成回复
+
+        Args:
+            prompt: 提示词
+            use_small_model: 是否使用小模型
+            cache_ttl: 结果缓存时间（秒），为None时不缓存，命中时一次性返回完整结果
+            cache_key: 用于计算缓存键的内容，默认为提示词本身
+            response_format: 传给接口的response_format，为None时不传
+
+        Yields:
+            str: 模型逐块生成的文本
+        """
+        if use_small_model:
+            model = self.small_model
+        else:
+            model = self.model
+
+        # 生成器在两次yield之间可能运行在不同的上下文中，因此不激活span，显式传给下层
+        span = tracer.start_span("llm.stream", model=model)
+        error = None
+        try:
+            if cache_ttl is not None:
+                cache = get_llm_cache()
+                key = LLMCache.make_key(model, prompt if cache_key is None else cache_key)
+                cached = await cache.aget(key)
+                if cached is not None:
+                    self.logger.info("LLM缓存命中")
+                    span.set(cache_hit=True)
+                    yield cached
+                    return
+
+            async def request():
+                parts = []
+                async with aclosing(self._stream_completion(model, prompt, span, response_format,
+                                                               use_small_model)) as chunks:
+                    async for chunk in chunks:
+                        parts.append(chunk)
+                        yield chunk
+                if cache_ttl is not None:
+                    cache.set(key, "".join(parts), cache_ttl)
+
+            if LLM_COALESCE:
+                stream = _single_flight.stream(
+                    _flight_key("stream", model, use_small_model, prompt, response_format), request, span)
+            else:
+                stream = request()
+            async with aclosing(stream) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            tracer.finish(span, error)
+
+    async def _stream_completion(self, model, prompt, span: Span, response_format=None, use_small_model=False):
+        """流式请求模型
+
+        输出内容前失败时立即换一个接口重试，没有其他可用接口时指数退避后重试同一接口；
+        开启对冲时按首字耗时对冲，先输出内容的接口继续生成，另一个请求被取消。
+        """
+        extra = {"response_format": response_format} if response_format is not None else {}
+        kind = f"stream:{'small' if use_small_model else 'main'}"
+        tried = []
+        retries = 0
+        while True:
+            emitted = False
+            endpoint = self.pool.choose(exclude=tried)
+            if endpoint in tried:
+                await asyncio.sleep(self._backoff_delay(retries))  # 指数退避
+            try:
+                async with self._acquire_slot() as queue_wait:
+                    span.incr("queue_wait", queue_wait)
+                    start = time.perf_counter()
+                    (stream, head), endpoint = await self.pool.hedged(
+                        lambda e: self._open_stream(e, e.model_name(model, use_small_model), prompt, extra),
+                        endpoint, kind, exclude=tried, discard=lambda opened: opened[0].close())
+                    span.set(endpoint=endpoint.name)
+                    usage = None
+                    parts = []
+                    # 被取消或提前关闭（客户端断开）时关闭响应连接，上游随之停止生成
+                    async with stream, aclosing(_replay(head, stream)) as chunks:
+                        async for chunk in chunks:
+                            # 部分接口在最后一个chunk中返回usage
+                            usage = getattr(chunk, "usage", None) or usage
+                            if not chunk.choices:
+                                continue
+                            content = chunk.choices[0].delta.content
+                            if content:
+                                if not emitted:
+                                    span.set(ttft=time.perf_counter() - start)
+                                emitted = True
+                                parts.append(content)
+                                yield content
+                self._record_usage(span, usage, prompt, "".join(parts))
+                return
+            except Exception as e:
+                if extra and isinstance(e, BadRequestError):
+                    raise  # 可能是接口不支持response_format，由调用方改为只用提示约束，不重试
+                retries += 1
+                span.set(retries=retries)
+                tried.append(endpoint)
+                # 已经输出过内容时无法透明重试，直接抛出
+                if emitted:
+                    endpoint.record_failure(e)  # 输出过程中断开也计入接口故障
+                if emitted or retries == self.max_retries:
+                    self.logger.error(f"LLM API Stream Error after {retries} retries: {e}")
+                    raise
+                self.logger.warning(f"接口{endpoint.name}流式请求失败，准备重试: {e}")
+
+    @staticmethod
+    async def _open_stream(endpoint: Endpoint, model, prompt, extra):
+        """在接口上发起流式请求并读取到第一个有内容的chunk
+
+        Returns:
+            tuple: (流, 已读取的chunk列表)
+        """
+        stream = await endpoint.client().chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            **extra
+        )
+        head = []
+        try:
+            while True:
+                try:
+                    chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    break
+                head.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except BaseException:
+            await stream.close()
+            raise
+        return stream, head
+
+    @staticmethod
+    def _response_format(output_type) -> dict:
+        """按配置和接口支持情况生成response_format，只用提示约束时返回None"""
+        if not _response_format_supported:
+            return None
+        if STRUCTURED_OUTPUT_MODE == 'json_schema':
+            return {"type": "json_schema",
+                    "json_schema": {"name": output_type.__name__, "schema": output_type.json_schema(), "strict": True}}
+        return {"type": "json_object"}
+
+    @staticmethod
+    def _is_response_format_error(error: BadRequestError) -> bool:
+        """400错误是否明确由response_format引起（而不是上下文超长、内容审核等其他原因）"""
+        if getattr(error, "param", None) in ("response_format", "json_schema"):
+            return True
+        message = str(error).lower()
+        return any(word in message for word in ("response_format", "json_schema", "json_object"))
+
+    def _fallback_without_response_format(self, error: BadRequestError):
+        """带response_format的请求返回400后改为只在提示中约束格式
+
+        只有错误明确与response_format有关时才对整个进程关闭，否则只有本次调用不带response_format重试。
+        """
+        global _response_format_supported
+        if self._is_response_format_error(error):
+            _response_format_supported = False
+            self.logger.warning(f"接口不支持response_format，改为只在提示中约束输出格式: {error}")
+        else:
+            self.logger.warning(f"带response_format的请求被拒绝，本次改为只在提示中约束输出格式: {error}")
+
+    async def _generate_json(self, prompt, output_type, use_small_model=False, cache_ttl=None, cache_key=None):
+        """请求JSON格式的完整回复"""
+        response_format = self._response_format(output_type)
+        if response_format is not None:
+            try:
+                return await self.generate_response(prompt, use_small_model, cache_ttl, cache_key, response_format)
+            except BadRequestError as e:
+                self._fallback_without_response_format(e)
+        return await self.generate_response(prompt, use_small_model, cache_ttl, cache_key)
+
+    async def generate_structured(self, prompt, output_type, use_small_model=False, cache_ttl=None, cache_key=None):
+        """生成结构化回复
+
+        Args:
+            prompt: 提示词，不需要包含输出格式说明（按output_type自动追加）
+            output_type: StructuredOutput的子类
+            use_small_model: 是否使用小模型
+            cache_ttl: 结果缓存时间（秒），为None时不缓存
+            cache_key: 用于计算缓存键的内容，默认为提示词本身
+
+        Returns:
+            StructuredOutput: output_type的实例
+
+        Raises:
+            StructuredOutputError: 修复后仍无法解析，且output_type没有兜底结果
+        """
+        prompt += output_type.format_instructions()
+        text = await self._generate_json(prompt, output_type, use_small_model, cache_ttl, cache_key)
+        return await self.parse_structured(text, output_type)
+
+    def stream_structured(self, prompt, output_type, use_small_model=False) -> StructuredStream:
+        """流式生成结构化回复
+
+        Args:
+            prompt: 提示词，不需要包含输出格式说明
+            output_type: StructuredOutput的子类
+            use_small_model: 是否使用小模型
+
+        Returns:
+            StructuredStream: 迭代得到顶层字符串字段的新增文本，结束后result为解析后的对象
+        """
+        stream = StructuredStream()
+        return stream.bind(self._structured_events(prompt + output_type.format_instructions(), output_type,
+                                                   use_small_model, stream))
+
+    async def _structured_events(self, prompt, output_type, use_small_model, stream: StructuredStream):
+        parser = JsonStreamParser()
+        response_format = self._response_format(output_type)
+        try:
+            async with aclosing(self.stream_response(prompt, use_small_model,
+                                                     response_format=response_format)) as chunks:
+                async for chunk in chunks:
+                    for event in parser.feed(chunk):
+                        yield event
+        except BadRequestError as e:
+            if response_format is None or parser.parts:
+                raise
+            self._fallback_without_response_format(e)
+            async with aclosing(self.stream_response(prompt, use_small_model)) as chunks:
+                async for chunk in chunks:
+                    for event in parser.feed(chunk):
+                        yield event
+        stream.result = await self.parse_structured(parser.text, output_type)
+
+    async def parse_structured(self, text: str, output_type) -> StructuredOutput:
+        """解析结构化回复，失败时用小模型修复一次，仍失败时使用output_type的兜底结果"""
+        try:
+            return output_type.parse(text)
+        except StructuredOutputError as e:
+            error = e
+        self.logger.warning(f"结构化输出解析失败（{output_type.__name__}）: {error}，尝试修复")
+
+        prompt = f"""以下内容本应是一个JSON对象，但解析失败：{error}
+请修正格式后输出，保留原有内容，不要增加或改写信息。
+
+[原始内容]
+{text}""" + output_type.format_instructions()
+        try:
+            with tracer.span("llm.repair", output=output_type.__name__):
+                repaired = await self._generate_json(prompt, output_type, use_small_model=True)
+            return output_type.parse(repaired)
+        except Exception as e:
+            result = output_type.fallback(text)
+            if result is None:
+                raise StructuredOutputError(f"修复结构化输出失败: {e}", text)
+            self.logger.error(f"修复结构化输出失败（{output_type.__name__}），使用原始文本: {e}")
+            return result
 
     async def detect_task(self, message: str) -> tuple[bool, str]:
         """从对话中检测任务
@@ -65,7 +460,7 @@ class LLMService:
         """
 
         try:
-            response = await self.generate_response(prompt)
+            response = await self.generate_response(prompt, cache_ttl=DEFAULT_CACHE_TTL)
             if "系统任务内容" in response:
                 tasks_desc = response
                 self.logger.debug(f"检测到任务: {tasks_desc}")
@@ -95,19 +490,17 @@ class LLMService:
         # [相关上下文]
         {context}
 
-        请返回完成哪些了哪些任务，按照如下格式：
-        [完成任务]：[任务描述1]，[任务描述2]，[任务描述3]
-        如果没有任务完成，请返回：
-        无任务完成
-        
+        请返回完成了哪些任务。
         注意：仅考虑[任务]中的内容，其他部分的不是任务描述，不需要考虑。
         """
 
         try:
-            response = await self.generate_response(prompt)
-            is_completed = "[完成任务]" in response
+            result = await self.generate_structured(prompt, TaskCheck)
+            is_completed = bool(result.completed_tasks)
             self.logger.info(f"任务状态检查结果: {'已完成' if is_completed else '未完成'}")
-            return is_completed, response
+            if not is_completed:
+                return False, "无任务完成"
+            return True, "[完成任务]：" + "，".join(result.completed_tasks)
         except Exception as e:
             self.logger.error(f"任务状态检查失败: {e}")
             return False, ""
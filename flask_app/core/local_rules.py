@@ -0,0 +1,213 @@
+"""本地规则：常见的时间描述和修改类型不调用LLM，直接用规则判断
+
+规则无法确定时返回None，由调用方退回到小模型。各规则的命中和退回次数记录在fast_path_stats中。
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+import calendar
+import re
+import threading
+
+# 时间增量：(月数, 秒数)，月和年按日历推进，其余单位换算为秒
+TimeSpan = Tuple[int, int]
+
+_DAY = 86400
+
+# 单位 -> (是否按月计算, 每单位的月数或秒数)
+_UNITS = {
+    "s": (False, 1), "m": (False, 60), "h": (False, 3600), "d": (False, _DAY), "w": (False, 7 * _DAY),
+    "M": (True, 1), "y": (True, 12),
+}
+
+# 自然语言单位，按长度降序匹配
+_UNIT_WORDS = {
+    "秒钟": "s", "秒": "s", "分钟": "m", "刻钟": "quarter", "刻": "quarter",
+    "小时": "h", "钟头": "h", "天": "d", "日": "d",
+    "星期": "w", "礼拜": "w", "周": "w", "月": "M", "年": "y",
+    "seconds": "s", "second": "s", "secs": "s", "sec": "s",
+    "minutes": "m", "minute": "m", "mins": "m", "min": "m",
+    "hours": "h", "hour": "h", "hrs": "h", "hr": "h",
+    "days": "d", "day": "d", "weeks": "w", "week": "w",
+    "months": "M", "month": "M", "years": "y", "year": "y",
+}
+
+# 整句即为时间增量的常见说法
+_RELATIVE_WORDS = {
+    "明天": "1d", "明日": "1d", "次日": "1d", "第二天": "1d", "隔天": "1d", "后天": "2d", "大后天": "3d",
+    "下周": "1w", "下星期": "1w", "下礼拜": "1w", "下个星期": "1w", "下个礼拜": "1w", "下一周": "1w",
+    "下个月": "1M", "下月": "1M", "明年": "1y", "来年": "1y", "第二年": "1y", "后年": "2y",
+}
+
+_CN_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_CN_MULTIPLIERS = {"十": 10, "百": 100, "千": 1000, "万": 10000}
+
+_NUMBER = r"\d+(?:\.\d+)?|[零〇一二两三四五六七八九十百千万]+"
+_STANDARD_PATTERN = re.compile(r"(\d+)([smhdwMy])")
+_TERM_PATTERN = re.compile(
+    rf"(?P<number>{_NUMBER})?\s*个?\s*(?P<half>半)?\s*个?\s*"
+    rf"(?P<unit>{'|'.join(sorted(map(re.escape, _UNIT_WORDS), key=len, reverse=True))})(?P<half_after>半)?")
+# 可以忽略的前后缀和连接词
+_PREFIX_PATTERN = re.compile(r"^(?:再过|过了|经过|大约|大概|约|过|in)\s*")
+_SUFFIX_PATTERN = re.compile(r"\s*(?:之后|以后|过后|左右|后|later)$")
+_SEPARATOR_PATTERN = re.compile(r"[\s,，、又和加零]+|and")
+
+
+def _parse_number(text: Optional[str]) -> Optional[float]:
+    """解析阿拉伯数字或中文数字（如"二十五"、"一百零三"、"两"）"""
+    if text is None:
+        return None
+    if text[0].isdigit():
+        return float(text)
+    total, section, digit = 0, 0, None
+    for char in text:
+        if char in _CN_DIGITS:
+            digit = _CN_DIGITS[char]
+        elif char == "万":
+            total = (total + section + (digit or 0)) * 10000
+            section, digit = 0, None
+        else:
+            # "十五"省略了开头的"一"
+            section += (1 if digit is None else digit) * _CN_MULTIPLIERS[char]
+            digit = None
+    return float(total + section + (digit or 0))
+
+
+def _span_of(value: float, unit: str) -> Optional[TimeSpan]:
+    """把数值和单位换算为(月数, 秒数)，非整月的部分按每月30天换算"""
+    if unit == "quarter":
+        value, unit = value * 15, "m"
+    by_month, size = _UNITS[unit]
+    amount = value * size
+    if not by_month:
+        return 0, int(round(amount))
+    months = int(amount)
+    return months, int(round((amount - months) * 30 * _DAY))
+
+
+def _sum_spans(spans: Iterable[TimeSpan]) -> TimeSpan:
+    months, seconds = 0, 0
+    for span_months, span_seconds in spans:
+        months += span_months
+        seconds += span_seconds
+    return months, seconds
+
+
+def parse_standard_time_span(text: str) -> Optional[TimeSpan]:
+    """解析标准格式的时间增量，如"10m"、"3d"、"1M"、"1h30m"（m为分钟，M为月）"""
+    text = text.strip()
+    if not text or _STANDARD_PATTERN.sub("", text).strip():
+        return None
+    return _sum_spans(_span_of(int(value), unit) for value, unit in _STANDARD_PATTERN.findall(text))
+
+
+def parse_time_span(text: str) -> Optional[TimeSpan]:
+    """解析时间增量描述
+
+    支持标准格式（"1h30m"）、中文数字和单位的组合（"三天后"、"1个半小时"、"两天半"、"一年零三个月"）、
+    整句的相对说法（"明天"、"下周"、"下个月"）以及简单的英文（"2 hours"）。
+    无法完整解析时返回None，不会只解析其中一部分。
+
+    Args:
+        text: 时间描述
+
+    Returns:
+        tuple: (月数, 秒数)，无法解析时返回None
+    """
+    span = parse_standard_time_span(text)
+    if span is not None:
+        return span
+    text = _SUFFIX_PATTERN.sub("", _PREFIX_PATTERN.sub("", text.strip().lower()))
+    if text in _RELATIVE_WORDS:
+        return parse_standard_time_span(_RELATIVE_WORDS[text])
+
+    spans = []
+    position = 0
+    while position < len(text):
+        separator = _SEPARATOR_PATTERN.match(text, position)
+        if separator and separator.end() > position:
+            position = separator.end()
+            continue
+        term = _TERM_PATTERN.match(text, position)
+        if term is None or (term.group("number") is None and not term.group("half")):
+            return None
+        value = _parse_number(term.group("number")) or 0
+        if term.group("half") or term.group("half_after"):
+            value += 0.5
+        spans.append(_span_of(value, _UNIT_WORDS[term.group("unit")]))
+        position = term.end()
+    if not spans:
+        return None
+    return _sum_spans(spans)
+
+
+def shift_time(current: datetime, span: TimeSpan) -> datetime:
+    """把时间推进指定的(月数, 秒数)，按月推进时日期超出当月天数则取当月最后一天"""
+    months, seconds = span
+    if months:
+        month_index = current.month - 1 + months
+        year, month = current.year + month_index // 12, month_index % 12 + 1
+        current = current.replace(year=year, month=month,
+                                  day=min(current.day, calendar.monthrange(year, month)[1]))
+    return current + timedelta(seconds=seconds)
+
+
+# 修改内容的关键词，只命中一类时直接判断，两类都命中或都未命中时交给LLM
+_CHARACTER_KEYWORDS = (
+    "主角", "任务", "技能", "属性", "体力", "智力", "敏捷", "意志", "幸运", "生命值", "精神值",
+    "获得", "得到", "物品", "背包", "学会", "能力", "好感", "关系", "心情", "情绪", "想法", "记忆",
+    "性格", "外貌", "身体", "受伤", "等级", "升级",
+)
+_WORLD_KEYWORDS = (
+    "世界", "天气", "下雨", "下雪", "刮风", "城市", "全城", "全国", "国家", "政府", "社会", "新闻",
+    "地震", "爆发", "所有人", "人们", "街道", "时代", "历史", "法律", "经济", "季节",
+)
+_NAME_PATTERN = re.compile(r"^\s*(?:名字|姓名)\s*[:：]\s*(\S+)", re.MULTILINE)
+
+
+def classify_modification(modification: str, character_profile: str = "") -> Optional[str]:
+    """根据关键词判断修改针对世界还是主角
+
+    发布任务视为针对主角；主角档案中的名字也算作主角关键词。
+
+    Args:
+        modification: 修改描述
+        character_profile: 主角档案
+
+    Returns:
+        str: "world"或"character"，无法确定时返回None
+    """
+    character_keywords = list(_CHARACTER_KEYWORDS)
+    name = _NAME_PATTERN.search(character_profile or "")
+    if name:
+        character_keywords.append(name.group(1))
+    character_hit = any(keyword in modification for keyword in character_keywords)
+    world_hit = any(keyword in modification for keyword in _WORLD_KEYWORDS)
+    if character_hit == world_hit:
+        return None
+    return "character" if character_hit else "world"
+
+
+class FastPathStats:
+    """本地规则的命中统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[Tuple[str, str], int] = defaultdict(int)  # (规则, hit或fallback) -> 次数
+
+    def record(self, path: str, hit: bool):
+        with self._lock:
+            self._counts[(path, "hit" if hit else "fallback")] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """各规则的命中次数、退回LLM次数和命中率"""
+        with self._lock:
+            counts = dict(self._counts)
+        result = {}
+        for path in sorted({path for path, _ in counts}):
+            hits, fallbacks = counts.get((path, "hit"), 0), counts.get((path, "fallback"), 0)
+            result[path] = {"hits": hits, "fallbacks": fallbacks, "hit_rate": round(hits / (hits + fallbacks), 3)}
+        return result
+
+
+fast_path_stats = FastPathStats()
@@ -1,51 +1,127 @@
+import atexit
 import logging
 import os
+import queue
+import random
+import threading
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# 写入文件和控制台的最低级别
+FILE_LOG_LEVEL = logging.getLevelName(os.getenv('LOG_FILE_LEVEL', 'DEBUG').upper())
+CONSOLE_LOG_LEVEL = logging.getLevelName(os.getenv('LOG_CONSOLE_LEVEL', 'INFO').upper())
+
+# 提示词、模型回复等长文本的记录级别、最大字符数（0表示不截断）和采样比例
+TEXT_LOG_LEVEL = logging.getLevelName(os.getenv('LOG_TEXT_LEVEL', 'DEBUG').upper())
+TEXT_LOG_MAX_CHARS = int(os.getenv('LOG_TEXT_MAX_CHARS', '500'))
+TEXT_LOG_SAMPLE_RATE = float(os.getenv('LOG_TEXT_SAMPLE_RATE', '1.0'))
+
+_logs_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'logs')
+_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# 所有日志记录器共享一个队列，由单个后台线程写入文件和控制台，请求线程和事件循环中只做入队
+_queue = queue.SimpleQueue()
+_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+
+
+class _RoutingHandler(logging.Handler):
+    """在监听线程中把日志按记录器名称分发到各自的文件，并输出到控制台"""
+
+    def __init__(self):
+        super().__init__()
+        self._file_handlers = {}
+        self._console_handler = logging.StreamHandler()
+        self._console_handler.setFormatter(_formatter)
+
+    def _file_handler(self, name: str) -> logging.Handler:
+        handler = self._file_handlers.get(name)
+        if handler is None:
+            os.makedirs(_logs_dir, exist_ok=True)
+            current_date = datetime.now().strftime('%Y-%m-%d')
+            # 每个文件最大10MB，保留5个备份
+            handler = RotatingFileHandler(
+                os.path.join(_logs_dir, f'{name}_{current_date}.log'),
+                maxBytes=10*1024*1024,
+                backupCount=5,
+                encoding='utf-8'
+            )
+            handler.setFormatter(_formatter)
+            self._file_handlers[name] = handler
+        return handler
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno >= FILE_LOG_LEVEL:
+            self._file_handler(record.name).handle(record)
+        if record.levelno >= CONSOLE_LOG_LEVEL:
+            self._console_handler.handle(record)
+
+    def flush(self):
+        for handler in self._file_handlers.values():
+            handler.flush()
+        self._console_handler.flush()
+
+
+def _get_queue_handler() -> QueueHandler:
+    """获取共享的队列处理器，首次调用时启动监听线程"""
+    global _listener, _queue_handler
+    with _lock:
+        if _queue_handler is None:
+            _queue_handler = QueueHandler(_queue)
+            _listener = QueueListener(_queue, _RoutingHandler(), respect_handler_level=False)
+            _listener.start()
+            atexit.register(stop_logging)
+        return _queue_handler
+
+
+def stop_logging():
+    """停止监听线程，写出队列中剩余的日志"""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
 
 def setup_logger(name: str) -> logging.Logger:
     """设置日志记录器
 
+    可重复调用：同名记录器只会挂一次处理器，World、Character等重建时不会重复输出。
+
     Args:
         name: 日志记录器名称（通常是类名）
 
     Returns:
         logging.Logger: 配置好的日志记录器
     """
-    # 创建日志记录器
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-
-    # 创建logs目录（如果不存在）
-    logs_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'logs')
-    os.makedirs(logs_dir, exist_ok=True)
-
-    # 创建日志文件名（使用当前日期）
-    current_date = datetime.now().strftime('%Y-%m-%d')
-    log_file = os.path.join(logs_dir, f'{name}_{current_date}.log')
-
-    # 创建文件处理器（每个文件最大10MB，保留5个备份）
-    file_handler = RotatingFileHandler(
-        log_file,
-        maxBytes=10*1024*1024,  # 10MB
-        backupCount=5,
-        encoding='utf-8'
-    )
-    file_handler.setLevel(logging.DEBUG)
-
-    # 创建控制台处理器
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-
-    # 创建格式化器
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    # 添加处理器到日志记录器
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-
+    handler = _get_queue_handler()
+    if handler not in logger.handlers:
+        logger.setLevel(min(FILE_LOG_LEVEL, CONSOLE_LOG_LEVEL))
+        logger.addHandler(handler)
+        # 不向根记录器传播，避免logging.basicConfig等配置导致重复输出
+        logger.propagate = False
     return logger
+
+
+def log_text(logger: logging.Logger, label: str, text: str, level: int = None):
+    """记录提示词、模型回复等长文本
+
+    只在级别启用时处理，按LOG_TEXT_SAMPLE_RATE采样，超过LOG_TEXT_MAX_CHARS的部分截断。
+
+    Args:
+        logger: 日志记录器
+        label: 文本说明，如"故事演进提示"
+        text: 文本内容
+        level: 日志级别，默认为LOG_TEXT_LEVEL
+    """
+    level = TEXT_LOG_LEVEL if level is None else level
+    if not logger.isEnabledFor(level):
+        return
+    if TEXT_LOG_SAMPLE_RATE < 1.0 and random.random() >= TEXT_LOG_SAMPLE_RATE:
+        return
+    text = str(text)
+    if 0 < TEXT_LOG_MAX_CHARS < len(text):
+        text = f"{text[:TEXT_LOG_MAX_CHARS]}...（共{len(text)}字，已截断）"
+    logger.log(level, f"{label}: {text}")
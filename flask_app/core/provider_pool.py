@@ -0,0 +1,389 @@
+"""LLM接口池：多个OpenAI兼容接口的加权选择、健康跟踪、熔断和对冲请求
+
+接口通过LLM_ENDPOINTS配置（JSON数组），未配置时由MODEL_URL、MODEL_KEY组成单个接口：
+
+    LLM_ENDPOINTS='[{"name": "main", "url": "https://api.deepseek.com/v1", "key_env": "MODEL_KEY", "weight": 3},
+                    {"name": "backup", "url": "https://example.com/v1", "key": "sk-...",
+                     "model": "backup-chat", "small_model": "backup-mini", "weight": 1}]'
+
+每个接口的字段：url（必填）、name（默认为url）、key或key_env（从指定环境变量读取，默认MODEL_KEY）、
+model和small_model（该接口使用的模型名，默认与MODEL_NAME、SMALL_MODEL_NAME相同）、weight（默认1）。
+"""
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import inspect
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
+from .logger import setup_logger
+
+# 连续失败多少次后熔断接口
+LLM_BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '3'))
+# 熔断后多少秒放行一个试探请求
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))
+# 是否开启对冲请求：首个接口超过耗时分位数仍未返回时，向另一个接口发送相同的请求，取先成功的结果
+LLM_HEDGE = os.getenv('LLM_HEDGE', '0') == '1'
+# 对冲时限取接口近期耗时的分位数
+LLM_HEDGE_QUANTILE = float(os.getenv('LLM_HEDGE_QUANTILE', '0.95'))
+# 样本数不足时不对冲
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+# 对冲时限的下限（秒），避免样本偏小时频繁对冲
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '0.2'))
+# 每个接口每类请求保留的耗时样本数
+LLM_LATENCY_WINDOW = int(os.getenv('LLM_LATENCY_WINDOW', '200'))
+
+# 不计为接口故障的状态码：请求本身有问题，换接口重试也不会成功
+_CLIENT_ERROR_STATUS = {400, 413, 422}
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """错误是否说明接口不可用（网络错误、超时、限流、5xx、鉴权失败等）"""
+    return getattr(error, "status_code", None) not in _CLIENT_ERROR_STATUS
+
+
+def create_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    """创建AsyncOpenAI客户端
+
+    连接池大小、keep-alive和超时均可通过环境变量配置：
+    LLM_MAX_CONNECTIONS、LLM_MAX_KEEPALIVE、LLM_KEEPALIVE_EXPIRY、LLM_CONNECT_TIMEOUT、LLM_READ_TIMEOUT
+    """
+    limits = httpx.Limits(
+        max_connections=int(os.getenv('LLM_MAX_CONNECTIONS', '100')),
+        max_keepalive_connections=int(os.getenv('LLM_MAX_KEEPALIVE', '20')),
+        keepalive_expiry=float(os.getenv('LLM_KEEPALIVE_EXPIRY', '30'))
+    )
+    timeout = httpx.Timeout(
+        float(os.getenv('LLM_READ_TIMEOUT', '120')),
+        connect=float(os.getenv('LLM_CONNECT_TIMEOUT', '10'))
+    )
+    return AsyncOpenAI(
+        base_url=base_url,
+        api_key=api_key,
+        timeout=timeout,
+        max_retries=0,  # 重试和切换接口由LLMService统一处理，避免与SDK内部重试叠加
+        http_client=DefaultAsyncHttpxClient(limits=limits, timeout=timeout)
+    )
+
+
+class CircuitBreaker:
+    """单个接口的熔断器
+
+    连续失败达到阈值后断开，冷却期内不再选择该接口；冷却结束后放行一个试探请求，
+    成功则恢复，失败则重新断开。
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold: int = LLM_BREAKER_THRESHOLD, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0.0
+        self._trial = False  # 半开状态下是否已放行试探请求
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """当前是否可以选择该接口（不占用试探名额）"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at >= self.cooldown
+            return not self._trial
+
+    def allow(self) -> bool:
+        """选择该接口前调用，半开状态下只放行一个试探请求"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+    def record_abandoned(self):
+        """请求被取消或因请求本身的问题失败，不影响健康状态，只归还试探名额"""
+        with self._lock:
+            self._trial = False
+
+
+class Endpoint:
+    def __init__(self, name: str, base_url: str, api_key: str, model: str = None, small_model: str = None,
+                 weight: float = 1.0):
+        self.logger = setup_logger('Endpoint')
+        """一个OpenAI兼容接口
+
+        Args:
+            name: 名称，用于日志和指标
+            base_url: 接口地址
+            api_key: 接口密钥
+            model: 该接口使用的模型名，为空时使用LLMService的默认模型
+            small_model: 该接口使用的小模型名，为空时使用LLMService的默认小模型
+            weight: 选择权重
+        """
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.small_model = small_model
+        self.weight = max(0.0, float(weight))
+        self.breaker = CircuitBreaker()
+        self.requests = 0
+        self.failures = 0
+        self.hedged = 0  # 作为首选接口超时而触发对冲的次数
+        self.hedge_wins = 0  # 作为对冲接口先返回结果的次数
+        self._latencies: Dict[str, deque] = {}  # 请求类型 -> 近期成功请求的耗时
+        self._clients = weakref.WeakKeyDictionary()  # 事件循环 -> 客户端
+        self._lock = threading.Lock()
+
+    def client(self) -> AsyncOpenAI:
+        """获取当前事件循环中该接口的客户端（httpx连接池不能跨事件循环使用）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                client = create_client(self.base_url, self.api_key)
+                self._clients[loop] = client
+            return client
+
+    async def close_client(self, loop: asyncio.AbstractEventLoop):
+        """关闭该事件循环中的客户端及其连接池"""
+        with self._lock:
+            client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.close()
+
+    def model_name(self, model: str, small: bool = False) -> str:
+        """该接口上实际使用的模型名"""
+        return (self.small_model if small else self.model) or model
+
+    def record_success(self, kind: str, seconds: float):
+        self.breaker.record_success()
+        with self._lock:
+            self.requests += 1
+            window = self._latencies.get(kind)
+            if window is None:
+                window = self._latencies[kind] = deque(maxlen=LLM_LATENCY_WINDOW)
+            window.append(seconds)
+
+    def record_failure(self, error: BaseException):
+        if not is_endpoint_failure(error):
+            self.breaker.record_abandoned()
+            return
+        was_open = self.breaker.state == CircuitBreaker.OPEN
+        self.breaker.record_failure()
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+        if not was_open and self.breaker.state == CircuitBreaker.OPEN:
+            self.logger.warning(f"接口{self.name}连续失败{self.breaker.failures}次，熔断{self.breaker.cooldown:.0f}秒: {error}")
+
+    def latency_quantile(self, kind: str, quantile: float, min_samples: int = 1) -> Optional[float]:
+        """近期成功请求耗时的分位数，样本不足时返回None"""
+        with self._lock:
+            samples = sorted(self._latencies.get(kind, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(quantile * len(samples)))]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            kinds = list(self._latencies)
+            result = {"name": self.name, "state": self.breaker.state, "weight": self.weight,
+                      "requests": self.requests, "failures": self.failures,
+                      "hedged": self.hedged, "hedge_wins": self.hedge_wins, "clients": len(self._clients)}
+        result["p95"] = {kind: round(self.latency_quantile(kind, 0.95), 3) for kind in kinds}
+        return result
+
+
+class ProviderPool:
+    def __init__(self, endpoints: Sequence[Endpoint], hedge: bool = LLM_HEDGE,
+                 hedge_quantile: float = LLM_HEDGE_QUANTILE, hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+                 hedge_min_delay: float = LLM_HEDGE_MIN_DELAY):
+        self.logger = setup_logger('ProviderPool')
+        """LLM接口池
+
+        Args:
+            endpoints: 接口列表，至少一个
+            hedge: 是否开启对冲请求
+            hedge_quantile: 对冲时限取首选接口近期耗时的该分位数
+            hedge_min_samples: 样本数少于该值时不对冲
+            hedge_min_delay: 对冲时限的下限（秒）
+        """
+        if not endpoints:
+            raise ValueError("至少需要配置一个LLM接口")
+        self.endpoints = list(endpoints)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+
+    def choose(self, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        """按权重选择一个接口
+
+        优先选择不在exclude中且未熔断的接口；都不可用时在所有未熔断的接口中选择；
+        全部熔断时选择最早熔断的接口，仍然发出请求而不是直接失败。
+
+        Args:
+            exclude: 尽量避开的接口（如本次请求已经失败过的接口）
+        """
+        for candidates in ([e for e in self.endpoints if e not in exclude], list(self.endpoints)):
+            while candidates:
+                available = [e for e in candidates if e.weight > 0 and e.breaker.available()]
+                if not available:
+                    break
+                endpoint = random.choices(available, weights=[e.weight for e in available])[0]
+                if endpoint.breaker.allow():
+                    return endpoint
+                candidates.remove(endpoint)  # 试探名额刚被其他请求占用
+        return min(self.endpoints, key=lambda e: e.breaker.opened_at)
+
+    def hedge_delay(self, endpoint: Endpoint, kind: str) -> Optional[float]:
+        """首选接口的对冲时限，未开启对冲、只有一个接口或样本不足时返回None"""
+        if not self.hedge or len(self.endpoints) < 2:
+            return None
+        delay = endpoint.latency_quantile(kind, self.hedge_quantile, self.hedge_min_samples)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    async def hedged(self, attempt: Callable[[Endpoint], Awaitable[Any]], endpoint: Endpoint, kind: str,
+                     exclude: Sequence[Endpoint] = (),
+                     discard: Callable[[Any], Any] = None) -> Tuple[Any, Endpoint]:
+        """在接口上执行一次请求，超过对冲时限仍未完成时在另一个接口上同时执行，取先成功的结果
+
+        两个请求都失败时抛出后失败的错误。成功、失败和耗时记入各接口的统计和熔断器。
+
+        Args:
+            attempt: 以接口为参数、返回协程的函数
+            endpoint: 首选接口
+            kind: 请求类型，耗时按类型分别统计（如不同模型的完整回复耗时、流式首字耗时）
+            exclude: 选择对冲接口时尽量避开的接口
+            discard: 可选，未被采用但已成功的结果的清理函数（如关闭流式响应）
+
+        Returns:
+            tuple: (结果, 给出结果的接口)
+        """
+        tasks = {asyncio.ensure_future(self._timed(attempt, endpoint, kind)): endpoint}
+        chosen = None
+        try:
+            delay = self.hedge_delay(endpoint, kind)
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    backup = self.choose(exclude=(*exclude, endpoint))
+                    if backup is not endpoint:
+                        endpoint.hedged += 1
+                        self.logger.info(f"接口{endpoint.name}超过{delay:.2f}秒未返回，向{backup.name}发送对冲请求")
+                        tasks[asyncio.ensure_future(self._timed(attempt, backup, kind))] = backup
+                    else:
+                        backup.breaker.record_abandoned()
+
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        chosen = task
+                        winner = tasks[task]
+                        if winner is not endpoint:
+                            winner.hedge_wins += 1
+                        return task.result(), winner
+                    error = task.exception()
+            raise error
+        finally:
+            # 取消未完成的请求；两个请求几乎同时成功时，清理未被采用的结果
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if discard is not None:
+                for task in tasks:
+                    if task is not chosen and not task.cancelled() and task.exception() is None:
+                        outcome = discard(task.result())
+                        if inspect.isawaitable(outcome):
+                            await outcome
+
+    @staticmethod
+    async def _timed(attempt, endpoint: Endpoint, kind: str):
+        start = time.perf_counter()
+        try:
+            result = await attempt(endpoint)
+        except asyncio.CancelledError:
+            endpoint.breaker.record_abandoned()
+            raise
+        except Exception as e:
+            endpoint.record_failure(e)
+            raise
+        endpoint.record_success(kind, time.perf_counter() - start)
+        return result
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+
+def load_endpoints() -> List[Endpoint]:
+    """从LLM_ENDPOINTS读取接口配置，未配置时使用MODEL_URL和MODEL_KEY"""
+    default_key = os.getenv('MODEL_KEY', '')
+    config = os.getenv('LLM_ENDPOINTS', '').strip()
+    if not config:
+        url = os.getenv('MODEL_URL', 'https://api.deepseek.com/v1')
+        return [Endpoint(url, url, default_key)]
+
+    endpoints = []
+    for item in json.loads(config):
+        url = item["url"]
+        key = item["key"] if "key" in item else os.getenv(item.get("key_env", "MODEL_KEY"), default_key)
+        endpoints.append(Endpoint(item.get("name", url), url, key, item.get("model"), item.get("small_model"),
+                                  item.get("weight", 1.0)))
+    return endpoints
+
+
+_shared_pool: Optional[ProviderPool] = None
+_shared_pool_lock = threading.Lock()
+
+
+async def close_loop_clients():
+    """关闭当前事件循环中创建的所有接口客户端
+
+    短生命周期的事件循环（WSGI模式下每个请求和每个流式响应各一个）关闭前调用，
+    否则客户端的httpx连接池和已建立的连接不会释放。
+    """
+    with _shared_pool_lock:
+        pool = _shared_pool
+    if pool is None:
+        return
+    loop = asyncio.get_running_loop()
+    for endpoint in pool.endpoints:
+        await endpoint.close_client(loop)
+
+
+def get_provider_pool() -> ProviderPool:
+    """获取进程共享的LLM接口池，接口由LLM_ENDPOINTS（或MODEL_URL、MODEL_KEY）配置"""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ProviderPool(load_endpoints())
+        return _shared_pool
@@ -0,0 +1,101 @@
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Tuple
+import math
+
+
+def char_ngrams(text: str, sizes: Tuple[int, ...] = (1, 2)) -> List[str]:
+    """把文本切分为字符n-gram（中文没有空格分词，按字符切分即可检索）
+
+    Args:
+        text: 文本
+        sizes: n-gram的长度
+
+    Returns:
+        List[str]: n-gram列表
+    """
+    chars = [c for c in text.lower() if c.isalnum()]
+    grams = []
+    for n in sizes:
+        grams.extend("".join(chars[i:i + n]) for i in range(len(chars) - n + 1))
+    return grams
+
+
+class BM25Index:
+    """基于字符n-gram的增量BM25索引
+
+    文档以其在列表中的位置为ID，通过sync与只追加的列表（如World.history）保持同步，
+    只对新增的条目建索引；列表被整体替换或缩短时重建。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[int, int]] = defaultdict(dict)  # term -> {doc_id: 词频}
+        self._doc_lengths: List[int] = []
+        self._total_length = 0
+        self._source = None  # 建索引的列表本身：列表被替换后旧列表可能被回收，id会被新列表复用，不能用id判断
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def clear(self):
+        """清空索引"""
+        self._postings = defaultdict(dict)
+        self._doc_lengths = []
+        self._total_length = 0
+
+    def add(self, text: str) -> int:
+        """添加文档
+
+        Args:
+            text: 文档文本
+
+        Returns:
+            int: 文档ID
+        """
+        doc_id = len(self._doc_lengths)
+        terms = Counter(char_ngrams(text))
+        for term, freq in terms.items():
+            self._postings[term][doc_id] = freq
+        length = sum(terms.values())
+        self._doc_lengths.append(length)
+        self._total_length += length
+        return doc_id
+
+    def sync(self, documents: List[Any], text_of: Callable[[Any], str] = str):
+        """与只追加的文档列表同步，只索引新增部分
+
+        Args:
+            documents: 文档列表
+            text_of: 从条目中取出文本的函数
+        """
+        if documents is not self._source or len(documents) < len(self._doc_lengths):
+            self.clear()
+            self._source = documents
+        for document in documents[len(self._doc_lengths):]:
+            self.add(text_of(document))
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[int, float]]:
+        """检索与查询最相关的文档
+
+        Args:
+            query: 查询文本
+            top_k: 返回的文档数量
+
+        Returns:
+            List[Tuple[int, float]]: (文档ID, 分数)列表，按分数从高到低排列
+        """
+        doc_count = len(self._doc_lengths)
+        if doc_count == 0:
+            return []
+        avg_length = self._total_length / doc_count or 1
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(char_ngrams(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, freq in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * freq * (self.k1 + 1) / (freq + norm)
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
@@ -0,0 +1,178 @@
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+import threading
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, create_engine, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+from .save_log import SaveLog, MANIFEST_NAME
+from .session_store import enable_sqlite_wal
+from .logger import setup_logger
+
+DEFAULT_SAVE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'save')
+
+_metadata = MetaData()
+
+# 每个存档一行，mtime为manifest（旧版存档为json文件）的修改时间，用于判断目录中的存档是否有变化
+saves_table = Table(
+    'saves', _metadata,
+    Column('name', String(255), primary_key=True),
+    Column('story_name', String(255)),
+    Column('timestamp', String(32)),
+    Column('mtime', Float, nullable=False),
+    Column('format', Integer, nullable=False),
+)
+
+# 排序方式：time按保存时间从新到旧，name按存档名，story按剧本名（同剧本内从新到旧）
+SORT_ORDERS = {
+    "time": [saves_table.c.timestamp.desc(), saves_table.c.name],
+    "name": [saves_table.c.name],
+    "story": [saves_table.c.story_name, saves_table.c.timestamp.desc(), saves_table.c.name],
+}
+
+
+class SaveCatalog:
+    def __init__(self, save_dir: str = DEFAULT_SAVE_DIR, db_path: str = None):
+        self.logger = setup_logger('SaveCatalog')
+        """初始化存档目录索引
+
+        索引记录每个存档的名称、剧本、保存时间和文件修改时间，save_game后更新对应条目。
+        列出存档时只需对存档目录做一次stat扫描，修改时间未变的存档不再读取manifest或存档文件，
+        其他worker新增、覆盖或手动删除的存档也会在扫描时同步到索引。
+
+        Args:
+            save_dir: 存档目录
+            db_path: 索引数据库路径，默认为存档目录下的catalog.db
+        """
+        self.save_dir = save_dir
+        os.makedirs(save_dir, exist_ok=True)
+        self.db_path = db_path or os.path.join(save_dir, 'catalog.db')
+        self.engine = create_engine(f"sqlite:///{self.db_path}")
+        enable_sqlite_wal(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(CreateTable(saves_table, if_not_exists=True))
+        self.logger.info(f"存档索引: {self.db_path}")
+
+    def refresh(self, name: str):
+        """从磁盘读取单个存档的信息并更新索引，存档不存在时删除条目
+
+        Args:
+            name: 存档名称
+        """
+        entry = self._read_entry(name)
+        if entry is None:
+            self.remove(name)
+        else:
+            self._upsert(entry)
+
+    def remove(self, name: str):
+        """从索引中删除存档"""
+        with self.engine.begin() as conn:
+            conn.execute(saves_table.delete().where(saves_table.c.name == name))
+
+    def sync(self) -> int:
+        """扫描存档目录，只读取新增或修改时间变化的存档，并删除已不存在的条目
+
+        Returns:
+            int: 更新的条目数
+        """
+        on_disk = self._scan()
+        with self.engine.connect() as conn:
+            indexed = dict(conn.execute(select(saves_table.c.name, saves_table.c.mtime)).all())
+
+        changed = 0
+        for name, mtime in on_disk.items():
+            if indexed.get(name) == mtime:
+                continue
+            try:
+                self.refresh(name)
+                changed += 1
+            except Exception as e:
+                self.logger.error(f"读取存档信息失败 {name}: {e}")
+        for name in indexed.keys() - on_disk.keys():
+            self.remove(name)
+            changed += 1
+        if changed:
+            self.logger.info(f"存档索引已同步，更新{changed}条")
+        return changed
+
+    def page(self, page: int = 1, page_size: int = 20, sort: str = "time") -> Tuple[List[Dict], int]:
+        """分页获取存档列表
+
+        Args:
+            page: 页码，从1开始
+            page_size: 每页条数
+            sort: 排序方式，time、name或story
+
+        Returns:
+            tuple: (当前页的存档列表, 存档总数)
+        """
+        if sort not in SORT_ORDERS:
+            raise ValueError(f"不支持的排序方式: {sort}")
+        query = (select(saves_table.c.name, saves_table.c.story_name, saves_table.c.timestamp)
+                 .order_by(*SORT_ORDERS[sort])
+                 .limit(page_size).offset((max(page, 1) - 1) * page_size))
+        with self.engine.connect() as conn:
+            total = conn.execute(select(func.count()).select_from(saves_table)).scalar()
+            rows = [{"name": name, "story": story, "time": timestamp}
+                    for name, story, timestamp in conn.execute(query)]
+        return rows, total
+
+    def _scan(self) -> Dict[str, float]:
+        """存档目录中的存档及其修改时间"""
+        saves = {}
+        with os.scandir(self.save_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        saves[entry.name] = os.stat(os.path.join(entry.path, MANIFEST_NAME)).st_mtime
+                    elif entry.name.endswith('.json'):
+                        # 同名的新格式存档优先
+                        saves.setdefault(entry.name[:-5], entry.stat().st_mtime)
+                except FileNotFoundError:
+                    continue  # 没有manifest的目录不是存档（或尚未写完）
+        return saves
+
+    def _read_entry(self, name: str) -> Optional[dict]:
+        """读取存档的manifest（旧版存档读取整个json文件）"""
+        save_log = SaveLog(os.path.join(self.save_dir, name))
+        if save_log.exists():
+            mtime = os.stat(save_log.manifest_path).st_mtime
+            manifest = save_log.read_manifest()
+            return {"name": name, "story_name": manifest["story_name"], "timestamp": manifest["timestamp"],
+                    "mtime": mtime, "format": manifest["format"]}
+        legacy_path = os.path.join(self.save_dir, f"{name}.json")
+        if os.path.exists(legacy_path):
+            mtime = os.stat(legacy_path).st_mtime
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                save_data = json.load(f)
+            return {"name": name, "story_name": save_data["story_name"], "timestamp": save_data["timestamp"],
+                    "mtime": mtime, "format": 1}
+        return None
+
+    def _upsert(self, entry: dict):
+        values = {key: value for key, value in entry.items() if key != "name"}
+        try:
+            self._write_entry(entry["name"], values)
+        except IntegrityError:
+            # 另一个worker同时插入了该存档，重试一次即转为更新
+            self._write_entry(entry["name"], values)
+
+    def _write_entry(self, name: str, values: dict):
+        with self.engine.begin() as conn:
+            updated = conn.execute(saves_table.update().where(saves_table.c.name == name).values(**values))
+            if updated.rowcount == 0:
+                conn.execute(saves_table.insert().values(name=name, **values))
+
+
+_shared_catalog: Optional[SaveCatalog] = None
+_shared_catalog_lock = threading.Lock()
+
+
+def get_save_catalog() -> SaveCatalog:
+    """获取进程共享的存档索引，数据库路径可由SAVE_CATALOG_DB配置"""
+    global _shared_catalog
+    with _shared_catalog_lock:
+        if _shared_catalog is None:
+            _shared_catalog = SaveCatalog(DEFAULT_SAVE_DIR, os.getenv('SAVE_CATALOG_DB') or None)
+        return _shared_catalog
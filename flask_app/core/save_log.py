@@ -0,0 +1,219 @@
+from typing import Any, List, Optional
+import gzip
+import json
+import os
+import time
+
+# 存档格式版本，旧版存档是save目录下的单个{存档名}.json
+SAVE_FORMAT = 2
+
+# 增量记录超过该条数，或增量总大小超过快照大小时，重新写快照
+SNAPSHOT_MAX_RECORDS = int(os.getenv('SAVE_SNAPSHOT_RECORDS', '50'))
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _atomic_write(path: str, data: bytes):
+    """先写临时文件再原子替换，中途失败不会留下半个文件"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _shadow(value: Any) -> Any:
+    """记录已写入的状态：字典逐层复制，列表只复制元素引用"""
+    if isinstance(value, dict):
+        return {key: _shadow(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def _dropped_prefix(old: list, new: list) -> Optional[int]:
+    """判断new是否由old去掉开头若干项再追加得到（按对象身份比较）
+
+    Returns:
+        int: 去掉的项数；不是这种关系时返回None
+    """
+    for drop in range(len(old) + 1):
+        kept = len(old) - drop
+        if kept > len(new):
+            continue
+        if all(old[drop + i] is new[i] for i in range(kept)):
+            return drop
+    return None
+
+
+def _diff(old: Any, new: Any, path: List[str], ops: list) -> list:
+    """计算从已写入状态到当前状态的增量操作
+
+    列表只记录开头去掉的项数和新追加的项（对话、历史事件等只会追加，压缩时从开头移除），
+    其他值变化时整体替换。
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            if key not in old:
+                ops.append([path + [key], "set", value])
+            else:
+                _diff(old[key], value, path + [key], ops)
+        for key in old.keys() - new.keys():
+            ops.append([path + [key], "del"])
+    elif isinstance(old, list) and isinstance(new, list):
+        drop = _dropped_prefix(old, new)
+        if drop is None:
+            ops.append([path, "set", new])
+        else:
+            appended = new[len(old) - drop:]
+            if drop or appended:
+                ops.append([path, "extend", drop, appended])
+    elif old is not new and old != new:
+        ops.append([path, "set", new])
+    return ops
+
+
+def _apply(state: dict, ops: list):
+    """把增量操作应用到状态上"""
+    for op in ops:
+        path, kind = op[0], op[1]
+        parent = state
+        for key in path[:-1]:
+            parent = parent[key]
+        if kind == "set":
+            parent[path[-1]] = op[2]
+        elif kind == "del":
+            parent.pop(path[-1], None)
+        elif kind == "extend":
+            items = parent[path[-1]]
+            del items[:op[2]]
+            items.extend(op[3])
+
+
+class SaveTracker:
+    """记录某个存档最近一次写入（或读取）时的状态，用于计算下次保存的增量"""
+
+    def __init__(self, revision: int = None, state: dict = None):
+        self.revision = revision
+        self.shadow = _shadow(state) if state is not None else None
+
+
+class SaveLog:
+    def __init__(self, directory: str):
+        """分段存档
+
+        每个存档是一个目录：
+        - manifest.json：当前快照和增量日志的文件名、日志有效长度、修订号、保存时间和剧本名
+        - snapshot-{修订号}.json.gz：某次保存时的完整状态
+        - log-{修订号}.jsonl.gz：之后每次保存追加一个gzip段，内容为一行增量操作
+
+        保存时只追加本次的增量，再原子替换manifest；manifest中记录的日志长度之后的内容
+        （如写到一半中断）在读取时被忽略。增量累积到一定程度时重新写快照。
+
+        Args:
+            directory: 存档目录
+        """
+        self.directory = directory
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def read_manifest(self) -> Optional[dict]:
+        """读取manifest，不存在时返回None"""
+        if not self.exists():
+            return None
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def load(self) -> dict:
+        """读取最新快照并应用其后的增量
+
+        Returns:
+            dict: 存档状态（与System.get_save_data格式相同），修订号在manifest中
+        """
+        manifest = self.read_manifest()
+        if manifest is None:
+            raise FileNotFoundError(self.directory)
+        with open(os.path.join(self.directory, manifest["snapshot"]), 'rb') as f:
+            state = json.loads(gzip.decompress(f.read()))
+        if manifest["log_bytes"]:
+            with open(os.path.join(self.directory, manifest["log"]), 'rb') as f:
+                data = f.read(manifest["log_bytes"])
+            for line in gzip.decompress(data).decode('utf-8').splitlines():
+                if line:
+                    _apply(state, json.loads(line))
+        return state
+
+    def save(self, state: dict, tracker: SaveTracker) -> str:
+        """保存状态，能追加增量时只追加增量
+
+        Args:
+            state: 当前状态
+            tracker: 该存档的写入记录，保存后更新
+
+        Returns:
+            str: "snapshot"或"append"
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self.read_manifest()
+        if (manifest is None or manifest.get("format") != SAVE_FORMAT
+                or tracker.revision != manifest["revision"] or tracker.shadow is None
+                or manifest["log_records"] >= SNAPSHOT_MAX_RECORDS
+                or manifest["log_bytes"] > manifest["snapshot_bytes"]):
+            # 存档被其他会话写过、增量过多或第一次保存，写完整快照
+            self._write_snapshot(state, manifest)
+            kind = "snapshot"
+        else:
+            self._append(state, tracker, manifest)
+            kind = "append"
+        tracker.revision = self.read_manifest()["revision"]
+        tracker.shadow = _shadow(state)
+        return kind
+
+    def _write_snapshot(self, state: dict, manifest: Optional[dict]):
+        revision = (manifest["revision"] if manifest else 0) + 1
+        snapshot_name = f"snapshot-{revision:06d}.json.gz"
+        log_name = f"log-{revision:06d}.jsonl.gz"
+        data = gzip.compress(json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        _atomic_write(os.path.join(self.directory, snapshot_name), data)
+        _atomic_write(os.path.join(self.directory, log_name), b"")
+        self._write_manifest({
+            "format": SAVE_FORMAT,
+            "revision": revision,
+            "snapshot": snapshot_name,
+            "snapshot_bytes": len(data),
+            "log": log_name,
+            "log_bytes": 0,
+            "log_records": 0,
+        }, state)
+        # manifest切换后再删除旧文件
+        for name in os.listdir(self.directory):
+            if name.startswith(("snapshot-", "log-")) and name not in (snapshot_name, log_name):
+                os.remove(os.path.join(self.directory, name))
+
+    def _append(self, state: dict, tracker: SaveTracker, manifest: dict):
+        ops = _diff(tracker.shadow, state, [], [])
+        record = gzip.compress((json.dumps(ops, ensure_ascii=False, separators=(',', ':')) + "\n").encode('utf-8'))
+        with open(os.path.join(self.directory, manifest["log"]), 'r+b') as f:
+            # 丢弃上次写到一半的内容
+            f.truncate(manifest["log_bytes"])
+            f.seek(manifest["log_bytes"])
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        manifest.update({
+            "revision": manifest["revision"] + 1,
+            "log_bytes": manifest["log_bytes"] + len(record),
+            "log_records": manifest["log_records"] + 1,
+        })
+        self._write_manifest(manifest, state)
+
+    def _write_manifest(self, manifest: dict, state: dict):
+        manifest["timestamp"] = state.get("timestamp", time.strftime("%Y-%m-%d %H:%M:%S"))
+        manifest["story_name"] = state.get("story_name")
+        _atomic_write(self.manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
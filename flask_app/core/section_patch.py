@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from typing import Dict, Optional
+import re
+from .llm_service import LLMService
+
+# 分块标题行，如 [属性]、[技能]（[[...]]为剧本文件的顶层键，不在此处匹配）
+_SECTION_HEADER = re.compile(r'^\[([^\[\]]+)\]\s*$')
+
+# 第一个分块之前的内容（名字、年龄等）在提示中使用的分块名
+PREAMBLE_SECTION = "基本信息"
+
+NO_CHANGE = "无变化"
+
+
+def split_sections(text: str) -> "OrderedDict[str, str]":
+    """把档案文本按[分块]拆分
+
+    Args:
+        text: 档案文本
+
+    Returns:
+        OrderedDict[str, str]: 分块名到内容的映射，第一个分块之前的内容对应空字符串
+    """
+    sections = OrderedDict()
+    name = ""
+    sections[name] = ""
+    for line in text.splitlines(keepends=True):
+        match = _SECTION_HEADER.match(line.strip())
+        if match:
+            name = match.group(1).strip()
+            sections[name] = ""
+        else:
+            sections[name] = sections.get(name, "") + line
+    return sections
+
+
+def join_sections(sections: Dict[str, str]) -> str:
+    """把分块重新拼接为档案文本，是split_sections的逆操作"""
+    parts = []
+    for name, body in sections.items():
+        if name == "":
+            parts.append(body)
+        else:
+            parts.append(f"[{name}]\n{body}")
+    return "".join(parts)
+
+
+def parse_patch(response: str) -> Optional["OrderedDict[str, str]"]:
+    """解析模型返回的分块补丁
+
+    Args:
+        response: 模型回复
+
+    Returns:
+        OrderedDict[str, str]: 需要替换的分块；无需修改时为空；格式不合法时返回None
+    """
+    response = response.replace("#", "").replace("---", "").strip()
+    if response == NO_CHANGE or response == "":
+        return OrderedDict()
+    patch = split_sections(response)
+    # 第一个分块之前最多允许一行说明文字，更多内容说明模型没有按格式返回
+    if len([line for line in patch.pop("").splitlines() if line.strip()]) > 1:
+        return None
+    if not patch:
+        return None
+    for name, body in patch.items():
+        if not body.strip():
+            return None
+    return patch
+
+
+def apply_patch(text: str, patch: Dict[str, str]) -> str:
+    """把分块补丁应用到档案文本，未涉及的分块保持原样
+
+    Args:
+        text: 原档案文本
+        patch: 需要替换或新增的分块
+
+    Returns:
+        str: 更新后的档案文本
+    """
+    sections = split_sections(text)
+    for name, body in patch.items():
+        if name == PREAMBLE_SECTION and name not in sections:
+            name = ""
+        sections[name] = body.strip("\n") + "\n\n"
+    return join_sections(sections)
+
+
+def render_for_prompt(text: str) -> str:
+    """渲染为带分块标题的文本，让模型可以引用第一个分块之前的内容"""
+    sections = split_sections(text)
+    parts = []
+    for name, body in sections.items():
+        if name == "":
+            if not body.strip():
+                continue
+            name = PREAMBLE_SECTION
+        parts.append(f"[{name}]\n{body.strip()}\n")
+    return "\n".join(parts)
+
+
+async def patch_document(llm_service: LLMService, text: str, changes: str, document_name: str) -> Optional[str]:
+    """让模型只输出受影响的分块，并在本地应用补丁
+
+    Args:
+        llm_service: LLM服务实例
+        text: 当前档案文本
+        changes: 变更描述
+        document_name: 档案名称，如"角色档案"、"世界背景"
+
+    Returns:
+        str: 更新后的档案文本；模型回复格式不合法时返回None，由调用方回退到完整重写
+    """
+    prompt = f"""
+下面是当前的{document_name}，按[分块名]分块组织：
+---
+
+{render_for_prompt(text)}
+
+---
+
+下面是需要变更的内容：
+---
+
+{changes}
+
+---
+
+请根据上述变更信息，只输出需要修改的分块。注意：
+1. 每个分块以单独一行的[分块名]开头，后面是该分块修改后的完整内容。
+2. 不需要修改的分块不要输出。如需新增内容且不属于已有分块，可以使用新的分块名。
+3. 最小化根据变更要求，最小化的修改状态，不要修改任何与变更无关的内容，不用记录更新历史。
+4. 如果不需要任何修改，只返回：{NO_CHANGE}
+
+只返回修改后的分块："""
+
+    response = await llm_service.generate_response(prompt)
+    patch = parse_patch(response)
+    if patch is None:
+        return None
+    return apply_patch(text, patch)
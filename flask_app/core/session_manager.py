@@ -0,0 +1,213 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from .system import System
+from .session_store import SessionConflict, SessionStore
+from .logger import setup_logger
+
+# 会话ID只允许字母、数字、下划线和短横线，防止被拼接成任意文件路径
+_SESSION_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{1,64}$')
+
+
+class SessionManager:
+    def __init__(self, max_sessions: int = None, store: SessionStore = None):
+        self.logger = setup_logger('SessionManager')
+        """初始化会话管理器
+
+        会话状态保存在各worker共享的SessionStore中，每个worker在内存中按LRU缓存热会话：
+        读取时比较版本号，其他worker更新过的会话会重新加载（read-through）；
+        每条命令处理完后由会话的后台任务队列写回（write-behind），不占用请求的响应时间。
+
+        Args:
+            max_sessions: 内存中最多保留的会话数量，超过后按LRU换出
+            store: 会话状态存储，默认按环境变量创建
+        """
+        self.max_sessions = max_sessions or int(os.getenv('MAX_SESSIONS', '100'))
+        self.store = store or SessionStore()
+        self._sessions: "OrderedDict[str, System]" = OrderedDict()
+        self._versions: Dict[str, Optional[int]] = {}  # 内存中的会话基于的存储版本
+        self._digests: Dict[str, str] = {}  # 最近一次写入的状态摘要，状态未变化时跳过写入
+        self._lock = threading.Lock()
+        self.logger.info(f"初始化会话管理器，内存会话上限: {self.max_sessions}")
+
+    @staticmethod
+    def new_session_id() -> str:
+        """生成新的会话ID"""
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def is_valid_session_id(session_id: Optional[str]) -> bool:
+        """检查会话ID是否合法"""
+        return bool(session_id) and bool(_SESSION_ID_PATTERN.match(session_id))
+
+    def get(self, session_id: str) -> System:
+        """获取会话对应的系统实例，不在内存中或已被其他worker更新时从存储加载，都没有时新建
+
+        会读写存储并等待后台任务，需在线程中调用，不要直接在事件循环中调用。
+
+        Args:
+            session_id: 会话ID
+
+        Returns:
+            System: 会话的系统实例
+        """
+        if not self.is_valid_session_id(session_id):
+            raise ValueError(f"非法的会话ID: {session_id}")
+
+        with self._lock:
+            cached = self._sessions.get(session_id)
+        if cached is not None:
+            cached.jobs.wait()  # 等待本worker尚未完成的写回，避免把自己的写入当成其他worker的更新
+        version = self.store.version(session_id)
+
+        with self._lock:
+            system = self._sessions.get(session_id)
+            if system is not None and (version is None or version == self._versions.get(session_id)):
+                self._sessions.move_to_end(session_id)
+                return system
+
+        if system is not None:
+            self.logger.info(f"会话已被其他worker更新，重新加载: {session_id}")
+        restored = self._restore(session_id)
+        with self._lock:
+            if restored is None:
+                self.logger.info(f"创建新会话: {session_id}")
+                system, version, digest = System(), None, None
+            else:
+                system, version, digest = restored
+            self._sessions[session_id] = system
+            self._sessions.move_to_end(session_id)
+            self._versions[session_id] = version
+            self._digests[session_id] = digest
+            evicted = self._pop_overflow()
+
+        # 换出的会话在锁外写入，避免阻塞其他会话
+        for evicted_id, evicted_system in evicted:
+            self._persist(evicted_id, evicted_system)
+        return system
+
+    def persist_later(self, session_id: str):
+        """命令处理完后写回会话状态，作为后台任务排在该会话的状态更新之后执行
+
+        Args:
+            session_id: 会话ID
+        """
+        with self._lock:
+            system = self._sessions.get(session_id)
+        if system is None:
+            return
+        system.jobs.submit(lambda: asyncio.to_thread(self._write, session_id, system), "保存会话状态")
+
+    def drop(self, session_id: str):
+        """丢弃会话（内存和存储）
+
+        Args:
+            session_id: 会话ID
+        """
+        with self._lock:
+            system = self._sessions.pop(session_id, None)
+            self._versions.pop(session_id, None)
+            self._digests.pop(session_id, None)
+        if system is not None:
+            system.speculation.cancel()
+        self.store.delete(session_id)
+
+    def flush(self):
+        """将所有内存中的会话写入存储，进程退出前调用"""
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for session_id, system in sessions:
+            self._persist(session_id, system)
+        self.logger.info(f"已保存{len(sessions)}个会话")
+
+    def stats(self) -> Dict[str, int]:
+        """获取会话统计信息"""
+        with self._lock:
+            hot = len(self._sessions)
+        return {"hot_sessions": hot, "stored_sessions": self.store.count(), "max_sessions": self.max_sessions}
+
+    def _pop_overflow(self) -> List[Tuple[str, System]]:
+        """弹出超过上限的最久未使用会话，调用方需持有锁"""
+        evicted = []
+        while len(self._sessions) > self.max_sessions:
+            evicted.append(self._sessions.popitem(last=False))
+        return evicted
+
+    def _persist(self, session_id: str, system: System):
+        """等待会话的后台任务完成后写入存储"""
+        system.speculation.cancel()  # 换出或退出后不会再用到预生成的结果
+        try:
+            system.jobs.wait()  # 等待后台任务完成，保证写入的是最新状态
+            self._write(session_id, system)
+        except Exception as e:
+            self.logger.error(f"保存会话失败 {session_id}: {e}")
+        finally:
+            with self._lock:
+                if session_id not in self._sessions:
+                    self._versions.pop(session_id, None)
+                    self._digests.pop(session_id, None)
+
+    def _write(self, session_id: str, system: System):
+        """序列化会话状态并写入存储，状态未变化时跳过"""
+        state = json.dumps(system.get_save_data(), ensure_ascii=False)
+        digest = self._digest(system.started, state)
+        with self._lock:
+            if self._digests.get(session_id) == digest:
+                return
+            base_version = self._versions.get(session_id)
+        try:
+            version = self.store.save(session_id, system.started, system.current_story, state, base_version)
+        except SessionConflict as e:
+            self._discard_conflicting(session_id, system, e)
+            return
+        with self._lock:
+            self._versions[session_id] = version
+            self._digests[session_id] = digest
+        self.logger.debug(f"会话已写入存储: {session_id}，版本: {version}")
+
+    def _discard_conflicting(self, session_id: str, system: System, conflict: SessionConflict):
+        """写入冲突时以库中（先写入的worker）的状态为准：丢弃本worker内存中的会话，下次访问时重新加载"""
+        with self._lock:
+            if self._sessions.get(session_id) is system:
+                del self._sessions[session_id]
+            if session_id not in self._sessions:
+                self._versions.pop(session_id, None)
+                self._digests.pop(session_id, None)
+        system.speculation.cancel()
+        self.logger.warning(f"{conflict}，放弃本worker的修改，下次访问时重新加载")
+
+    def _restore(self, session_id: str) -> Optional[Tuple[System, Optional[int], Optional[str]]]:
+        """从存储加载会话，不存在或损坏时返回None
+
+        Returns:
+            tuple: (系统实例, 存储版本, 状态摘要)
+        """
+        try:
+            row = self.store.load(session_id)
+            if row is None:
+                return None
+            version, started, state = row
+            system = self._build_system(json.loads(state), started)
+            digest = self._digest(started, state)
+            self.logger.info(f"从存储加载会话: {session_id}，版本: {version}")
+            return system, version, digest
+        except Exception as e:
+            self.logger.error(f"恢复会话失败 {session_id}: {e}")
+            return None
+
+    @staticmethod
+    def _digest(started: bool, state: str) -> str:
+        return hashlib.sha1(f"{bool(started)}:{state}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _build_system(save_data: dict, started: bool) -> System:
+        system = System(save_data["story_name"])
+        system.load_save_data(save_data)
+        system.started = started
+        return system
@@ -0,0 +1,140 @@
+from typing import Optional, Tuple
+import os
+import time
+from sqlalchemy import (Boolean, Column, Float, Integer, MetaData, String, Table, Text, create_engine, event,
+                        func, select)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+from .logger import setup_logger
+
+_metadata = MetaData()
+
+# 每个会话一行，version在每次写入时加一，各worker据此判断缓存的会话是否已被其他worker更新
+sessions_table = Table(
+    'sessions', _metadata,
+    Column('session_id', String(64), primary_key=True),
+    Column('version', Integer, nullable=False),
+    Column('started', Boolean, nullable=False, default=False),
+    Column('story_name', String(255)),
+    Column('state', Text, nullable=False),
+    Column('updated_at', Float, nullable=False),
+)
+
+
+class SessionConflict(Exception):
+    """写入时会话已被其他worker更新（版本号与本worker读到的不一致）"""
+
+    def __init__(self, session_id: str, base_version: Optional[int], current_version: Optional[int]):
+        super().__init__(f"会话{session_id}已被其他worker更新（{base_version} -> {current_version}）")
+        self.session_id = session_id
+        self.base_version = base_version
+        self.current_version = current_version
+
+
+def enable_sqlite_wal(engine):
+    """SQLite连接使用WAL模式，多个worker读写互不阻塞，写入冲突时等待而不是直接报错"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    def configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    event.listen(engine, 'connect', configure)
+
+
+def _default_url() -> str:
+    path = os.getenv('SESSION_DB', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'sessions', 'sessions.db'))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return f"sqlite:///{path}"
+
+
+class SessionStore:
+    def __init__(self, url: str = None):
+        self.logger = setup_logger('SessionStore')
+        """初始化会话状态存储
+
+        多个worker进程共享同一个数据库，本地默认使用SQLite（WAL模式，读写互不阻塞）。
+        也可以通过SESSION_DB_URL指定其他SQLAlchemy支持的数据库，以便跨机器扩展worker。
+
+        Args:
+            url: SQLAlchemy数据库URL，默认读取SESSION_DB_URL，未设置时使用SESSION_DB指定的SQLite文件
+        """
+        self.url = url or os.getenv('SESSION_DB_URL') or _default_url()
+        self.engine = create_engine(self.url)
+        enable_sqlite_wal(self.engine)
+        # 多个worker同时启动时create_all的检查和建表之间存在竞争，直接使用IF NOT EXISTS
+        with self.engine.begin() as conn:
+            conn.execute(CreateTable(sessions_table, if_not_exists=True))
+        self.logger.info(f"会话存储: {self.engine.url.render_as_string(hide_password=True)}")
+
+    def version(self, session_id: str) -> Optional[int]:
+        """获取会话的版本号，不存在时返回None"""
+        with self.engine.connect() as conn:
+            return conn.execute(select(sessions_table.c.version)
+                                .where(sessions_table.c.session_id == session_id)).scalar()
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bool, str]]:
+        """读取会话
+
+        Returns:
+            tuple: (版本号, 是否已开始游戏, 状态JSON)，不存在时返回None
+        """
+        with self.engine.connect() as conn:
+            row = conn.execute(select(sessions_table.c.version, sessions_table.c.started, sessions_table.c.state)
+                               .where(sessions_table.c.session_id == session_id)).first()
+        return tuple(row) if row else None
+
+    def save(self, session_id: str, started: bool, story_name: str, state: str, base_version: Optional[int]) -> int:
+        """写入会话，版本号加一
+
+        只有库中的版本仍是base_version时才写入（比较和加一在同一条UPDATE中完成），
+        否则说明其他worker在此期间也修改了该会话，抛出SessionConflict，不覆盖对方的写入。
+
+        Args:
+            session_id: 会话ID
+            started: 是否已开始游戏
+            story_name: 剧本名称
+            state: 状态JSON（System.get_save_data的序列化结果）
+            base_version: 本worker读到的版本号，为None表示新会话
+
+        Returns:
+            int: 写入后的版本号
+
+        Raises:
+            SessionConflict: 库中的版本与base_version不一致
+        """
+        values = {"started": started, "story_name": story_name, "state": state, "updated_at": time.time()}
+        with self.engine.begin() as conn:
+            if base_version is not None:
+                updated = conn.execute(sessions_table.update()
+                                       .where(sessions_table.c.session_id == session_id)
+                                       .where(sessions_table.c.version == base_version)
+                                       .values(version=sessions_table.c.version + 1, **values)).rowcount
+                if updated:
+                    return base_version + 1
+                current = conn.execute(select(sessions_table.c.version)
+                                       .where(sessions_table.c.session_id == session_id)).scalar()
+                if current is not None:
+                    raise SessionConflict(session_id, base_version, current)
+                # 会话已被删除（如其他worker执行了重置），作为新会话重新写入
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(sessions_table.insert().values(session_id=session_id, version=1, **values))
+            return 1
+        except IntegrityError:
+            # 另一个worker同时插入了该会话
+            raise SessionConflict(session_id, base_version, self.version(session_id))
+
+    def delete(self, session_id: str):
+        """删除会话"""
+        with self.engine.begin() as conn:
+            conn.execute(sessions_table.delete().where(sessions_table.c.session_id == session_id))
+
+    def count(self) -> int:
+        """已存储的会话数量"""
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(sessions_table)).scalar()
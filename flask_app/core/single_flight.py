@@ -0,0 +1,216 @@
+"""合并相同的并发调用（single-flight）
+
+同一个键同时只有一个调用真正执行，其余调用等待并共享它的结果；流式调用的每个订阅者都从头
+收到完整的chunk序列。请求、流式转发和后台任务分别运行在不同的事件循环中，因此结果通过
+concurrent.futures.Future跨事件循环传递。
+"""
+from concurrent.futures import Future
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+import asyncio
+import threading
+from .logger import setup_logger
+from .tracing import Span
+
+
+class FlightAbandoned(Exception):
+    """共享的流式调用在输出过程中被取消（发起者的事件循环已关闭），已输出部分内容的订阅者无法透明重试"""
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+async def _wait(future: Future):
+    """在当前事件循环中等待跨事件循环的Future完成，取消等待不会取消Future本身"""
+    if future.done():
+        return
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def wake(_):
+        try:
+            loop.call_soon_threadsafe(_wake, waiter)
+        except RuntimeError:
+            pass  # 等待者所在的事件循环已经关闭
+
+    future.add_done_callback(wake)
+    await waiter
+
+
+class _Flight:
+    def __init__(self, key: str, loop: asyncio.AbstractEventLoop):
+        self.key = key
+        self.loop = loop  # 执行调用的事件循环
+        self.head = Future()  # 调用结果；流式调用时为第一个节点，结果为(chunk, 下一个节点)或None（结束）
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class SingleFlight:
+    def __init__(self, name: str = 'single_flight'):
+        self.logger = setup_logger('SingleFlight')
+        """初始化调用合并器
+
+        第一个调用者（leader）在自己的事件循环中以独立任务执行调用，之后到达的相同调用（follower）
+        只订阅结果。所有订阅者都离开（如客户端全部断开）时才取消调用；只有部分订阅者离开时调用继续，
+        其余订阅者不受影响。调用被取消而仍有订阅者时，尚未收到内容的订阅者重新发起调用。
+
+        Args:
+            name: 名称，用于日志
+        """
+        self.name = name
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        # 统计信息
+        self.leaders = 0  # 实际执行的调用数
+        self.followers = 0  # 被合并的调用数
+        self.abandoned = 0  # 仍有订阅者时被取消的调用数
+
+    async def call(self, key: str, factory: Callable[[], Awaitable[Any]], span: Span = None) -> Any:
+        """执行调用，相同键的调用正在进行时共享其结果
+
+        Args:
+            key: 调用的键，结果只取决于键
+            factory: 返回协程的无参函数，只在本调用实际执行时调用
+            span: 可选，记录本调用是否被合并
+
+        Returns:
+            调用结果，调用失败时抛出同一个错误
+        """
+        while True:
+            flight = self._join(key, lambda f: self._run(f, factory), span)
+            try:
+                await _wait(flight.head)
+            finally:
+                await self._leave(flight)
+            if not flight.head.cancelled():
+                return flight.head.result()
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]], span: Span = None) -> AsyncIterator[Any]:
+        """执行流式调用，相同键的调用正在进行时订阅其输出
+
+        Args:
+            key: 调用的键
+            factory: 返回异步生成器的无参函数，只在本调用实际执行时调用
+            span: 可选，记录本调用是否被合并
+
+        Yields:
+            调用输出的每个chunk，从第一个开始
+        """
+        while True:
+            flight = self._join(key, lambda f: self._pump(f, factory), span)
+            node = flight.head
+            emitted = False
+            try:
+                while True:
+                    await _wait(node)
+                    if node.cancelled():
+                        break
+                    item = node.result()
+                    if item is None:
+                        return
+                    chunk, node = item
+                    emitted = True
+                    yield chunk
+            finally:
+                await self._leave(flight)
+            if emitted:
+                raise FlightAbandoned(f"共享的流式调用已被取消: {key[:12]}")
+
+    def _join(self, key: str, execute: Callable[[_Flight], Awaitable[None]], span: Optional[Span]) -> _Flight:
+        """订阅相同键正在进行的调用，没有时创建并开始执行"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight(key, asyncio.get_running_loop())
+                flight.task = flight.loop.create_task(execute(flight))
+                self._flights[key] = flight
+                self.leaders += 1
+            else:
+                self.followers += 1
+            flight.subscribers += 1
+        if span is not None:
+            span.set(coalesced=not leader)
+        if not leader:
+            self.logger.debug(f"[{self.name}] 合并相同的调用: {key[:12]}，订阅者: {flight.subscribers}")
+        return flight
+
+    async def _leave(self, flight: _Flight):
+        """取消订阅，最后一个订阅者离开时取消尚未完成的调用
+
+        调用在当前事件循环中执行时等待其结束，保证离开后上游连接已经关闭。
+        """
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0 or flight.task.done():
+                return
+        if asyncio.get_running_loop() is flight.loop:
+            flight.task.cancel()
+            await asyncio.wait({flight.task})
+            return
+        try:
+            flight.loop.call_soon_threadsafe(flight.task.cancel)
+        except RuntimeError:
+            pass  # 事件循环已经关闭，任务已随之结束
+
+    def _finish(self, flight: _Flight) -> bool:
+        """调用结束，之后到达的相同调用重新执行。返回是否仍有订阅者"""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            abandoned = flight.subscribers > 0
+        return abandoned
+
+    async def _run(self, flight: _Flight, factory: Callable[[], Awaitable[Any]]):
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            self._abandon(flight, flight.head)
+            raise
+        except Exception as e:
+            self._finish(flight)
+            flight.head.set_exception(e)
+            return
+        self._finish(flight)
+        flight.head.set_result(result)
+
+    async def _pump(self, flight: _Flight, factory: Callable[[], AsyncIterator[Any]]):
+        node = flight.head
+        try:
+            async with aclosing(factory()) as chunks:
+                async for chunk in chunks:
+                    next_node = Future()
+                    node.set_result((chunk, next_node))
+                    node = next_node
+        except asyncio.CancelledError:
+            self._abandon(flight, node)
+            raise
+        except Exception as e:
+            self._finish(flight)
+            node.set_exception(e)
+            return
+        self._finish(flight)
+        node.set_result(None)
+
+    def _abandon(self, flight: _Flight, node: Future):
+        # 先移除再通知，重试的订阅者会发起新的调用而不是订阅已取消的调用
+        if self._finish(flight):
+            with self._lock:
+                self.abandoned += 1
+            self.logger.warning(f"[{self.name}] 调用在仍有订阅者时被取消: {flight.key[:12]}")
+        node.cancel()
+
+    def stats(self) -> Dict[str, float]:
+        """获取统计信息"""
+        with self._lock:
+            total = self.leaders + self.followers
+            return {
+                "in_flight": len(self._flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "abandoned": self.abandoned,
+                "coalesce_rate": round(self.followers / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,161 @@
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+import itertools
+import operator
+import os
+import time
+
+# /undo可以回退的步数
+UNDO_DEPTH = int(os.getenv('UNDO_DEPTH', '20'))
+# 每个会话最多保留的分支数量，超过后删除最早创建的分支
+MAX_BRANCHES = int(os.getenv('MAX_BRANCHES', '20'))
+# 冻结列表最多由多少块组成，超过后合并为一块
+_MAX_CHUNKS = 16
+
+# 快照中的列表字段，以元组块保存
+_LIST_FIELDS = ("dialogue_history", "dialogue_summaries", "qu_history", "world_history")
+
+
+def freeze_list(items: list, previous: Tuple[tuple, ...] = None) -> Tuple[tuple, ...]:
+    """把列表冻结为若干元组块
+
+    列表只在末尾追加时，直接复用上一个快照的块，只为新追加的项建一个新块，
+    因此连续的快照共享同一份历史记录，每次快照的开销与新增项数成正比。
+
+    Args:
+        items: 要冻结的列表，其中的元素视为不可变（字符串或追加后不再修改的字典）
+        previous: 上一个快照中同一字段的块
+
+    Returns:
+        tuple: 元组块
+    """
+    if previous:
+        shared = sum(len(chunk) for chunk in previous)
+        if len(items) >= shared and all(map(operator.is_, itertools.chain.from_iterable(previous), items)):
+            if len(items) == shared:
+                return previous
+            if len(previous) < _MAX_CHUNKS:
+                return previous + (tuple(items[shared:]),)
+    return (tuple(items),) if items else ()
+
+
+def thaw_list(chunks: Tuple[tuple, ...]) -> list:
+    """把元组块还原为新的列表，元素本身不复制"""
+    return list(itertools.chain.from_iterable(chunks))
+
+
+class GameSnapshot:
+    def __init__(self, system, label: str = "", previous: "GameSnapshot" = None):
+        """记录System某一时刻的状态，创建后不再修改
+
+        字符串（世界背景、角色档案等）本身不可变，直接共享引用；历史列表冻结为元组块，
+        与上一个快照共享未变化的部分。恢复时原地更新World和Character，不重新读取剧本文件。
+
+        Args:
+            system: 系统实例
+            label: 快照说明，如触发快照的命令
+            previous: 上一个快照，用于共享历史列表
+        """
+        self.label = label
+        self.created_at = time.time()
+        world, character = system.world, system.character
+        lists = {
+            "dialogue_history": system.dialogue_history,
+            "dialogue_summaries": system.dialogue_summaries,
+            "qu_history": system.qu_history,
+            "world_history": world.history,
+        }
+        self.values = {
+            "story_name": system.current_story,
+            "started": system.started,
+            "energy": system.energy,
+            "archive_id": system.archive_id,
+            "world_background": world.background,
+            "story_readme": world.story_readme,
+            "current_time": world.current_time,
+            "profile": character.profile,
+            "thoughts": character.thoughts,
+            "hidden_profile": character.hidden_profile,
+        }
+        for field, items in lists.items():
+            self.values[field] = freeze_list(items, previous.values[field] if previous else None)
+
+    def same_state(self, other: Optional["GameSnapshot"]) -> bool:
+        """与另一个快照的状态是否相同（共享的块按引用比较，开销很小）"""
+        return other is not None and self.values == other.values
+
+    def restore(self, system):
+        """把快照中的状态恢复到系统实例"""
+        values = self.values
+        system.current_story = values["story_name"]
+        system.started = values["started"]
+        system.energy = values["energy"]
+        system.archive_id = values["archive_id"]
+        system.dialogue_history = thaw_list(values["dialogue_history"])
+        system.dialogue_summaries = thaw_list(values["dialogue_summaries"])
+        system.qu_history = thaw_list(values["qu_history"])
+
+        world, character = system.world, system.character
+        world.background = values["world_background"]
+        world.story_readme = values["story_readme"]
+        world.current_time = values["current_time"]
+        world.history = thaw_list(values["world_history"])  # 新列表，检索索引查询时自动重建
+        character.profile = values["profile"]
+        character.thoughts = values["thoughts"]
+        character.hidden_profile = values["hidden_profile"]
+
+    def describe(self) -> str:
+        return f"{time.strftime('%H:%M:%S', time.localtime(self.created_at))} {self.label}".strip()
+
+
+class SnapshotHistory:
+    def __init__(self, depth: int = UNDO_DEPTH, max_branches: int = MAX_BRANCHES):
+        """单个会话的内存快照：撤销栈、命名分支和最近保存的存档状态
+
+        快照只保存在当前worker的内存中，会话被换出或由其他worker重新加载后清空。
+
+        Args:
+            depth: 撤销栈深度
+            max_branches: 最多保留的分支数量
+        """
+        self.undo_stack: "deque[GameSnapshot]" = deque(maxlen=depth)
+        self.branches: "OrderedDict[str, GameSnapshot]" = OrderedDict()
+        self.saved: Dict[str, Tuple[int, GameSnapshot]] = {}  # 存档名 -> (存档修订号, 保存时的状态)
+        self.max_branches = max_branches
+        self._latest: Optional[GameSnapshot] = None  # 最近创建的快照，新快照与它共享历史列表
+
+    def capture(self, system, label: str = "") -> GameSnapshot:
+        """创建当前状态的快照"""
+        self._latest = GameSnapshot(system, label, self._latest)
+        return self._latest
+
+    def checkpoint(self, system, label: str) -> GameSnapshot:
+        """执行会修改状态的命令前记录撤销点，状态与上一个撤销点相同时不重复记录
+
+        Returns:
+            GameSnapshot: 命令执行前的状态
+        """
+        snapshot = self.capture(system, label)
+        if not (self.undo_stack and snapshot.same_state(self.undo_stack[-1])):
+            self.undo_stack.append(snapshot)
+        return snapshot
+
+    def rollback(self, system, snapshot: GameSnapshot):
+        """放弃没有执行完的命令：恢复到命令执行前的状态，并移除该命令记录的撤销点"""
+        snapshot.restore(system)
+        if self.undo_stack and self.undo_stack[-1] is snapshot:
+            self.undo_stack.pop()
+
+    def pop_undo(self) -> Optional[GameSnapshot]:
+        """取出最近的撤销点，没有时返回None"""
+        return self.undo_stack.pop() if self.undo_stack else None
+
+    def add_branch(self, name: str, snapshot: GameSnapshot):
+        """保存命名分支，同名分支被覆盖"""
+        self.branches.pop(name, None)
+        self.branches[name] = snapshot
+        while len(self.branches) > self.max_branches:
+            self.branches.popitem(last=False)
+
+    def list_branches(self) -> List[Tuple[str, GameSnapshot]]:
+        return list(self.branches.items())
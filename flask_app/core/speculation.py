@@ -0,0 +1,238 @@
+"""推测执行：玩家阅读上一条结果时，提前生成下一条/st或/des的输出
+
+预生成的结果带有生成时的状态版本和提示，只有状态未变化且提示完全相同时才直接返回，否则丢弃。
+默认关闭，通过SPECULATION环境变量开启（如"st,des"）。
+"""
+from collections import defaultdict
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncio
+import os
+import threading
+import time
+from .job_queue import get_background_loop
+from .logger import setup_logger
+from .tracing import current_span, tracer
+
+# 开启推测执行的命令：st（默认时长的/st）、des（/des），逗号分隔，为空时关闭
+SPECULATION_KINDS = frozenset(kind.strip() for kind in os.getenv('SPECULATION', '').split(',') if kind.strip())
+# 预生成结果的有效期（秒），玩家超过该时间未使用则丢弃
+SPECULATION_TTL = float(os.getenv('SPECULATION_TTL', '600'))
+# 同一命令连续浪费（被丢弃、过期或取消）多少次后暂停该会话对该命令的推测执行
+SPECULATION_MAX_MISSES = int(os.getenv('SPECULATION_MAX_MISSES', '3'))
+# 暂停的时长（秒）
+SPECULATION_COOLDOWN = float(os.getenv('SPECULATION_COOLDOWN', '600'))
+# 整个进程同时进行的推测执行数量上限，达到上限时跳过，不排队
+SPECULATION_MAX_INFLIGHT = int(os.getenv('SPECULATION_MAX_INFLIGHT', '4'))
+
+
+class SpeculativeResult:
+    def __init__(self, version: str, prompt: str, value: Any):
+        """一次预生成的结果
+
+        Args:
+            version: 生成时的状态版本
+            prompt: 生成使用的提示
+            value: 生成结果
+        """
+        self.version = version
+        self.prompt = prompt
+        self.value = value
+        self.created_at = time.monotonic()
+
+
+class SpeculationStats:
+    """推测执行的统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = defaultdict(int)  # 结果 -> 次数
+        self.in_flight = 0
+
+    def record(self, result: str):
+        with self._lock:
+            self._counts[result] += 1
+
+    def try_acquire(self, limit: int) -> bool:
+        """占用一个并发名额，已达上限时返回False"""
+        with self._lock:
+            if self.in_flight >= limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """各结果的次数、当前进行中的数量和命中率（命中 / 已结束的预生成）"""
+        with self._lock:
+            counts = dict(self._counts)
+            in_flight = self.in_flight
+        used = counts.get("hit", 0) + sum(counts.get(result, 0) for result in ("stale", "expired", "cancelled"))
+        return {"counts": counts, "in_flight": in_flight,
+                "hit_rate": round(counts.get("hit", 0) / used, 3) if used else 0.0}
+
+
+speculation_stats = SpeculationStats()
+
+
+class Speculator:
+    def __init__(self, name: str = 'session', kinds=SPECULATION_KINDS, ttl: float = SPECULATION_TTL,
+                 max_misses: int = SPECULATION_MAX_MISSES, cooldown: float = SPECULATION_COOLDOWN,
+                 max_in_flight: int = SPECULATION_MAX_INFLIGHT):
+        self.logger = setup_logger('Speculator')
+        """初始化会话级的推测执行
+
+        每种命令最多保留一个预生成任务，在后台事件循环中运行（不占用会话的后台任务队列，
+        因此不会阻塞下一条命令）。结果只能使用一次，使用时校验状态版本和提示：预生成构建好提示后
+        通过prepare登记，使用时先比较登记的版本和提示，不一致则直接取消，不必等待LLM调用完成。
+        玩家每次只会用到其中一种命令的结果，因此浪费次数和暂停按命令分别计算。
+
+        Args:
+            name: 名称，用于日志
+            kinds: 开启推测执行的命令
+            ttl: 结果有效期（秒）
+            max_misses: 连续浪费多少次后暂停
+            cooldown: 暂停时长（秒）
+            max_in_flight: 进程内同时进行的预生成数量上限
+        """
+        self.name = name
+        self.kinds = frozenset(kinds)
+        self.ttl = ttl
+        self.max_misses = max_misses
+        self.cooldown = cooldown
+        self.max_in_flight = max_in_flight
+        self.misses: Dict[str, int] = defaultdict(int)  # 命令 -> 连续浪费的次数
+        self.paused_until: Dict[str, float] = {}  # 命令 -> 暂停结束的时间
+        self._futures: Dict[str, Future] = {}  # 命令 -> 预生成任务，结果为SpeculativeResult或None
+        self._prepared: Dict[str, Future] = {}  # 命令 -> 预生成使用的(状态版本, 提示)，没有生成时为None
+        self._lock = threading.Lock()
+
+    def enabled(self, kind: str) -> bool:
+        return kind in self.kinds
+
+    def start(self, kind: str, speculate: Callable[[], Awaitable[Optional[SpeculativeResult]]]) -> bool:
+        """开始预生成，替换同一命令尚未使用的结果
+
+        Args:
+            kind: 命令
+            speculate: 返回协程的无参函数，协程返回SpeculativeResult，状态在准备过程中发生变化时返回None
+
+        Returns:
+            bool: 是否开始了预生成（未开启、暂停中或达到并发上限时不开始）
+        """
+        if not self.enabled(kind):
+            return False
+        if time.monotonic() < self.paused_until.get(kind, 0.0):
+            speculation_stats.record("paused")
+            return False
+        self._discard(kind)
+        if not speculation_stats.try_acquire(self.max_in_flight):
+            speculation_stats.record("skipped")
+            self.logger.debug(f"[{self.name}] 推测执行已达并发上限，跳过: {kind}")
+            return False
+        speculation_stats.record("started")
+        prepared = Future()
+        with self._lock:
+            self._prepared[kind] = prepared
+            self._futures[kind] = asyncio.run_coroutine_threadsafe(
+                self._run(kind, speculate, prepared, current_span()), get_background_loop())
+        return True
+
+    def prepare(self, kind: str, version: str, prompt: str):
+        """预生成构建好提示、开始调用LLM前登记状态版本和提示，供take提前判断结果能否使用"""
+        with self._lock:
+            prepared = self._prepared.get(kind)
+        if prepared is not None:
+            self._settle(prepared, (version, prompt))
+
+    @staticmethod
+    def _settle(prepared: Future, value):
+        try:
+            prepared.set_result(value)
+        except InvalidStateError:
+            pass  # 已登记过，或take等待时被取消
+
+    async def _run(self, kind: str, speculate, prepared: Future, parent) -> Optional[SpeculativeResult]:
+        try:
+            with tracer.span("speculation", parent=parent, kind=kind):
+                return await speculate()
+        except Exception as e:
+            speculation_stats.record("failed")
+            self.logger.warning(f"[{self.name}] 预生成失败: {kind}: {e}")
+            return None
+        finally:
+            self._settle(prepared, None)  # 没有登记就结束（状态变化或失败）
+            speculation_stats.release()
+
+    async def take(self, kind: str, version: str, prompt: str) -> Optional[SpeculativeResult]:
+        """取出预生成的结果，仍在生成时等待其完成
+
+        Args:
+            kind: 命令
+            version: 执行命令前的状态版本
+            prompt: 命令实际使用的提示
+
+        Returns:
+            SpeculativeResult: 版本和提示都相同且未过期时返回结果，否则丢弃并返回None
+        """
+        with self._lock:
+            future = self._futures.pop(kind, None)
+            prepared = self._prepared.pop(kind, None)
+        if future is None:
+            return None
+        try:
+            # 构建提示很快，先比较预生成登记的版本和提示，状态已变化时不等待注定被丢弃的结果
+            spec = await asyncio.wrap_future(prepared)
+            if spec is not None and spec != (version, prompt):
+                if future.cancel() or (future.done() and not future.cancelled()):
+                    self._record_miss(kind, "stale")
+                return None
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            return None  # 已被cancel()取消并计数
+        if result is None:
+            return None
+        if time.monotonic() - result.created_at > self.ttl:
+            self._record_miss(kind, "expired")
+            return None
+        if result.version != version or result.prompt != prompt:
+            self._record_miss(kind, "stale")
+            return None
+        self.misses[kind] = 0
+        speculation_stats.record("hit")
+        self.logger.info(f"[{self.name}] 使用预生成的结果: {kind}")
+        return result
+
+    def cancel(self, keep: Optional[str] = None):
+        """取消并丢弃预生成任务和结果，玩家执行会改变状态的命令时调用
+
+        Args:
+            keep: 保留的命令，即将执行的命令会用到其结果
+        """
+        with self._lock:
+            kinds = [kind for kind in self._futures if kind != keep]
+        for kind in kinds:
+            self._discard(kind)
+
+    def _discard(self, kind: str):
+        with self._lock:
+            future = self._futures.pop(kind, None)
+            self._prepared.pop(kind, None)
+        if future is None:
+            return
+        # 已完成且没有结果（准备阶段状态变化或生成失败）时不计为浪费
+        if future.cancel() or (not future.cancelled() and future.result() is not None):
+            self._record_miss(kind, "cancelled")
+
+    def _record_miss(self, kind: str, result: str):
+        speculation_stats.record(result)
+        self.misses[kind] += 1
+        if self.misses[kind] >= self.max_misses:
+            self.misses[kind] = 0
+            self.paused_until[kind] = time.monotonic() + self.cooldown
+            self.logger.info(f"[{self.name}] {kind}连续{self.max_misses}次预生成未被使用，暂停{self.cooldown:.0f}秒")
@@ -0,0 +1,103 @@
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+import os
+import threading
+import time
+from .utils import read_story_file_to_dict
+from .logger import setup_logger
+
+DEFAULT_STORY_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'story')
+
+# 距上次检查超过该秒数时才重新stat剧本文件和目录，0表示每次都检查，负数表示不再检查（不热加载）
+STORY_RELOAD_INTERVAL = float(os.getenv('STORY_RELOAD_INTERVAL', '2'))
+
+
+class StoryRegistry:
+    def __init__(self, story_dir: str = DEFAULT_STORY_DIR, reload_interval: float = STORY_RELOAD_INTERVAL):
+        self.logger = setup_logger('StoryRegistry')
+        """初始化剧本注册表
+
+        每个剧本文件只解析一次，解析结果以只读映射的形式在所有会话间共享；
+        新建会话、重置、切换剧本和读档时只需从内存取用。剧本文件或目录的修改时间变化时自动重新解析。
+
+        Args:
+            story_dir: 剧本目录
+            reload_interval: 检查文件修改时间的最小间隔（秒）
+        """
+        self.story_dir = story_dir
+        self.reload_interval = reload_interval
+        self._files: Dict[str, Tuple[float, float, Mapping[str, str]]] = {}  # 路径 -> (修改时间, 检查时间, 解析结果)
+        self._stories: Optional[Tuple[float, float, Tuple[str, ...]]] = None  # (目录修改时间, 检查时间, 剧本列表)
+        self._lock = threading.Lock()
+
+    def load(self, story_name: Optional[str], file_name: str) -> Mapping[str, str]:
+        """获取解析后的剧本文件
+
+        Args:
+            story_name: 剧本名称，为空时读取剧本目录下的同名文件
+            file_name: 文件名，如world_init.txt
+
+        Returns:
+            Mapping[str, str]: 各段标题到内容的只读映射，不要修改
+
+        Raises:
+            OSError: 文件不存在或无法读取
+        """
+        path = os.path.join(self.story_dir, story_name or "", file_name)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._files.get(path)
+        if cached is not None and not self._should_check(cached[1], now):
+            return cached[2]
+
+        mtime = os.stat(path).st_mtime
+        if cached is not None and cached[0] == mtime:
+            with self._lock:
+                self._files[path] = (mtime, now, cached[2])
+            return cached[2]
+
+        data = MappingProxyType(read_story_file_to_dict(path))
+        with self._lock:
+            self._files[path] = (mtime, now, data)
+        self.logger.info(f"{'重新' if cached else ''}解析剧本文件: {path}")
+        return data
+
+    def list_stories(self) -> List[str]:
+        """获取所有剧本名称（剧本目录下的子目录）"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._stories
+        if cached is not None and not self._should_check(cached[1], now):
+            return list(cached[2])
+
+        mtime = os.stat(self.story_dir).st_mtime
+        if cached is not None and cached[0] == mtime:
+            stories = cached[2]
+        else:
+            with os.scandir(self.story_dir) as entries:
+                stories = tuple(sorted(entry.name for entry in entries if entry.is_dir()))
+        with self._lock:
+            self._stories = (mtime, now, stories)
+        return list(stories)
+
+    def has_story(self, story_name: str) -> bool:
+        """剧本是否存在"""
+        return story_name in self.list_stories()
+
+    def _should_check(self, checked_at: float, now: float) -> bool:
+        if self.reload_interval < 0:
+            return False
+        return now - checked_at >= self.reload_interval
+
+
+_shared_registry: Optional[StoryRegistry] = None
+_shared_registry_lock = threading.Lock()
+
+
+def get_story_registry() -> StoryRegistry:
+    """获取进程共享的剧本注册表，热加载检查间隔由STORY_RELOAD_INTERVAL配置"""
+    global _shared_registry
+    with _shared_registry_lock:
+        if _shared_registry is None:
+            _shared_registry = StoryRegistry()
+        return _shared_registry
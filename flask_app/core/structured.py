@@ -0,0 +1,374 @@
+"""结构化（JSON）输出
+
+每种输出用StructuredOutput的子类声明字段，LLMService据此生成格式说明和JSON schema，
+并把模型回复解析为对应的对象。回复只解析一次；解析失败时由调用方发起一次小模型修复。
+流式回复用JsonStreamParser逐字符解析，顶层字符串字段可以边生成边展示。
+"""
+from contextlib import aclosing
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import re
+
+_FENCE_PATTERN = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class StructuredOutputError(ValueError):
+    """模型回复不符合结构化输出格式"""
+
+    def __init__(self, message: str, raw: str = ""):
+        super().__init__(message)
+        self.raw = raw
+
+
+def parse_json_object(text: str) -> dict:
+    """解析模型回复中的JSON对象，容忍代码块标记和对象前后的多余文字
+
+    Raises:
+        StructuredOutputError: 找不到合法的JSON对象
+    """
+    text = _FENCE_PATTERN.sub("", text or "")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end <= start:
+            raise StructuredOutputError("回复中没有JSON对象", text)
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError as e:
+            raise StructuredOutputError(f"JSON格式错误: {e}", text)
+    if not isinstance(data, dict):
+        raise StructuredOutputError("回复不是JSON对象", text)
+    return data
+
+
+class StructuredOutput:
+    """结构化输出的基类，子类在FIELDS中按输出顺序声明字段：字段名 -> (类型, 说明)
+
+    类型只支持str和list（字符串列表）。流式输出时只有str字段能边生成边展示，
+    需要尽早展示的字段应放在前面。
+    """
+
+    FIELDS: Dict[str, Tuple[type, str]] = {}
+
+    def __init__(self, **values):
+        for field, (field_type, _) in self.FIELDS.items():
+            setattr(self, field, values.get(field, field_type()))
+
+    @classmethod
+    def json_schema(cls) -> dict:
+        """字段对应的JSON schema，用于支持json_schema的接口"""
+        properties = {}
+        for field, (field_type, description) in cls.FIELDS.items():
+            if field_type is list:
+                properties[field] = {"type": "array", "items": {"type": "string"}, "description": description}
+            else:
+                properties[field] = {"type": "string", "description": description}
+        return {"type": "object", "properties": properties, "required": list(cls.FIELDS),
+                "additionalProperties": False}
+
+    @classmethod
+    def format_instructions(cls) -> str:
+        """追加在提示末尾的输出格式说明"""
+        lines = ["", "", "请只输出一个JSON对象，不要输出JSON以外的任何内容，按以下顺序包含这些字段："]
+        for field, (field_type, description) in cls.FIELDS.items():
+            lines.append(f'- "{field}"（{"字符串数组" if field_type is list else "字符串"}）：{description}')
+        return "\n".join(lines)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StructuredOutput":
+        """从解析出的JSON对象构建，缺少字段或类型不符时抛出StructuredOutputError"""
+        values = {}
+        for field, (field_type, _) in cls.FIELDS.items():
+            if field not in data:
+                raise StructuredOutputError(f"缺少字段: {field}")
+            value = data[field]
+            if field_type is list:
+                if isinstance(value, str):
+                    value = [line for line in value.split("\n") if line.strip()]
+                if not isinstance(value, list):
+                    raise StructuredOutputError(f"字段{field}应为字符串数组")
+                value = [str(item).strip() for item in value]
+            elif isinstance(value, (int, float)):
+                value = str(value)
+            elif not isinstance(value, str):
+                raise StructuredOutputError(f"字段{field}应为字符串")
+            values[field] = value.strip() if isinstance(value, str) else value
+        return cls(**values)
+
+    @classmethod
+    def parse(cls, text: str) -> "StructuredOutput":
+        """解析模型回复
+
+        Raises:
+            StructuredOutputError: 回复不符合格式
+        """
+        try:
+            return cls.from_dict(parse_json_object(text))
+        except StructuredOutputError as e:
+            e.raw = text
+            raise
+
+    @classmethod
+    def fallback(cls, raw: str) -> Optional["StructuredOutput"]:
+        """修复也失败时从原始文本得到的尽力结果，无法得到时返回None"""
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def render(self, labels: Dict[str, str]) -> str:
+        """按labels的顺序把字段渲染为展示文本，label为空时不加标题，不在labels中的字段不展示"""
+        parts = []
+        for field, label in labels.items():
+            parts.append(_render_field(label, getattr(self, field)))
+        return "\n".join(parts)
+
+
+def _render_field(label: str, value) -> str:
+    header = f"【{label}】：" if label else ""
+    if isinstance(value, list):
+        items = "\n".join(f"{i}. {item}" for i, item in enumerate(value, 1))
+        return f"{header}\n{items}" if header else items
+    return f"{header}{value}"
+
+
+class CharacterReply(StructuredOutput):
+    """主角对系统消息的回复"""
+
+    FIELDS = {
+        "reply": (str, "角色对系统消息的回复内容"),
+        "thoughts": (str, "回复后角色的心理状态变化"),
+    }
+
+    @classmethod
+    def fallback(cls, raw: str) -> Optional["CharacterReply"]:
+        # 心理状态为空时保持不变
+        return cls(reply=raw.strip(), thoughts="") if raw and raw.strip() else None
+
+
+class ActionPlans(StructuredOutput):
+    """主角的候选行动方案"""
+
+    FIELDS = {
+        "actions": (list, "三个候选行动方案，每项一行，包含行动描述和预期结果"),
+    }
+
+
+class StoryProgress(StructuredOutput):
+    """一次故事演进"""
+
+    FIELDS = {
+        "time": (str, "故事开展的具体时间，格式为YYYY-MM-DD HH:MM:SS"),
+        "place": (str, "具体的地点"),
+        "story": (str, "主角的行动以及具体的行动结果，保持文学性和画面感"),
+        "suggestions": (list, "三个系统帮助主角的简略建议，以减轻玩家的思考压力"),
+    }
+
+    # 展示给玩家的字段和标题
+    LABELS = {"time": "时间", "place": "地点", "story": "故事", "suggestions": "建议"}
+    # 记入世界历史的字段
+    HISTORY_LABELS = {"time": "时间", "place": "地点", "story": "故事"}
+
+    @classmethod
+    def fallback(cls, raw: str) -> Optional["StoryProgress"]:
+        return cls(story=raw.strip()) if raw and raw.strip() else None
+
+
+class TaskCheck(StructuredOutput):
+    """任务完成情况"""
+
+    FIELDS = {
+        "completed_tasks": (list, "已经完成的任务描述，没有任务完成时为空数组"),
+    }
+
+
+class JsonStreamParser:
+    """增量解析流式输出的顶层JSON对象
+
+    逐字符跟踪解析状态，顶层字符串字段的内容在生成过程中即可取得（已处理转义），
+    嵌套的数组和对象只跳过，完整结果在结束后用parse_json_object解析。
+    """
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self._state = "start"
+        self._key: List[str] = []
+        self._field: Optional[str] = None
+        self._escape = False
+        self._unicode: Optional[str] = None  # 正在读取的\uXXXX
+        self._high_surrogate: Optional[int] = None
+        self._depth = 0
+        self._nested_string = False
+        self._nested_escape = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """输入一个chunk
+
+        Returns:
+            list: (字段名, 新增文本)列表，相邻的同一字段已合并
+        """
+        self.parts.append(chunk)
+        events: List[List[str]] = []
+        for char in chunk:
+            text = self._step(char)
+            if text:
+                if events and events[-1][0] == self._field:
+                    events[-1][1] += text
+                else:
+                    events.append([self._field, text])
+        return [(field, text) for field, text in events]
+
+    def _step(self, char: str) -> str:
+        state = self._state
+        if state == "start":
+            if char == "{":
+                self._state = "key_wait"
+        elif state == "key_wait":
+            if char == '"':
+                self._key = []
+                self._state = "key"
+            elif char == "}":
+                self._state = "done"
+        elif state == "key":
+            if self._escape:
+                self._key.append(char)
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._state = "colon"
+            else:
+                self._key.append(char)
+        elif state == "colon":
+            if char == ":":
+                self._state = "value_wait"
+        elif state == "value_wait":
+            if char == '"':
+                self._field = "".join(self._key)
+                self._state = "string"
+            elif not char.isspace():
+                self._depth = 0
+                self._state = "other"
+                self._skip_value(char)
+        elif state == "string":
+            return self._string_char(char)
+        elif state == "other":
+            self._skip_value(char)
+        return ""
+
+    def _string_char(self, char: str) -> str:
+        if self._unicode is not None:
+            self._unicode += char
+            if len(self._unicode) < 4:
+                return ""
+            try:
+                code = int(self._unicode, 16)
+            except ValueError:
+                code = 0xFFFD
+            self._unicode = None
+            if 0xD800 <= code < 0xDC00:
+                self._high_surrogate = code
+                return ""
+            if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+                code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            return chr(code) if not 0xD800 <= code < 0xE000 else ""
+        if self._escape:
+            self._escape = False
+            if char == "u":
+                self._unicode = ""
+                return ""
+            return _ESCAPES.get(char, char)
+        if char == "\\":
+            self._escape = True
+            return ""
+        if char == '"':
+            self._state = "key_wait"
+            return ""
+        return char
+
+    def _skip_value(self, char: str):
+        """跳过非字符串的值，顶层遇到逗号或对象结束时回到等待下一个字段"""
+        if self._nested_string:
+            if self._nested_escape:
+                self._nested_escape = False
+            elif char == "\\":
+                self._nested_escape = True
+            elif char == '"':
+                self._nested_string = False
+        elif char == '"':
+            self._nested_string = True
+        elif char in "[{":
+            self._depth += 1
+        elif char in "]}":
+            if self._depth == 0:
+                self._state = "done"
+            else:
+                self._depth -= 1
+        elif char == "," and self._depth == 0:
+            self._state = "key_wait"
+
+
+class StructuredStream:
+    """结构化输出的流式结果
+
+    迭代得到(字段名, 新增文本)，只包含顶层字符串字段；迭代结束后result为解析（必要时修复）后的对象。
+    """
+
+    def __init__(self):
+        self.result: Optional[StructuredOutput] = None
+        self._events = None
+
+    def bind(self, events):
+        self._events = events
+        return self
+
+    def __aiter__(self):
+        return self._events
+
+    async def aclose(self):
+        """提前结束时关闭底层的流式请求"""
+        await self._events.aclose()
+
+
+async def render_stream(stream: StructuredStream, labels: Dict[str, str]):
+    """把结构化流渲染为与StructuredOutput.render相同的展示文本
+
+    labels中的字符串字段边生成边输出，其他字段（列表、未能流式取得的字段）在结束后按顺序补齐。
+    修复或兜底解析可能改变已输出字段的内容，结束后把这些字段改回实际输出的文本，
+    保证调用方保存的stream.result与玩家看到的一致。
+
+    Yields:
+        str: 展示文本片段
+    """
+    shown = []  # 已开始输出的字段
+    streamed: Dict[str, List[str]] = {}  # 字段 -> 已输出的文本
+    async with aclosing(stream) as events:
+        async for field, text in events:
+            if field not in labels:
+                continue
+            if field not in shown:
+                # 前面还没输出的字段（如模型调换了字段顺序）留到结束后补齐
+                prefix = "\n" if shown else ""
+                label = labels[field]
+                yield prefix + (f"【{label}】：" if label else "")
+                shown.append(field)
+                streamed[field] = []
+            streamed[field].append(text)
+            yield text
+    result = stream.result
+    for field, parts in streamed.items():
+        setattr(result, field, "".join(parts))
+    for field, label in labels.items():
+        if field in shown:
+            continue
+        value = getattr(result, field)
+        yield ("\n" if shown else "") + _render_field(label, value)
+        shown.append(field)
@@ -1,12 +1,40 @@
-from typing import Optional, List
+from contextlib import aclosing
+from typing import Dict, Optional, List
+import asyncio
+import hashlib
 import json
 import os
 from datetime import datetime
 from .world import World
 from .character import Character
-from .llm_service import LLMService
-from .logger import setup_logger
+from .llm_service import LLMService, DEFAULT_CACHE_TTL
+from .logger import setup_logger, log_text
+from .structured import CharacterReply, StoryProgress, render_stream
+from .job_queue import SessionJobQueue, get_background_loop
+from .context_builder import ContextBuilder, DEFAULT_CONTEXT_BUDGET, estimate_tokens
+from .retrieval import BM25Index
+from .save_log import SaveLog, SaveTracker
+from .save_catalog import DEFAULT_SAVE_DIR, SORT_ORDERS, get_save_catalog
+from .snapshots import GameSnapshot, SnapshotHistory
+from .story_registry import get_story_registry
+from .local_rules import classify_modification, fast_path_stats, parse_standard_time_span, shift_time
+from .speculation import SpeculativeResult, Speculator
+from .task_graph import TaskGraph
+from .tracing import traced
 import re
+import uuid
+
+# 对话历史压缩策略：超过轮数或token数时，把最早的一段对话总结后移出内存
+DIALOGUE_COMPACT_TURNS = int(os.getenv('DIALOGUE_COMPACT_TURNS', '40'))
+DIALOGUE_COMPACT_TOKENS = int(os.getenv('DIALOGUE_COMPACT_TOKENS', '4000'))
+DIALOGUE_COMPACT_BLOCK = int(os.getenv('DIALOGUE_COMPACT_BLOCK', '20'))
+DIALOGUE_KEEP_RECENT = int(os.getenv('DIALOGUE_KEEP_RECENT', '10'))
+
+# /qu查询时放入提示的相关历史事件数量
+QUERY_TOP_K = int(os.getenv('QUERY_TOP_K', '20'))
+
+# /st未指定时长时推进的时间
+DEFAULT_STORY_SPAN = "10m"
 
 
 class System:
@@ -23,7 +51,16 @@ class System:
         self.dialogue_summaries = []  # 对话总结记录
         self.qu_history = []  # qu命令历史记录
         self.current_story = story_name or "默认剧本"
-
+        self.started = False  # 是否已经/start开始游戏
+        self.jobs = SessionJobQueue('System')  # 响应返回后执行的后台任务
+        self.archive_id = uuid.uuid4().hex  # 已压缩对话的归档文件名
+        self._compaction_scheduled = False
+        self._qu_index = BM25Index()  # qu历史检索索引
+        self._save_trackers: Dict[str, SaveTracker] = {}  # 各存档最近一次写入的状态，用于增量保存
+        self.snapshots = SnapshotHistory()  # 内存快照，用于/undo、分支和快速读档
+        self.speculation = Speculator('System')  # 预生成的下一条/st和/des结果
+
+    @traced()
     async def modify_state(self, modification: str) -> str:
         """修改世界或角色状态
         
@@ -33,31 +70,13 @@ class System:
         Returns:
             str: 修改结果
         """
-        # 构建提示以判断修改类型和计算能量
-        prompt = f"""
-[修改内容]
-{modification}
-
-请分析这个修改内容属于哪种类型。注意：
-1. 分析修改内容是针对世界状态还是角色状态
-2. 发布任务是给主角发布任务，因此类型为character
-
-请严格按以下格式回复：
-[类型]：world或character"""
-
-        # 获取类型判断和能量计算
-        response = await self.llm_service.generate_response(prompt, use_small_model=True)
-
-        # 解析响应
-        modification_type = ""
         energy_cost = 1
 
-        for line in response.split("\n"):
-            if "[类型]：" in line:
-                if "world" in line:
-                    modification_type = "world"
-                else:
-                    modification_type = "character"
+        # 常见的修改用关键词判断类型，无法确定时再让小模型判断
+        modification_type = classify_modification(modification, self.character.profile)
+        fast_path_stats.record("modify_type", modification_type is not None)
+        if modification_type is None:
+            modification_type = await self._classify_modification_llm(modification)
 
         self.logger.info(f"修改类型: {modification_type}, 所需能量: {energy_cost}")
 
@@ -76,17 +95,39 @@ class System:
                 result_msg = f"世界状态已更新：{modification}"
                 response = ""
             else:  # character
-                await self.character.update_attributes(modification)
+                # 更新档案和主角回复并发生成
+                response = await self._update_character_and_reply("修改主角状态", modification, modification)
                 self.logger.info(f"角色状态修改成功 - 消耗能量: {energy_cost}, 剩余: {self.energy}")
                 result_msg = f"角色状态变更如下：{modification}"
 
-                response = await self.communicate(modification)
-
             return f"[{result_msg}]\n[消耗了{energy_cost}点能量，剩余{self.energy}点能量。]\n\n{response}"
         except Exception as e:
             self.logger.error(f"修改失败: {e}")
             return f"修改失败：{str(e)}"
 
+    async def _classify_modification_llm(self, modification: str) -> str:
+        """让小模型判断修改针对世界还是主角，无法识别时视为主角"""
+        prompt = f"""
+[修改内容]
+{modification}
+
+请分析这个修改内容属于哪种类型。注意：
+1. 分析修改内容是针对世界状态还是角色状态
+2. 发布任务是给主角发布任务，因此类型为character
+
+请严格按以下格式回复：
+[类型]：world或character"""
+
+        # 结果只取决于修改内容，可以缓存
+        response = await self.llm_service.generate_response(
+            prompt, use_small_model=True, cache_ttl=DEFAULT_CACHE_TTL)
+
+        for line in response.split("\n"):
+            if "[类型]：" in line:
+                return "world" if "world" in line else "character"
+        return "character"
+
+    @traced()
     async def confirm_world_state(self, query: str) -> str:
         self.logger.info(f"查询世界状态: {query}")
         """查询世界状态
@@ -97,20 +138,78 @@ class System:
         Returns:
             str: 查询结果
         """
+        prompt = self._confirm_world_state_prompt(query)
+        # 状态未变化时的相同查询直接复用结果
+        response = await self.llm_service.generate_response(
+            prompt, cache_ttl=DEFAULT_CACHE_TTL, cache_key=self._query_cache_key(query))
+        return self._finish_confirm_world_state(query, response)
+
+    @traced()
+    async def confirm_world_state_stream(self, query: str):
+        """查询世界状态（流式）
+
+        Args:
+            query: 查询内容
+
+        Yields:
+            str: 查询结果片段
+        """
+        self.logger.info(f"流式查询世界状态: {query}")
+        prompt = self._confirm_world_state_prompt(query)
+        chunks = []
+        async with aclosing(self.llm_service.stream_response(
+                prompt, cache_ttl=DEFAULT_CACHE_TTL, cache_key=self._query_cache_key(query))) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        self._finish_confirm_world_state(query, "".join(chunks))
+
+    def _query_cache_key(self, query: str) -> str:
+        """查询结果的缓存键：查询内容加当前状态版本"""
+        return f"查询:{self.get_state_version()}:{query}"
+
+    def get_state_version(self) -> str:
+        """计算当前游戏状态的版本指纹
+
+        包含剧本、世界背景、时间、历史事件、角色档案、心理和对话轮数。
+        查询事件不计入版本，因此状态未变化时重复的查询可以复用结果。
 
-        world_current_context = self.world.get_current_context()
-        self.logger.debug(f"获取到的世界状态: {world_current_context}")
+        Returns:
+            str: 状态版本
+        """
+        digest = hashlib.sha256()
+        parts = [
+            self.current_story,
+            self.world.background,
+            self.world.current_time.strftime("%Y-%m-%d %H:%M:%S"),
+            self.character.profile,
+            self.character.hidden_profile,
+            self.character.thoughts,
+            str(len(self.dialogue_history)),
+        ]
+        parts.extend(event for event in self.world.history if not event.startswith("查询事件"))
+        for part in parts:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()[:16]
+
+    @traced()
+    def _confirm_world_state_prompt(self, query: str) -> str:
+        """构建查询世界状态的提示"""
+        # 只放入与查询相关的历史事件
+        world_current_context = self.world.get_relevant_context(query, top_k=QUERY_TOP_K)
+        log_text(self.logger, "获取到的世界状态", world_current_context)
 
         character_info = self.character.get_character_info_str()
-        self.logger.debug(f"获取到的角色状态: {character_info}")
+        log_text(self.logger, "获取到的角色状态", character_info)
 
-        # 获取qu历史
-        qu_context = self._format_qu_history(10)  # 获取最近10条qu记录
-        self.logger.debug(f"获取到的qu历史: {qu_context}")
+        # 获取qu历史：最近3条和检索到的相关记录
+        qu_context = self._format_relevant_qu_history(query, 5, 3)
+        log_text(self.logger, "获取到的qu历史", qu_context)
 
         # 获取对话历史
         dialogue_context = self._format_recent_history(10)
-        self.logger.debug(f"获取到的对话历史: {dialogue_context}")
+        log_text(self.logger, "获取到的对话历史", dialogue_context)
 
         # 生成查询响应
         prompt = f"""
@@ -135,9 +234,10 @@ class System:
 5. 在之前已有的信息基础之上，查询结果要给出详细信息。
 
 请根据以上信息回答查询："""
+        return prompt
 
-        response = await self.llm_service.generate_response(prompt)
-
+    def _finish_confirm_world_state(self, query: str, response: str) -> str:
+        """记录查询结果"""
         # 保存查询结果到世界历史
         self.world.save_query_result(query, response)
 
@@ -149,6 +249,7 @@ class System:
 
         return response
 
+    @traced()
     async def communicate(self, message: str) -> str:
         self.logger.info(f"与主角对话: {message}")
         """与主角直接对话
@@ -159,22 +260,48 @@ class System:
         Returns:
             str: 主角的回复
         """
+        prompt = self._communicate_prompt(message)
+        reply = await self.llm_service.generate_structured(prompt, CharacterReply)
+        return self._finish_communicate(message, reply)
 
-        # 构建对话上下文
-        context = {
-            "message": message,
-            "character": str(self.character.profile),
-            "thoughts": self.character.get_current_thoughts(),
-            "dialogue_history": self._format_recent_history(200),  # 获取最近5轮对话
-            "dialogue_summaries": "\n".join(self.dialogue_summaries[-3:])  # 最近3个总结
-        }
+    @traced()
+    async def communicate_stream(self, message: str):
+        """与主角直接对话（流式），只输出回复内容
+
+        Args:
+            message: 对话内容
+
+        Yields:
+            str: 主角回复片段
+        """
+        self.logger.info(f"流式与主角对话: {message}")
+        prompt = self._communicate_prompt(message)
+        stream = self.llm_service.stream_structured(prompt, CharacterReply)
+        async with aclosing(render_stream(stream, {"reply": ""})) as chunks:
+            async for chunk in chunks:
+                yield chunk
+        self._finish_communicate(message, stream.result)
+
+    @traced()
+    def _communicate_prompt(self, message: str) -> str:
+        """构建与主角对话的提示"""
+        # 按优先级在token预算内构建对话上下文：角色档案和心理 > 最近对话 > 历史总结
+        builder = ContextBuilder()
+        builder.add_text("message", message, 0, required=True)
+        builder.add_text("character", self.character.get_character_info_str(show_hidden_info=True), 0, required=True)
+        builder.add_items("dialogue_history", self.dialogue_history[-200:], 1,
+                          item_text=self._format_dialogue, render=self._format_dialogues)
+        builder.add_items("dialogue_summaries", self.dialogue_summaries[-3:], 2)  # 最近3个总结
+        context = builder.build()
+        if builder.omitted:
+            self.logger.debug(f"对话上下文超出token预算，省略部分: {builder.omitted}")
 
         # 生成回复
         prompt = f"""
 [历史对话总结]
 {context['dialogue_summaries']}
 
-{self.character.get_character_info_str(show_hidden_info=True)}
+{context['character']}
 
 [最近对话记录]
 {context['dialogue_history']}
@@ -188,38 +315,28 @@ class System:
 3. 展现角色当前的心理状态
 4. 确保回复的连贯性和自然度
 5. 同时更新角色的心理状态
-6. 当系统提出能力和物品给予的时候，角色不会立刻获得，而是后续通过命令或任务给予。
-
-以如下格式回复：
-[回复内容]：XXXXX
-[心理变化]：YYYYY"""
-
-        response = await self.llm_service.generate_response(prompt)
-        self.logger.debug(f"主角回复: {response}")
-
-        thoughts = self.character.thoughts
-        response_text = ""
-
-        for i in response.split("\n"):
-            if "[回复内容]：" in i:
-                response_text = i.split("[回复内容]：")[1].strip()
-            if "[心理变化]：" in i:
-                thoughts = i.split("[心理变化]：")[1].strip()
+6. 当系统提出能力和物品给予的时候，角色不会立刻获得，而是后续通过命令或任务给予。"""
+        return prompt
 
-        self.logger.info(response)
-
-        self.character.thoughts = thoughts
+    def _finish_communicate(self, message: str, reply: CharacterReply) -> str:
+        """根据主角回复更新心理状态并记录对话"""
+        log_text(self.logger, "主角回复", reply.reply)
+        response_text = reply.reply
+        if reply.thoughts:
+            self.character.thoughts = reply.thoughts
 
         # 记录对话
         self.dialogue_history.append({
             "system": message,
             "character": response_text
         })
+        self._maybe_compact_dialogue()
 
         response_text = response_text
 
         return response_text
 
+    @traced()
     async def advance_story(self, time_span_str):
         self.logger.info("触发故事演进")
         """触发自主故事演进
@@ -227,15 +344,62 @@ class System:
         Returns:
             str: 故事演进结果
         """
+        version = self.get_state_version()
+        prompt = await self._advance_story_prompt(time_span_str)
+
+        # 生成故事发展，状态和提示与预生成时相同则直接使用预生成的结果
+        speculated = await self.speculation.take("st", version, prompt)
+        if speculated is not None:
+            progress = speculated.value
+        else:
+            progress = await self.llm_service.generate_structured(prompt, StoryProgress)
+        return self._finish_advance_story(progress)
+
+    @traced()
+    async def advance_story_stream(self, time_span_str):
+        """触发自主故事演进（流式）
+
+        Yields:
+            str: 故事演进结果片段
+        """
+        self.logger.info("触发流式故事演进")
+        version = self.get_state_version()
+        prompt = await self._advance_story_prompt(time_span_str)
+        speculated = await self.speculation.take("st", version, prompt)
+        if speculated is not None:
+            progress = speculated.value
+            yield progress.render(StoryProgress.LABELS)
+        else:
+            stream = self.llm_service.stream_structured(prompt, StoryProgress)
+            async with aclosing(render_stream(stream, StoryProgress.LABELS)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+            progress = stream.result
+        self._finish_advance_story(progress)
+
+    @traced()
+    async def _advance_story_prompt(self, time_span_str) -> str:
+        """推进世界时间并构建故事演进提示"""
         if time_span_str == "":
-            time_span_str = "10m"
+            time_span_str = DEFAULT_STORY_SPAN
+
+        await self.world.advance_time(time_span_str)
+        return self._story_prompt(time_span_str)
 
-        self.world.advance_time(time_span_str)
+    def _story_prompt(self, time_span_str: str, current_time: datetime = None) -> str:
+        """构建故事演进提示
 
+        Args:
+            time_span_str: 推演时长
+            current_time: 推演开始的时间，为空时使用世界的当前时间（已推进）
+        """
+        current_time = current_time or self.world.current_time
         character_info = self.character.get_character_info_str(show_hidden_info=True)
 
-        # 构建故事演进提示
-        world_current_context = self.world.get_current_context(show_hide_info=True)
+        # 构建故事演进提示，角色信息之外的预算留给世界背景和历史事件
+        world_current_context = self.world.get_current_context(
+            show_hide_info=True, token_budget=max(0, DEFAULT_CONTEXT_BUDGET - estimate_tokens(character_info)),
+            current_time=current_time)
         prompt = f"""
 {character_info}
 
@@ -252,34 +416,58 @@ class System:
 7. 推演中，系统绝对不会发放能力、物品、信息。主角只能使用自身能力、属性、技能、物品和其他可以获得的非系统支持来解决问题。
 8. 保持文学性和画面感
 9. 控制在200字以内
-
-展开过程严格如下格式按照：
-
-【时间】：{self.world.current_time.strftime("%Y-%m-%d %H:%M:%S")}
-【地点】：具体的地点
-【故事】：主角的行动以及具体的行动结果。保持文学性和画面感。
-【建议】：给出三个系统帮助主角的简略建议，以减轻玩家的思考压力。
+10. 当前时间为{current_time.strftime("%Y-%m-%d %H:%M:%S")}
 
 请主角以最合理的方案行动，尽可能详细描述其展开过程（200字左右）："""
 
-        self.logger.info(f"故事演进提示: {prompt}")
+        log_text(self.logger, "故事演进提示", prompt)
+        return prompt
 
-        # 生成故事发展
-        story_progress = await self.llm_service.generate_response(prompt)
-        ordinary_progress = story_progress
-        story_progress = story_progress.split("【建议】")[0]
+    def _finish_advance_story(self, progress: StoryProgress) -> str:
+        """记录故事进展，主角状态和心理的更新放到后台任务中执行"""
+        ordinary_progress = progress.render(StoryProgress.LABELS)
+        story_progress = progress.render(StoryProgress.HISTORY_LABELS)  # 建议不记入历史
         # 记录到世界历史
         self.world.log_history(story_progress.replace("\n", " "))
 
-        await self.character.update_attributes(
-            "故事进展：" + story_progress.replace("\n", "") + "\n 根据以上故事进展更新主角的状态情况")
-        # 更新主角心理状态
-        await self.communicate(f"[世界发生了新的发展]:{story_progress}")
+        # 后台更新主角状态，下一条命令执行前会等待其完成
+        self.jobs.submit(lambda: self._update_after_story(story_progress), "故事演进后更新主角状态")
+        self._schedule_speculation()
 
         self.logger.info("故事演进完成")
-        self.logger.debug(f"故事进展: {story_progress}")
+        log_text(self.logger, "故事进展", story_progress)
         return ordinary_progress
 
+    @traced()
+    async def _update_after_story(self, story_progress: str):
+        """根据故事进展更新主角状态和心理（后台任务）"""
+        await self._update_character_and_reply(
+            "故事演进后更新主角",
+            "故事进展：" + story_progress.replace("\n", "") + "\n 根据以上故事进展更新主角的状态情况",
+            f"[世界发生了新的发展]:{story_progress}")
+
+    async def _update_character_and_reply(self, name: str, changes: str, message: str) -> str:
+        """更新主角档案，同时让主角回复消息
+
+        两次LLM调用都以更新前的状态为输入，并发执行；完成后先写入档案，再记录回复和心理变化。
+
+        Args:
+            name: 命令名称，用于追踪
+            changes: 档案变更描述
+            message: 发给主角的消息
+
+        Returns:
+            str: 主角的回复
+        """
+        prompt = self._communicate_prompt(message)
+        graph = TaskGraph(name)
+        graph.add("profile", lambda: self.character.compute_profile_update(changes),
+                  commit=self.character.set_profile)
+        graph.add("reply", lambda: self.llm_service.generate_structured(prompt, CharacterReply),
+                  commit=lambda reply: self._finish_communicate(message, reply))
+        results = await graph.run()
+        return results["reply"].reply
+
     def _format_recent_history(self, count: int) -> str:
         """格式化最近的对话历史
 
@@ -290,29 +478,94 @@ class System:
             str: 格式化的对话历史
         """
         recent = self.dialogue_history[-count:] if len(self.dialogue_history) > 0 else []
+        return self._format_dialogues(recent)
+
+    @staticmethod
+    def _format_dialogue(dialogue: dict) -> str:
+        """格式化单轮对话"""
+        return f"系统：{dialogue['system']}\n角色：{dialogue['character']}\n"
+
+    def _format_dialogues(self, dialogues: List[dict]) -> str:
+        """格式化多轮对话，按顺序编号"""
         formatted = []
-        for i, dialogue in enumerate(recent, 1):
+        for i, dialogue in enumerate(dialogues, 1):
             formatted.append(f"第{i}轮对话：")
-            formatted.append(f"系统：{dialogue['system']}")
-            formatted.append(f"角色：{dialogue['character']}\n")
+            formatted.append(self._format_dialogue(dialogue))
         return "\n".join(formatted)
 
+    @traced()
     async def summarize_current_dialogue(self) -> str:
         """总结当前对话历史"""
         if not self.dialogue_history:
             return "暂无对话记录"
 
+        summary = await self._summarize_dialogues(self.dialogue_history)
+        self.dialogue_summaries.append(summary)
+        return summary
+
+    async def _summarize_dialogues(self, dialogues: List[dict]) -> str:
+        """使用小模型总结一段对话"""
         prompt = f"""
 请总结以下对话的主要内容（100字以内）：
 
-{self._format_recent_history(len(self.dialogue_history))}
+{self._format_dialogues(dialogues)}
 
 请提供简洁的总结：
         """
 
-        summary = await self.llm_service.generate_response(prompt, use_small_model=True)
-        self.dialogue_summaries.append(summary)
-        return summary
+        return await self.llm_service.generate_response(prompt, use_small_model=True)
+
+    def _maybe_compact_dialogue(self):
+        """对话历史超过阈值时，安排后台任务压缩最早的一段对话"""
+        if self._compaction_scheduled or len(self.dialogue_history) <= DIALOGUE_KEEP_RECENT:
+            return
+        if len(self.dialogue_history) <= DIALOGUE_COMPACT_TURNS:
+            tokens = sum(estimate_tokens(self._format_dialogue(d)) for d in self.dialogue_history)
+            if tokens <= DIALOGUE_COMPACT_TOKENS:
+                return
+        self._compaction_scheduled = True
+        # 总结不进入后台任务队列，下一条命令执行前的jobs.join()不会等待这次LLM调用
+        asyncio.run_coroutine_threadsafe(self._compact_dialogue(), get_background_loop())
+
+    @traced()
+    async def _compact_dialogue(self):
+        """总结最早的一段对话，完成后通过后台任务队列写入状态"""
+        count = min(DIALOGUE_COMPACT_BLOCK, len(self.dialogue_history) - DIALOGUE_KEEP_RECENT)
+        if count <= 0:
+            self._compaction_scheduled = False
+            return
+        block = self.dialogue_history[:count]
+        try:
+            summary = await self._summarize_dialogues(block)
+        except Exception as e:
+            self._compaction_scheduled = False
+            self.logger.error(f"压缩对话历史失败: {e}")
+            return
+        # 写入与其他状态更新一起按顺序执行，只是列表操作，不会明显推迟下一条命令
+        self.jobs.submit(lambda: self._apply_compaction(block, summary), "写入对话历史压缩结果")
+
+    async def _apply_compaction(self, block: List[dict], summary: str):
+        """把总结存入dialogue_summaries，并把原始对话归档到磁盘（后台任务）"""
+        try:
+            # 总结期间对话列表可能被整体替换（如读档、撤销），只在仍是同一批对话时移除
+            count = len(block)
+            if self.dialogue_history[:count] == block:
+                self._archive_dialogues(block)
+                self.dialogue_summaries.append(summary)
+                del self.dialogue_history[:count]
+                self.logger.info(f"已压缩{count}轮对话，剩余{len(self.dialogue_history)}轮")
+        finally:
+            self._compaction_scheduled = False
+        # 一次只压缩一段，仍超过阈值时继续安排
+        self._maybe_compact_dialogue()
+
+    def _archive_dialogues(self, dialogues: List[dict]):
+        """把对话追加写入归档文件"""
+        archive_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'archive')
+        os.makedirs(archive_dir, exist_ok=True)
+        with open(os.path.join(archive_dir, f"{self.archive_id}.jsonl"), 'a', encoding='utf-8') as f:
+            for dialogue in dialogues:
+                f.write(json.dumps(dialogue, ensure_ascii=False) + "\n")
 
     async def clear_dialogue_history(self) -> None:
         """清除当前对话历史，在开始新故事前调用"""
@@ -321,6 +574,22 @@ class System:
             self.dialogue_history = []
             self.logger.info("已清除对话历史并保存总结")
 
+    def _format_relevant_qu_history(self, query: str, top_k: int, recent: int) -> str:
+        """格式化与查询相关的qu历史
+
+        Args:
+            query: 查询内容
+            top_k: 检索的相关记录数
+            recent: 始终包含的最近记录数
+
+        Returns:
+            str: 格式化的qu历史
+        """
+        self._qu_index.sync(self.qu_history, lambda record: f"{record['query']} {record['response']}")
+        indices = {doc_id for doc_id, _ in self._qu_index.search(query, top_k)}
+        indices.update(range(max(0, len(self.qu_history) - recent), len(self.qu_history)))
+        return self._format_qu_records([self.qu_history[i] for i in sorted(indices)])
+
     def _format_qu_history(self, count: int) -> str:
         """格式化最近的qu历史
 
@@ -331,13 +600,19 @@ class System:
             str: 格式化的qu历史
         """
         recent = self.qu_history[-count:] if len(self.qu_history) > 0 else []
+        return self._format_qu_records(recent)
+
+    @staticmethod
+    def _format_qu_records(records: List[dict]) -> str:
+        """格式化qu记录，按顺序编号"""
         formatted = []
-        for i, record in enumerate(recent, 1):
+        for i, record in enumerate(records, 1):
             formatted.append(f"第{i}次查询：")
             formatted.append(f"问：{record['query']}")
             formatted.append(f"答：{record['response']}\n")
         return "\n".join(formatted)
 
+    @traced()
     async def reset(self, story_name: str = None) -> str:
         """重置游戏状态
         
@@ -348,9 +623,10 @@ class System:
             str: 重置结果
         """
         self.logger.info(f"开始重置游戏状态，切换剧本: {story_name}")
+        story_name = story_name or self.current_story
         try:
             # 重新初始化各个组件
-            self.world = World(story_name)
+            self.world = World(self.llm_service, story_name)
             self.character = Character(self.llm_service, story_name)
             self.world.set_character(self.character)
 
@@ -359,6 +635,7 @@ class System:
             self.dialogue_history = []
             self.dialogue_summaries = []
             self.qu_history = []  # 清空qu历史
+            self.started = False  # 重置后需要重新/start
 
             if story_name:
                 self.current_story = story_name
@@ -375,18 +652,15 @@ class System:
         Returns:
             List[str]: 剧本名称列表
         """
-        story_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'story')
-        stories = []
         try:
-            for item in os.listdir(story_dir):
-                if os.path.isdir(os.path.join(story_dir, item)):
-                    stories.append(item)
+            stories = get_story_registry().list_stories()
             self.logger.info(f"获取到可用剧本列表: {stories}")
             return stories
         except Exception as e:
             self.logger.error(f"获取剧本列表失败: {e}")
             return []
 
+    @traced()
     async def switch_story(self, story_name: str) -> str:
         """切换到指定剧本
         
@@ -397,9 +671,7 @@ class System:
             str: 切换结果
         """
         self.logger.info(f"准备切换到剧本: {story_name}")
-        story_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'story', story_name)
-
-        if not os.path.isdir(story_dir):
+        if not get_story_registry().has_story(story_name):
             self.logger.error(f"剧本不存在: {story_name}")
             return f"切换失败：剧本「{story_name}」不存在"
 
@@ -411,6 +683,7 @@ class System:
             self.logger.error(f"切换剧本失败: {e}")
             return f"切换剧本失败: {str(e)}"
 
+    @traced()
     async def generate_scene_description(self) -> str:
         """生成当前场景的描述
         
@@ -418,7 +691,50 @@ class System:
             str: 场景描述
         """
         self.logger.info("开始生成场景描述")
+        version = self.get_state_version()
+        prompt = self._scene_description_prompt()
 
+        # 生成描述
+        try:
+            speculated = await self.speculation.take("des", version, prompt)
+            if speculated is not None:
+                description = speculated.value
+            else:
+                description = await self.llm_service.generate_response(prompt)
+            return self._finish_scene_description(description)
+        except Exception as e:
+            self.logger.error(f"生成场景描述时出错: {e}")
+            return f"生成场景描述失败：{str(e)}"
+
+    @traced()
+    async def generate_scene_description_stream(self):
+        """生成当前场景的描述（流式）
+
+        Yields:
+            str: 场景描述片段
+        """
+        self.logger.info("开始流式生成场景描述")
+        version = self.get_state_version()
+        prompt = self._scene_description_prompt()
+        chunks = []
+        try:
+            speculated = await self.speculation.take("des", version, prompt)
+            if speculated is not None:
+                chunks.append(speculated.value)
+                yield speculated.value
+            else:
+                async with aclosing(self.llm_service.stream_response(prompt)) as stream:
+                    async for chunk in stream:
+                        chunks.append(chunk)
+                        yield chunk
+            self._finish_scene_description("".join(chunks))
+        except Exception as e:
+            self.logger.error(f"生成场景描述时出错: {e}")
+            yield f"生成场景描述失败：{str(e)}"
+
+    @traced()
+    def _scene_description_prompt(self) -> str:
+        """构建场景描述提示"""
         # 获取当前世界和角色状态
         world_context = self.world.get_current_context()
         character_info = self.character.get_character_info_str()
@@ -444,23 +760,53 @@ class System:
 【建议】：给出三个系统帮助主角的简略建议，以减轻玩家的思考压力。
 
 请直接给出场景描述和建议："""
+        return prompt
 
-        # 生成描述
-        try:
-            description = await self.llm_service.generate_response(prompt)
-            ordinary_description = description
-            self.dialogue_history.append({
-                "system": "[生成场景描述]",
-                "character": "[场景描述，非角色回答]: " + description
-            })
-            history_des = description.replace('\n', ' ')
-            self.world.history.append(f"场景描述：{history_des}")
-            self.logger.info("场景描述生成成功")
-            return ordinary_description
-        except Exception as e:
-            self.logger.error(f"生成场景描述时出错: {e}")
-            return f"生成场景描述失败：{str(e)}"
-
+    def _finish_scene_description(self, description: str) -> str:
+        """记录场景描述到对话和世界历史"""
+        ordinary_description = description
+        self.dialogue_history.append({
+            "system": "[生成场景描述]",
+            "character": "[场景描述，非角色回答]: " + description
+        })
+        self._maybe_compact_dialogue()
+        history_des = description.replace('\n', ' ')
+        self.world.history.append(f"场景描述：{history_des}")
+        self.logger.info("场景描述生成成功")
+        self._schedule_speculation()
+        return ordinary_description
+
+    def _schedule_speculation(self):
+        """/st或/des完成后，在玩家阅读结果时预生成下一条/st和/des的结果（需通过SPECULATION开启）"""
+        if not self.started:
+            return
+        self.speculation.start("st", self._speculate_story)
+        self.speculation.start("des", self._speculate_scene_description)
+
+    async def _speculate_story(self) -> Optional[SpeculativeResult]:
+        """预生成默认时长的故事演进，不推进时间，也不修改其他状态"""
+        await self.jobs.join()  # 等待本条命令的后台状态更新
+        version = self.get_state_version()
+        current_time = shift_time(self.world.current_time, parse_standard_time_span(DEFAULT_STORY_SPAN))
+        prompt = self._story_prompt(DEFAULT_STORY_SPAN, current_time)
+        if self.get_state_version() != version:
+            return None  # 构建提示期间玩家执行了新的命令
+        self.speculation.prepare("st", version, prompt)
+        progress = await self.llm_service.generate_structured(prompt, StoryProgress)
+        return SpeculativeResult(version, prompt, progress)
+
+    async def _speculate_scene_description(self) -> Optional[SpeculativeResult]:
+        """预生成当前状态的场景描述，不修改状态"""
+        await self.jobs.join()
+        version = self.get_state_version()
+        prompt = self._scene_description_prompt()
+        if self.get_state_version() != version:
+            return None
+        self.speculation.prepare("des", version, prompt)
+        description = await self.llm_service.generate_response(prompt)
+        return SpeculativeResult(version, prompt, description)
+
+    @traced()
     async def save_game(self, save_name: str = "default", force: bool = False) -> str:
         """保存游戏状态
         
@@ -474,37 +820,36 @@ class System:
         self.logger.info(f"开始保存游戏状态到存档: {save_name}")
         if save_name == "default":
             force = True
-        save_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'save')
-        save_path = os.path.join(save_dir, f"{save_name}.json")
+        save_dir = self._save_dir()
+        os.makedirs(save_dir, exist_ok=True)
+        save_log = SaveLog(os.path.join(save_dir, save_name))
+        legacy_path = os.path.join(save_dir, f"{save_name}.json")
 
         # 检查存档是否已存在
-        if os.path.exists(save_path) and not force:
+        if (save_log.exists() or os.path.exists(legacy_path)) and not force:
             self.logger.warning(f"存档已存在: {save_name}")
             return f"存档「{save_name}」已存在，如需覆盖请使用/savef命令"
 
         try:
             # 构建存档数据
-            save_data = {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "story_name": self.current_story,
-                "energy": self.energy,
-                "dialogue_history": self.dialogue_history,
-                "dialogue_summaries": self.dialogue_summaries,
-                "qu_history": self.qu_history,
-                "world_state": self.world.get_save_data(),
-                "character_state": self.character.get_save_data()
-            }
-
-            # 保存到文件
-            with open(save_path, 'w', encoding='utf-8') as f:
-                json.dump(save_data, f, ensure_ascii=False, indent=2)
-
-            self.logger.info(f"游戏状态保存成功: {save_name}")
+            save_data = self.get_save_data()
+            snapshot = self.snapshots.capture(self, f"存档 {save_name}")
+            tracker = self._save_trackers.setdefault(save_name, SaveTracker())
+
+            # 只追加本次的增量，必要时写快照，在线程中执行避免阻塞事件循环
+            kind = await asyncio.to_thread(save_log.save, save_data, tracker)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)  # 已转换为新格式
+            await asyncio.to_thread(get_save_catalog().refresh, save_name)
+            self.snapshots.saved[save_name] = (tracker.revision, snapshot)
+
+            self.logger.info(f"游戏状态保存成功: {save_name}（{'快照' if kind == 'snapshot' else '增量'}）")
             return f"游戏状态已保存到存档「{save_name}」"
         except Exception as e:
             self.logger.error(f"保存游戏状态失败: {e}")
             return f"保存失败: {str(e)}"
 
+    @traced()
     async def load_game(self, save_name: str = "default") -> str:
         """加载游戏状态
         
@@ -516,32 +861,37 @@ class System:
         """
         self.logger.info(f"开始加载存档: {save_name}")
 
-        save_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'save', f"{save_name}.json")
+        save_log = SaveLog(os.path.join(self._save_dir(), save_name))
+        legacy_path = os.path.join(self._save_dir(), f"{save_name}.json")
 
-        if not os.path.exists(save_path):
+        if not save_log.exists() and not os.path.exists(legacy_path):
             self.logger.warning(f"存档不存在: {save_name}")
             return f"存档「{save_name}」不存在"
 
         try:
-            # 读取存档数据
-            with open(save_path, 'r', encoding='utf-8') as f:
-                save_data = json.load(f)
+            manifest = save_log.read_manifest()
+            saved = self.snapshots.saved.get(save_name)
+            if manifest is not None and saved is not None and saved[0] == manifest["revision"]:
+                # 存档自本会话保存后没有被修改，直接从内存快照恢复
+                saved[1].restore(self)
+                self.started = True
+                self._save_trackers[save_name] = SaveTracker(manifest["revision"], self.get_save_data())
+                self.logger.info(f"存档加载成功（内存快照）: {save_name}")
+                return f"已加载存档「{save_name}」，游戏状态已恢复"
 
-            # 恢复系统状态
-            self.current_story = save_data["story_name"]
-            self.energy = save_data["energy"]
-            self.dialogue_history = save_data["dialogue_history"]
-            self.dialogue_summaries = save_data["dialogue_summaries"]
-            self.qu_history = save_data["qu_history"]
-
-            # 恢复世界和角色状态
-            self.world = World(self.current_story)
-            self.world.load_save_data(save_data["world_state"])
-
-            self.character = Character(self.llm_service, self.current_story)
-            self.character.load_save_data(save_data["character_state"])
-
-            self.world.set_character(self.character)
+            # 读取存档数据
+            if manifest is not None:
+                save_data = await asyncio.to_thread(save_log.load)
+            else:
+                manifest = None
+                with open(legacy_path, 'r', encoding='utf-8') as f:
+                    save_data = json.load(f)
+
+            self.load_save_data(save_data)
+            self.started = True  # 加载存档后自动设置为started状态
+            if manifest is not None:
+                # 加载后的状态与存档一致，之后保存到同一存档时可以直接追加增量
+                self._save_trackers[save_name] = SaveTracker(manifest["revision"], self.get_save_data())
 
             self.logger.info(f"存档加载成功: {save_name}")
             return f"已加载存档「{save_name}」，游戏状态已恢复"
@@ -549,31 +899,160 @@ class System:
             self.logger.error(f"加载存档失败: {e}")
             return f"加载失败: {str(e)}"
 
-    def list_saves(self) -> str:
-        """列出所有存档
-        
+    def checkpoint(self, label: str) -> GameSnapshot:
+        """执行会修改状态的命令前记录撤销点
+
+        Args:
+            label: 撤销点说明，一般为命令内容
+
+        Returns:
+            GameSnapshot: 命令执行前的状态，命令没有执行完时传给rollback
+        """
+        return self.snapshots.checkpoint(self, label)
+
+    def rollback(self, snapshot: GameSnapshot):
+        """命令没有执行完（客户端断开或出错）时恢复到命令执行前的状态
+
+        命令要么完整执行，要么不留下任何修改：执行到一半时已推进的时间、已记录的历史等都会撤回，
+        /undo也不会多出这条命令的撤销点。
+
+        Args:
+            snapshot: checkpoint返回的快照
+        """
+        self.snapshots.rollback(self, snapshot)
+        self.logger.info(f"命令没有执行完，已回滚: {snapshot.label}")
+
+    def undo(self) -> str:
+        """撤销上一条修改状态的命令
+
+        Returns:
+            str: 撤销结果
+        """
+        snapshot = self.snapshots.pop_undo()
+        if snapshot is None:
+            return "没有可以撤销的操作"
+        snapshot.restore(self)
+        self.logger.info(f"已撤销: {snapshot.label}")
+        return f"已撤销「{snapshot.label}」，剩余可撤销{len(self.snapshots.undo_stack)}步"
+
+    def create_branch(self, name: str) -> str:
+        """把当前状态保存为命名分支
+
+        Args:
+            name: 分支名称
+
+        Returns:
+            str: 创建结果
+        """
+        self.snapshots.add_branch(name, self.snapshots.capture(self, f"分支 {name}"))
+        self.logger.info(f"创建分支: {name}")
+        return f"已将当前状态保存为分支「{name}」，使用 /checkout {name} 切换回来"
+
+    def checkout_branch(self, name: str) -> str:
+        """切换到命名分支，切换前的状态可以用/undo恢复
+
+        Args:
+            name: 分支名称
+
+        Returns:
+            str: 切换结果
+        """
+        snapshot = self.snapshots.branches.get(name)
+        if snapshot is None:
+            return f"分支「{name}」不存在"
+        self.checkpoint(f"/checkout {name}")
+        snapshot.restore(self)
+        self.logger.info(f"切换到分支: {name}")
+        return f"已切换到分支「{name}」"
+
+    def list_branches(self) -> str:
+        """列出当前会话的分支
+
+        Returns:
+            str: 分支列表信息
+        """
+        branches = self.snapshots.list_branches()
+        if not branches:
+            return "当前没有任何分支，使用 /branch <名称> 保存当前状态"
+        result = "【分支列表】\n"
+        for name, snapshot in branches:
+            result += f"- {name}\n"
+            result += f"  剧本：{snapshot.values['story_name']}，世界时间：{snapshot.values['current_time']}\n"
+        return result
+
+    @staticmethod
+    def _save_dir() -> str:
+        return DEFAULT_SAVE_DIR
+
+    def get_save_data(self) -> dict:
+        """获取需要保存的系统状态数据
+
+        Returns:
+            dict: 系统状态数据，包含世界和角色状态
+        """
+        return {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "story_name": self.current_story,
+            "energy": self.energy,
+            "dialogue_history": self.dialogue_history,
+            "dialogue_summaries": self.dialogue_summaries,
+            "qu_history": self.qu_history,
+            "archive_id": self.archive_id,
+            "world_state": self.world.get_save_data(),
+            "character_state": self.character.get_save_data()
+        }
+
+    def load_save_data(self, save_data: dict):
+        """从存档数据恢复系统状态
+
+        Args:
+            save_data: 存档数据
+        """
+        # 恢复系统状态
+        self.current_story = save_data["story_name"]
+        self.energy = save_data["energy"]
+        self.dialogue_history = save_data["dialogue_history"]
+        self.dialogue_summaries = save_data["dialogue_summaries"]
+        self.qu_history = save_data["qu_history"]
+        self.archive_id = save_data.get("archive_id", self.archive_id)
+
+        # 恢复世界和角色状态
+        self.world = World(self.llm_service, self.current_story)
+        self.world.load_save_data(save_data["world_state"])
+
+        self.character = Character(self.llm_service, self.current_story)
+        self.character.load_save_data(save_data["character_state"])
+
+        self.world.set_character(self.character)
+
+    def list_saves(self, page: int = 1, sort: str = "time") -> str:
+        """分页列出存档
+
+        存档信息从存档索引读取，只有新增或修改过的存档才会读取manifest。
+
+        Args:
+            page: 页码，从1开始
+            sort: 排序方式，time（保存时间，新的在前）、name（存档名）或story（剧本名）
+
         Returns:
             str: 存档列表信息
         """
-        self.logger.info("获取存档列表")
+        self.logger.info(f"获取存档列表，第{page}页，排序: {sort}")
 
-        save_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'save')
-        saves = []
+        if sort not in SORT_ORDERS:
+            return f"不支持的排序方式：{sort}，可选：{'、'.join(SORT_ORDERS)}"
+        page_size = int(os.getenv('SAVE_PAGE_SIZE', '20'))
 
         try:
-            for file in os.listdir(save_dir):
-                if file.endswith('.json'):
-                    save_path = os.path.join(save_dir, file)
-                    with open(save_path, 'r', encoding='utf-8') as f:
-                        save_data = json.load(f)
-                    saves.append({
-                        "name": file[:-5],
-                        "time": save_data["timestamp"],
-                        "story": save_data["story_name"]
-                    })
+            catalog = get_save_catalog()
+            catalog.sync()
+            saves, total = catalog.page(page, page_size, sort)
 
-            if not saves:
+            if total == 0:
                 return "当前没有任何存档"
+            pages = (total + page_size - 1) // page_size
+            if not saves:
+                return f"共{total}个存档，{pages}页，第{page}页没有存档"
 
             # 格式化输出
             result = "【存档列表】\n"
@@ -581,6 +1060,9 @@ class System:
                 result += f"- {save['name']}\n"
                 result += f"  创建时间：{save['time']}\n"
                 result += f"  剧本：{save['story']}\n"
+            result += f"\n第{page}/{pages}页，共{total}个存档"
+            if page < pages:
+                result += f"，使用 /ls {page + 1} {sort} 查看下一页"
 
             return result
         except Exception as e:
@@ -602,10 +1084,13 @@ class System:
 /save [存档名] - 保存游戏状态，默认存档名为default, 如果已经对应存档，则会提示无法保存，可以使用/savef保存。此外，default为快速存档，总是可以被覆盖。
 /savef [存档名] - 强制保存游戏状态，会覆盖已有存档
 /load [存档名] - 加载游戏状态，默认加载default存档
-/ls - 显示所有存档
+/ls [页码] [time|name|story] - 分页显示存档，默认按保存时间从新到旧排序
 /start - 开始游戏，显示玩法说明并进入开始场景
 /help - 显示此帮助信息
 /reset - 重置当前游戏状态
+/undo - 撤销上一条修改状态的命令
+/branch [名称] - 把当前状态保存为分支，不带名称时列出所有分支
+/checkout <名称> - 切换到指定分支，切换前的状态可以用/undo恢复
 
 故事控制：
 /story - 显示可用剧本列表
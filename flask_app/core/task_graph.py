@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncio
+from .logger import setup_logger
+from .tracing import tracer
+
+
+class _Step:
+    def __init__(self, name: str, run: Callable[[], Awaitable[Any]], commit: Optional[Callable[[Any], Any]]):
+        self.name = name
+        self.run = run
+        self.commit = commit
+
+
+class TaskGraph:
+    def __init__(self, name: str):
+        self.logger = setup_logger('TaskGraph')
+        """一条命令内部相互独立的LLM步骤
+
+        每个步骤只计算结果，不修改游戏状态，所有步骤并发执行。全部步骤成功后再按声明顺序调用各步骤的commit写入状态；
+        任一步骤失败时取消其余步骤，不提交任何状态。
+
+        Args:
+            name: 命令名称，用于日志和追踪
+        """
+        self.name = name
+        self._steps: "OrderedDict[str, _Step]" = OrderedDict()
+
+    def add(self, name: str, run: Callable[[], Awaitable[Any]], commit: Callable[[Any], Any] = None) -> "TaskGraph":
+        """声明一个步骤
+
+        Args:
+            name: 步骤名称
+            run: 返回协程的无参函数
+            commit: 可选，全部步骤成功后以本步骤的结果调用，用于写入状态
+
+        Returns:
+            TaskGraph: 自身，便于链式声明
+        """
+        if name in self._steps:
+            raise ValueError(f"重复的步骤: {name}")
+        self._steps[name] = _Step(name, run, commit)
+        return self
+
+    async def run(self) -> Dict[str, Any]:
+        """执行所有步骤并按声明顺序提交
+
+        Returns:
+            dict: 步骤名称 -> 步骤结果
+        """
+        with tracer.span("task_graph", graph=self.name, steps=len(self._steps)):
+            tasks = {name: asyncio.ensure_future(self._run_step(step)) for name, step in self._steps.items()}
+            try:
+                await asyncio.gather(*tasks.values())
+            except BaseException:
+                for task in tasks.values():
+                    task.cancel()
+                # 等待被取消的步骤结束，避免留下仍在运行的LLM调用
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+                raise
+
+            results = {name: task.result() for name, task in tasks.items()}
+            for step in self._steps.values():
+                if step.commit is not None:
+                    step.commit(results[step.name])
+            return results
+
+    async def _run_step(self, step: _Step):
+        with tracer.span(f"step {step.name}", graph=self.name):
+            self.logger.debug(f"{self.name}: 开始步骤{step.name}")
+            return await step.run()
@@ -0,0 +1,282 @@
+from collections import defaultdict, deque
+from contextlib import aclosing, contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+import asyncio
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+
+# 当前活动的span，随协程/线程上下文传递，用于建立父子关系
+_current_span: ContextVar[Optional["Span"]] = ContextVar('current_span', default=None)
+
+# 延迟直方图的桶边界（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 按span名称和模型累加的数值属性
+COUNTED_ATTRIBUTES = ("prompt_tokens", "completion_tokens", "retries", "queue_wait")
+
+# 这些异常表示调用方放弃了操作（如客户端断开），记为取消而不是错误
+_CANCELLATIONS = (GeneratorExit, asyncio.CancelledError)
+
+_UNSET = object()
+
+
+class Span:
+    """一次操作的耗时记录"""
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Dict[str, Any] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        """设置属性"""
+        self.attributes.update(attributes)
+
+    def incr(self, key: str, value: float = 1):
+        """累加数值属性"""
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class SpanMetrics:
+    """按span名称聚合的指标，以Prometheus文本格式输出"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, List[float]] = {}  # name -> [各桶计数..., count, sum]
+        self._errors: Dict[str, int] = defaultdict(int)
+        self._counters: Dict[tuple, float] = defaultdict(float)  # (属性, span名称, 模型) -> 累计值
+
+    def observe(self, span: Span):
+        with self._lock:
+            histogram = self._histograms.setdefault(span.name, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += span.duration
+            if span.error:
+                self._errors[span.name] += 1
+            model = span.attributes.get("model")
+            if model is None:
+                return
+            self._counters[("requests", span.name, model)] += 1
+            if span.attributes.get("cache_hit"):
+                self._counters[("cache_hits", span.name, model)] += 1
+            for key in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(key)
+                if isinstance(value, (int, float)):
+                    self._counters[(key, span.name, model)] += value
+
+    def render(self, prefix: str = "systemcome") -> str:
+        """输出Prometheus文本格式"""
+        lines = [
+            f"# HELP {prefix}_span_duration_seconds Wall time of traced operations.",
+            f"# TYPE {prefix}_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                label = _escape_label(name)
+                for i, bound in enumerate(self.buckets):
+                    lines.append(f'{prefix}_span_duration_seconds_bucket{{span="{label}",le="{bound}"}} {histogram[i]}')
+                lines.append(f'{prefix}_span_duration_seconds_bucket{{span="{label}",le="+Inf"}} {histogram[-2]}')
+                lines.append(f'{prefix}_span_duration_seconds_count{{span="{label}"}} {histogram[-2]}')
+                lines.append(f'{prefix}_span_duration_seconds_sum{{span="{label}"}} {histogram[-1]:.6f}')
+
+            lines.append(f"# HELP {prefix}_span_errors_total Traced operations that raised.")
+            lines.append(f"# TYPE {prefix}_span_errors_total counter")
+            for name, count in sorted(self._errors.items()):
+                lines.append(f'{prefix}_span_errors_total{{span="{_escape_label(name)}"}} {count}')
+
+            by_metric = defaultdict(list)
+            for (key, name, model), value in self._counters.items():
+                by_metric[key].append((name, model, value))
+        for key in ("requests", "cache_hits") + COUNTED_ATTRIBUTES:
+            metric = f"{prefix}_llm_{key}_seconds_total" if key == "queue_wait" else f"{prefix}_llm_{key}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for name, model, value in sorted(by_metric.get(key, [])):
+                lines.append(f'{metric}{{span="{_escape_label(name)}",model="{_escape_label(model)}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Tracer:
+    def __init__(self, export_path: str = None, buffer_size: int = 1000):
+        """初始化追踪器
+
+        结束的span会进入内存环形缓冲区并聚合为指标；设置了export_path时同时以JSON行追加写入文件。
+
+        Args:
+            export_path: JSON行导出文件路径，为空时不写文件
+            buffer_size: 内存中保留的最近span数量
+        """
+        self.export_path = export_path
+        self.metrics = SpanMetrics()
+        self._recent = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._export_file = None
+
+    def start_span(self, name: str, parent=_UNSET, **attributes) -> Span:
+        """开始一个span（不设为当前span），默认以当前span为父span"""
+        if parent is _UNSET:
+            parent = _current_span.get()
+        return Span(name, parent, attributes)
+
+    def finish(self, span: Span, error: BaseException = None):
+        """结束span，记录耗时并导出"""
+        if span.duration is not None:
+            return
+        span.duration = time.perf_counter() - span._start
+        if isinstance(error, _CANCELLATIONS):
+            span.set(cancelled=True)
+        elif error is not None and span.error is None:
+            span.error = f"{type(error).__name__}: {error}"
+        self.metrics.observe(span)
+        with self._lock:
+            self._recent.append(span)
+            if self.export_path:
+                self._export(span)
+
+    def _export(self, span: Span):
+        try:
+            if self._export_file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.export_path)), exist_ok=True)
+                self._export_file = open(self.export_path, 'a', encoding='utf-8')
+            self._export_file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+            self._export_file.flush()
+        except OSError:
+            self.export_path = None
+
+    @contextmanager
+    def activate(self, span: Span):
+        """在上下文内把span设为当前span"""
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+
+    @contextmanager
+    def span(self, name: str, parent=_UNSET, **attributes):
+        """记录一段同步或异步代码的span
+
+        用法：
+            with tracer.span("System.save_game", save_name=name) as span:
+                ...
+        """
+        span = self.start_span(name, parent, **attributes)
+        error = None
+        try:
+            with self.activate(span):
+                yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.finish(span, error)
+
+    def recent(self, limit: int = 100) -> List[Span]:
+        """最近结束的span"""
+        with self._lock:
+            return list(self._recent)[-limit:]
+
+
+def current_span() -> Optional[Span]:
+    """获取当前span，不在任何span内时返回None"""
+    return _current_span.get()
+
+
+async def activate_stream(span: Span, agen):
+    """逐步推进异步生成器，每一步都把span设为当前span
+
+    异步生成器在两次yield之间可能运行在不同的任务（上下文）中（如WSGI模式下每一步都在新任务中驱动），
+    不能跨yield保持span激活，因此每次推进时重新激活，保证生成器内发起的调用挂在该span下。
+
+    Args:
+        span: 要激活的span，不会在这里结束
+        agen: 异步生成器
+    """
+    try:
+        while True:
+            with tracer.activate(span):
+                try:
+                    chunk = await agen.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield chunk
+    finally:
+        with tracer.activate(span):
+            await agen.aclose()
+
+
+def traced(name: str = None):
+    """为函数、协程函数或异步生成器函数记录span的装饰器
+
+    Args:
+        name: span名称，默认为函数的限定名（如System.communicate）
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def agen_wrapper(*args, **kwargs):
+                span = tracer.start_span(span_name)
+                error = None
+                try:
+                    async with aclosing(activate_stream(span, func(*args, **kwargs))) as stream:
+                        async for chunk in stream:
+                            yield chunk
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    tracer.finish(span, error)
+            return agen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+# 进程级追踪器，TRACE_EXPORT_PATH设置时把span以JSON行导出到该文件
+tracer = Tracer(os.getenv('TRACE_EXPORT_PATH', ''), int(os.getenv('TRACE_BUFFER_SIZE', '1000')))
@@ -1,10 +1,14 @@
 from typing import List, Dict
 from datetime import datetime
 import json
-import os
-from .logger import setup_logger
-from .utils import read_story_file_to_dict
-from .llm_service import LLMService
+from .logger import setup_logger, log_text
+from .story_registry import get_story_registry
+from .context_builder import ContextBuilder
+from .retrieval import BM25Index
+from .tracing import traced
+from .local_rules import parse_time_span, parse_standard_time_span, shift_time, fast_path_stats
+from .section_patch import patch_document
+from .llm_service import LLMService, DEFAULT_CACHE_TTL
 
 class World:
     def __init__(self, llm_service:LLMService, story_name: str = None):
@@ -14,15 +18,10 @@ class World:
         # 读取初始化配置
         self.llm_service = llm_service
         self.current_time = datetime.now()  # 默认使用当前时间
-        base_dir = os.path.dirname(os.path.dirname(__file__))
-        if story_name:
-            story_path = os.path.join(base_dir, 'story', story_name, 'world_init.txt')
-        else:
-            story_path = os.path.join(base_dir, 'story', 'world_init.txt')
-            
         try:
-            init_data = read_story_file_to_dict(story_path)
-            self.logger.info(f"成功加载世界初始化配置: {story_path}")
+            # 剧本文件由注册表解析并缓存，这里只读取，不修改
+            init_data = get_story_registry().load(story_name, 'world_init.txt')
+            self.logger.info(f"成功加载世界初始化配置: {story_name}")
         except Exception as e:
             self.logger.error(f"加载世界初始化配置失败: {e}")
             # 如果加载失败，使用默认配置
@@ -37,6 +36,7 @@ class World:
         self.history: List[str] = init_data.get("世界事件","无").split("\n")  # 历史事件记录
         self.story_readme = init_data.get("玩法说明","无")
         self.character = None  # 将由System类注入主角引用
+        self.history_index = BM25Index()  # 历史事件检索索引，查询时增量同步
         
         # 从初始化数据中提取时间
         time_str = init_data.get("初始时间").strip()
@@ -48,6 +48,7 @@ class World:
             except Exception as e:
                 self.logger.error(f"解析初始时间失败: {e}")
 
+    @traced()
     async def apply_change(self, change_prompt: str) -> str:
         self.logger.info(f"应用世界变更: {change_prompt}")
         """应用世界变更
@@ -63,6 +64,14 @@ class World:
 
         self.history.append(event)
 
+        # 优先只让LLM输出受影响的分块，在本地合并
+        updated_background = await patch_document(self.llm_service, self.background, change_prompt, "世界背景")
+        if updated_background is not None:
+            self.background = updated_background
+            log_text(self.logger, "按分块更新后的世界背景", self.background)
+            return f"世界状态已更新：{change_prompt}"
+        self.logger.warning("分块更新格式不合法，回退到完整重写世界背景")
+
         prompt = f"""
 下面是当前的世界情况：
 ---
@@ -89,48 +98,30 @@ class World:
         updated_profile = await self.llm_service.generate_response(prompt)
         updated_profile = updated_profile.replace("#", "").replace("---", "")
         self.background = updated_profile
-        self.logger.debug(f"更新后的档案: {self.background}")
+        log_text(self.logger, "更新后的档案", self.background)
 
         return f"世界状态已更新：{change_prompt}"
 
-    async def advance_time(self, time_str: str) -> str:
+    @traced()
+    async def advance_time(self, time_str: str, use_llm: bool = True) -> str:
         """推进世界时间
         
         Args:
             time_str: 时间增量字符串，格式如 1s, 1m, 1h, 1d, 1w, 1M, 1y
             也支持自然语言描述，如"三天后"、"下周"等
+            use_llm: 本地规则无法解析时是否使用LLM解析
             
         Returns:
             str: 更新后的时间字符串
         """
         self.logger.info(f"推进世界时间: {time_str}")
-        
-        # 先尝试标准格式解析
-        try:
-            unit = time_str[-1]
-            value = int(time_str[:-1])
-            
-            # 根据单位推进时间
-            if unit == 's':  # 秒
-                self.current_time = self.current_time.replace(second=self.current_time.second + value)
-            elif unit == 'm':  # 分钟
-                self.current_time = self.current_time.replace(minute=self.current_time.minute + value)
-            elif unit == 'h':  # 小时
-                self.current_time = self.current_time.replace(hour=self.current_time.hour + value)
-            elif unit == 'd':  # 天
-                self.current_time = self.current_time.replace(day=self.current_time.day + value)
-            elif unit == 'w':  # 周
-                self.current_time = self.current_time.replace(day=self.current_time.day + value * 7)
-            elif unit == 'M':  # 月
-                self.current_time = self.current_time.replace(month=self.current_time.month + value)
-            elif unit == 'y':  # 年
-                self.current_time = self.current_time.replace(year=self.current_time.year + value)
-            else:
-                raise ValueError(f"未知的时间单位: {unit}")
-                
-        except (ValueError, IndexError):
-            self.logger.info(f"标准格式解析失败，尝试使用LLM解析时间: {time_str}")
-            # 使用LLM解析时间
+
+        # 标准格式和常见的中文时间描述用本地规则解析
+        span = parse_time_span(time_str)
+        if use_llm:
+            fast_path_stats.record("time", span is not None)
+        if span is None and use_llm:
+            self.logger.info(f"本地规则无法解析，尝试使用LLM解析时间: {time_str}")
             prompt = f"""
 当前时间是: {self.current_time.strftime("%Y-%m-%d %H:%M:%S")}
 用户输入的时间描述是: {time_str}
@@ -146,35 +137,74 @@ class World:
 请直接返回转换后的格式，不要包含任何解释："""
 
             try:
-                result = await self.llm_service.generate_response(prompt,use_small_model=True)
+                # 解析结果与当前时间无关，按时间描述本身缓存
+                result = await self.llm_service.generate_response(
+                    prompt, use_small_model=True, cache_ttl=DEFAULT_CACHE_TTL, cache_key=f"时间解析:{time_str}")
                 result = result.strip()
                 self.logger.info(f"LLM解析结果: {result}")
-                
-                # 递归调用自身处理LLM解析后的标准格式
-                return await self.advance_time(result)
+                span = parse_standard_time_span(result)
             except Exception as e:
                 self.logger.error(f"LLM解析时间失败: {e}")
                 return str(self.current_time)
-            
+
+        if span is None:
+            self.logger.error(f"无法解析时间: {time_str}")
+            return str(self.current_time)
+        self.current_time = shift_time(self.current_time, span)
         return str(self.current_time)
 
-    def get_current_context(self, length=100, show_hide_info=False) -> str:
+    def get_current_context(self, length=100, show_hide_info=False, token_budget=None, current_time=None) -> str:
         self.logger.debug("获取当前世界状态")
         """获取当前完整世界状态
 
         Args:
             length: 返回的历史事件数量
+            token_budget: 可选，世界背景和历史事件的token预算，超出时省略较早的历史事件
+            current_time: 可选，代替当前时间写入上下文，用于在不推进时间的情况下预先构建提示
 
         Returns:
             Dict: 包含当前状态和相关历史的上下文
         """
         # 获取最近的历史事件
         recent_history = self.history[-length:] if self.history else []
-        history_info = "\n".join(recent_history)
+        if token_budget is None:
+            history_info = "\n".join(recent_history)
+        else:
+            builder = ContextBuilder(token_budget)
+            builder.add_text("background", self.background, 0, required=True)
+            builder.add_items("history", recent_history, 1)
+            history_info = builder.build()["history"]
+            if builder.omitted.get("history"):
+                self.logger.debug(f"超出token预算，省略{builder.omitted['history']}条较早的历史事件")
+
+        return self._format_context(history_info, current_time)
+
+    def get_relevant_context(self, query: str, top_k: int = 20, recent: int = 10) -> str:
+        """获取与查询相关的世界状态
 
+        历史事件只包含最近的若干条和检索到的最相关的若干条，按时间顺序排列。
+
+        Args:
+            query: 查询内容
+            top_k: 检索的相关历史事件数量
+            recent: 始终包含的最近历史事件数量
+
+        Returns:
+            str: 世界状态上下文
+        """
+        self.history_index.sync(self.history)
+        hits = self.history_index.search(query, top_k)
+        indices = {doc_id for doc_id, _ in hits}
+        indices.update(range(max(0, len(self.history) - recent), len(self.history)))
+        history_info = "\n".join(self.history[i] for i in sorted(indices))
+        self.logger.debug(f"检索到{len(hits)}条相关历史事件，共{len(self.history)}条")
+        return self._format_context(history_info)
+
+    def _format_context(self, history_info: str, current_time=None) -> str:
+        """格式化世界状态上下文"""
         info = f"""
 [[当前时间]]：
-{self.current_time.strftime("%Y-%m-%d %H:%M:%S")}
+{(current_time or self.current_time).strftime("%Y-%m-%d %H:%M:%S")}
 
 [[世界背景]]：
 {self.background}
@@ -1,4 +1,5 @@
 #Deployment commands： gunicorn chatGPT_Web:app -c gunicorn_config.py
+# ASGI模式（每个worker一个常驻事件循环）不使用本配置：uvicorn system_come_asgi:app --host 0.0.0.0 --port 8880 --workers 3
 
 bind = '0.0.0.0:8880'    # your IP:PORT
 worker_class = 'gevent'  
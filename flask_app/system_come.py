@@ -1,18 +1,50 @@
 from flask import Flask, request, render_template, Response
-from core import System
+from core.provider_pool import close_loop_clients
+from core.tracing import tracer
+from web_common import (logger, get_session_id, with_session_cookie, command_name, stats_payload, metrics_text,
+                        traces_body, error_events, sse_events, handle_chat, handle_stream_message)
+import asyncio
+import functools
 import json
-from core.logger import setup_logger
 import logging
 
-# 初始化日志记录器
-logger = setup_logger('WebApp')
-
+# WSGI服务方式：每个请求在独立的事件循环中执行异步视图，LLM客户端随事件循环创建和关闭，连接不会跨请求复用。
+# 需要常驻事件循环和连接池复用时使用system_come_asgi.py
 app = Flask(__name__)
-
-# 初始化系统
-system = System()
 logger.info("系统初始化完成")
-started = False
+
+
+def closes_llm_clients(view):
+    """异步视图运行在每个请求独立的事件循环中，返回前关闭本事件循环创建的LLM客户端"""
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await view(*args, **kwargs)
+        finally:
+            await close_loop_clients()
+    return wrapper
+
+
+def iterate_async(agen):
+    """在独立的事件循环中驱动异步生成器，转换为同步生成器供Response流式返回"""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        # 客户端断开时服务器关闭本生成器，关闭异步生成器链，取消尚未完成的LLM调用
+        loop.run_until_complete(agen.aclose())
+        # 等待仍在运行的任务结束：其他请求仍在订阅的共享LLM调用运行在本事件循环中，
+        # 最后一个订阅者离开时会取消它
+        tasks = asyncio.all_tasks(loop)
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks))
+        loop.run_until_complete(close_loop_clients())  # 释放本事件循环的连接池
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
 
 
 @app.route('/')
@@ -22,9 +54,29 @@ def index():
     return render_template('chat.html')
 
 
+@app.route('/stats')
+def stats():
+    """返回会话、LLM并发队列和进程内存的统计信息"""
+    return Response(stats_payload(), mimetype='application/json')
+
+
+@app.route('/metrics')
+def metrics():
+    """以Prometheus文本格式返回各操作的耗时分布、LLM调用统计和当前并发状态"""
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/traces')
+def traces():
+    """以JSON行返回最近结束的span，可用limit参数指定数量"""
+    return Response(traces_body(request.args.get('limit', 100, type=int)), mimetype='application/x-ndjson')
+
+
 @app.route('/chat', methods=['POST'])
+@closes_llm_clients
 async def chat():
     """处理普通对话请求"""
+    session_id = get_session_id(request)
     try:
         data = request.get_json()
         message = data.get('query', '')
@@ -32,144 +84,44 @@ async def chat():
         logging.info(f"Received message: {message}")
 
         # 普通对话
-        response = await system.communicate(message)
+        response, trace_id = await handle_chat(session_id, message)
         logger.info("对话请求处理成功")
-        return json.dumps({"response": response})
+        response = with_session_cookie(Response(json.dumps({"response": response})), session_id)
+        response.headers['X-Trace-Id'] = trace_id
+        return response
 
     except Exception as e:
         logger.error(f"处理对话请求时出错: {str(e)}", exc_info=True)
-        return json.dumps({"error": str(e)})
+        return with_session_cookie(Response(json.dumps({"error": str(e)})), session_id)
 
 
 @app.route('/chatstream', methods=['GET', 'POST'])
+@closes_llm_clients
 async def chat_stream():
     """处理流式对话请求"""
-    global started
+    session_id = get_session_id(request)
+    # 请求span覆盖到流式响应结束，在sse_events中结束
+    span = tracer.start_span("/chatstream", session_id=session_id)
     try:
-        logger.info("收到流式对话请求")
         if request.method == 'POST':
             data = request.get_json()
             message = data.get('query', '')
         else:
             message = request.args.get('query', '')
-
-        if message.startswith('/story'):
-            if len(message) > 6:
-                story_name = message[6:].strip()
-                response = await system.switch_story(story_name)
-                started = False  # 切换剧本后，需要重新/start
-                logger.info(f"切换剧本成功: {story_name}")
-            else:
-                # 获取可用剧本列表
-                stories = system.get_available_stories()
-                response = "可用剧本列表：\n" + "\n".join([f"- {story}" for story in stories])
-                logger.info("获取剧本列表成功")
-        elif message == '/help':
-            response = system.get_help_info()
-            logger.info("获取帮助信息成功")
-        elif message.startswith('/load'):
-            save_name = message[5:].strip() if len(message) > 5 else ""
-            if save_name == "":
-                response = await system.load_game()
-            else:
-                response = await system.load_game(save_name)
-            started = True  # 加载存档后自动设置为started状态
-            logger.info(f"加载游戏状态: {save_name}")
-        elif message == '/ls':
-            response = system.list_saves()
-            logger.info("获取存档列表")
-        elif not started:
-            if message == "/start":
-                started = True
-                response = f"{system.world.story_readme}\n\n"
-                response += "\n\n【作为玩家的你将扮演系统，你可以向主角发布对话、修改世界任务状态，或者推动故事发展。】\n【即将进入开始场景，请尽情发挥你的想象力帮助主角或者...】\n\n---\n\n"
-                response += await system.generate_scene_description()
-                logger.info("生成开始场景")
-            else:
-                response = "选择剧本，并点击 /start 开始游戏"
-        else:
-            # 处理特殊指令
-            if message.startswith('/'):
-                if message.startswith('/md '):
-                    modification = message[3:].strip()
-                    response = await system.modify_state(modification)
-                    logger.info("修改世界状态")
-                elif message.startswith('/qu '):
-                    query = message[3:].strip()
-                    response = await system.confirm_world_state(query)
-                    logger.info("查询世界状态")
-                elif message.startswith('/st'):
-                    if len(message) > 3:
-                        query = message[3:].strip()
-                    else:
-                        query = ""
-                    response = await system.advance_story(query)
-                    logger.info("故事演进")
-                elif message == '/th':
-                    response = system.character.get_current_thoughts()
-                    logger.info("获取主角心理活动成功")
-                elif message == '/en':
-                    logger.info(f"查询系统能量成功: {system.energy}")
-                    response = f"当前系统能量：{system.energy}"
-                elif message == '/ch':
-                    response = system.character.get_character_info_str()
-                    logger.info("获取角色信息成功")
-                elif message == '/world':
-                    response = system.world.story_readme
-                    logger.info("获取世界信息成功")
-                    logger.info("更新角色档案成功")
-                elif message == '/world_info':
-                    response = system.world.get_world_info()
-                    logger.info("获取世界信息成功")
-                    logger.info("更新角色档案成功")
-                elif message == '/des':
-                    response = await system.generate_scene_description()
-                    logger.info("生成场景描述成功")
-                elif message == '/reset':
-                    response = await system.reset()
-                    started = False  # 重置游戏状态后，需要重新/start
-                    logger.info("重置游戏状态成功")
-                elif message.startswith('/savef'):
-                    save_name = message[6:].strip() if len(message) > 6 else ""
-                    if save_name == "":
-                        response = await system.save_game(force=True)
-                    else:
-                        response = await system.save_game(save_name, force=True)
-                    logger.info(f"强制保存游戏状态: {save_name}")
-                elif message.startswith('/save'):
-                    save_name = message[5:].strip() if len(message) > 5 else ""
-                    if save_name == "":
-                        response = await system.save_game()
-                    else:
-                        response = await system.save_game(save_name)
-                    logger.info(f"保存游戏状态: {save_name}")
-                else:
-                    logger.warning(f"收到未知指令: {message}")
-                    response = "无效指令请重新输入"
-            else:
-                # 支持普通对话
-                response = await system.communicate(message)
-
-        # 流式返回
-        def generate():
-            # 普通响应转换为流式
-            yield 'data: {}\n\n'.format(json.dumps({'content': response}))
-            yield 'data: {}\n\n'.format(json.dumps({'conversation_id': ""}))
-            yield 'data: {}\n\n'.format(json.dumps({'content': '[DONE]'}))
-
-        logger.info(f"开始流式响应:{response}")
-        return Response(generate(), mimetype='text/event-stream')
-
+        span.name = f"/chatstream {command_name(message)}"
+        with tracer.activate(span):
+            response, stream = await handle_stream_message(session_id, message)
     except Exception as e:
         logger.error(f"处理流式对话请求时出错: {str(e)}", exc_info=True)
-
-        def generate():
-            # 普通响应转换为流式
-            yield f"data: Error: {str(e)}\n\n"
-            yield 'data: {}\n\n'.format(json.dumps({'conversation_id': ""}))
-            yield 'data: {}\n\n'.format(json.dumps({'content': '[DONE]'}))
-
-        return Response(generate(), mimetype='text/event-stream')
+        tracer.finish(span, e)
+        return with_session_cookie(Response(error_events(session_id, str(e)), mimetype='text/event-stream'),
+                                   session_id)
+
+    # 流式返回
+    events = iterate_async(sse_events(session_id, response, stream, span))
+    response = with_session_cookie(Response(events, mimetype='text/event-stream'), session_id)
+    response.headers['X-Trace-Id'] = span.trace_id
+    return response
 
 
 if __name__ == '__main__':
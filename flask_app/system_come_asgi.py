@@ -0,0 +1,97 @@
+"""ASGI服务方式（Quart）
+
+与system_come.py提供相同的路由，但每个worker只有一个常驻事件循环：所有请求共享同一个AsyncOpenAI客户端
+和连接池，流式响应由服务器直接发送异步生成器的输出，不再为每个请求创建事件循环和线程。
+
+部署：
+    uvicorn system_come_asgi:app --host 0.0.0.0 --port 8880 --workers 3
+本地调试：
+    python system_come_asgi.py
+"""
+from quart import Quart, request, render_template, Response
+from core.tracing import tracer
+from web_common import (logger, get_session_id, with_session_cookie, command_name, stats_payload, metrics_text,
+                        traces_body, error_events, sse_events, handle_chat, handle_stream_message)
+import json
+
+app = Quart(__name__)
+logger.info("系统初始化完成（ASGI）")
+
+
+@app.route('/')
+async def index():
+    """渲染聊天界面"""
+    logger.info("访问主页")
+    return await render_template('chat.html')
+
+
+@app.route('/stats')
+async def stats():
+    """返回会话、LLM并发队列和进程内存的统计信息"""
+    return Response(stats_payload(), mimetype='application/json')
+
+
+@app.route('/metrics')
+async def metrics():
+    """以Prometheus文本格式返回各操作的耗时分布、LLM调用统计和当前并发状态"""
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/traces')
+async def traces():
+    """以JSON行返回最近结束的span，可用limit参数指定数量"""
+    return Response(traces_body(request.args.get('limit', 100, type=int)), mimetype='application/x-ndjson')
+
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    """处理普通对话请求"""
+    session_id = get_session_id(request)
+    try:
+        data = await request.get_json()
+        message = data.get('query', '')
+        logger.info(f"收到聊天请求: {message}")
+
+        response, trace_id = await handle_chat(session_id, message)
+        logger.info("对话请求处理成功")
+        response = with_session_cookie(Response(json.dumps({"response": response})), session_id)
+        response.headers['X-Trace-Id'] = trace_id
+        return response
+
+    except Exception as e:
+        logger.error(f"处理对话请求时出错: {str(e)}", exc_info=True)
+        return with_session_cookie(Response(json.dumps({"error": str(e)})), session_id)
+
+
+@app.route('/chatstream', methods=['GET', 'POST'])
+async def chat_stream():
+    """处理流式对话请求"""
+    session_id = get_session_id(request)
+    # 请求span覆盖到流式响应结束，在sse_events中结束
+    span = tracer.start_span("/chatstream", session_id=session_id)
+    try:
+        if request.method == 'POST':
+            data = await request.get_json()
+            message = data.get('query', '')
+        else:
+            message = request.args.get('query', '')
+        span.name = f"/chatstream {command_name(message)}"
+        with tracer.activate(span):
+            response, stream = await handle_stream_message(session_id, message)
+    except Exception as e:
+        logger.error(f"处理流式对话请求时出错: {str(e)}", exc_info=True)
+        tracer.finish(span, e)
+        return with_session_cookie(Response(error_events(session_id, str(e)), mimetype='text/event-stream'),
+                                   session_id)
+
+    response = with_session_cookie(
+        Response(sse_events(session_id, response, stream, span), mimetype='text/event-stream'), session_id)
+    response.headers['X-Trace-Id'] = span.trace_id
+    # 故事生成可能超过默认的60秒响应超时，流式响应不设上限
+    response.timeout = None
+    return response
+
+
+if __name__ == '__main__':
+    logger.info("启动Web服务器（ASGI）")
+    app.run(host="0.0.0.0", port=5566)
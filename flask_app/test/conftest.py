@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试以flask_app为根目录导入core，与test下的脚本一致
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,185 @@
+"""本地OpenAI兼容的LLM替身服务
+
+用于在不访问真实API的情况下测量应用自身的开销。根据提示内容返回符合各调用格式的固定回复，
+可配置首字延迟、生成速度和随机抖动，支持stream=True；也可以按比例返回503或放慢响应，
+用于验证多接口切换、熔断和对冲请求。
+
+用法：
+    python test/mock_llm_server.py --port 8900 --latency 0.3 --token-rate 50
+    MODEL_URL=http://127.0.0.1:8900/v1 MODEL_KEY=mock python system_come.py
+
+    # 两个接口，其中一个不稳定
+    python test/mock_llm_server.py --port 8901 --error-rate 0.5 --slow-rate 0.1 --slow-latency 5
+    LLM_ENDPOINTS='[{"url": "http://127.0.0.1:8900/v1"}, {"url": "http://127.0.0.1:8901/v1"}]' python system_come.py
+"""
+from aiohttp import web
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+
+def structured_response(prompt: str) -> str:
+    """要求输出JSON对象的提示，按格式说明中的字段返回固定的JSON"""
+    if '"reply"' in prompt:
+        data = {"reply": "我听到了，系统。接下来我会小心行事，先观察一下周围的情况。",
+                "thoughts": "有些紧张，但对系统的帮助心怀期待。"}
+    elif '"story"' in prompt:
+        data = {"time": "2025-02-02 10:10:00", "place": "城北高中教学楼走廊",
+                "story": "主角沿着走廊快步前行，窗外阴雨连绵，远处传来救护车的鸣笛声。他停下脚步，"
+                         "透过窗户看见操场上有几个同学围在一起，似乎有人倒在了地上。",
+                "suggestions": ["提醒主角保持距离", "查询倒地同学的情况", "推进故事观察后续发展"]}
+    elif '"actions"' in prompt:
+        data = {"actions": ["去医务室打听消息", "给父亲打电话询问新型消毒剂", "和李浩一起留在教室观察"]}
+    elif '"completed_tasks"' in prompt:
+        data = {"completed_tasks": []}
+    else:
+        data = {}
+    return json.dumps(data, ensure_ascii=False)
+
+
+def canned_response(prompt: str) -> str:
+    """根据提示内容选择符合格式的固定回复"""
+    if "请只输出一个JSON对象" in prompt:
+        return structured_response(prompt)
+    if "[类型]：world或character" in prompt:
+        return "[类型]：character" if any(k in prompt for k in ("主角", "任务", "技能", "属性")) else "[类型]：world"
+    if "转换为具体的时间增量" in prompt:
+        return "3d"
+    if "只输出需要修改的分块" in prompt:
+        return "[状态]\n身体状态: 略感疲惫\n"
+    if "请总结以下对话" in prompt:
+        return "系统与主角进行了几轮交流，主角对当前局势保持警惕。"
+    if "判断是否包含任务" in prompt:
+        return "无任务"
+    if "[玩家查询内容]" in prompt:
+        return "根据已知信息，城市里暂时一切如常，但细心的人已经察觉到一些异样的迹象。"
+    if "请直接给出场景描述和建议" in prompt:
+        return ("【场景】：阴雨笼罩着新海市，教室里的日光灯忽明忽暗，同学们低声议论着医院收治的怪病。"
+                "主角望向窗外，雨幕中的城市显得格外安静。\n"
+                "【建议】：1. 与主角对话了解他的想法 2. 查询城市近况 3. 推进故事")
+    return "根据已知信息，城市里暂时一切如常，但细心的人已经察觉到一些异样的迹象。"
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text))
+
+
+class MockLLMServer:
+    def __init__(self, latency: float, token_rate: float, jitter: float, chars_per_chunk: int,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_latency: float = 5.0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.jitter = jitter
+        self.chars_per_chunk = chars_per_chunk
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    async def _delay(self, seconds: float):
+        if seconds > 0:
+            await asyncio.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+        model = body.get("model", "mock")
+        content = canned_response(prompt)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": estimate_tokens(content),
+            "total_tokens": estimate_tokens(prompt) + estimate_tokens(content),
+        }
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return web.json_response({"error": {"message": "mock overloaded", "type": "server_error"}},
+                                         status=503)
+            await self._delay(self.slow_latency if random.random() < self.slow_rate else self.latency)
+            chunk_delay = self.chars_per_chunk / self.token_rate if self.token_rate > 0 else 0
+
+            if not body.get("stream"):
+                await self._delay(len(content) / self.token_rate if self.token_rate > 0 else 0)
+                return web.json_response({
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for i in range(0, len(content), self.chars_per_chunk):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": content[i:i + self.chars_per_chunk]},
+                        "finish_reason": None,
+                    }],
+                }
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await self._delay(chunk_delay)
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+            await response.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "errors": self.errors, "in_flight": self.in_flight})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地OpenAI兼容的LLM替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.3, help="首字延迟（秒）")
+    parser.add_argument("--token-rate", type=float, default=50, help="生成速度（字/秒），0表示不限速")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延迟的随机抖动比例")
+    parser.add_argument("--chunk", type=int, default=4, help="流式返回时每个chunk的字数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回503的请求比例")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="使用--slow-latency作为首字延迟的请求比例")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="慢请求的首字延迟（秒）")
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.latency, args.token_rate, args.jitter, args.chunk,
+                           args.error_rate, args.slow_rate, args.slow_latency)
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""端到端基准测试
+
+并发回放脚本化的游戏会话（/start、对话、/st、/qu、/md、/save等）请求/chatstream，
+统计各命令的总延迟和首字延迟（p50/p95/p99）、吞吐量以及每个会话占用的内存。
+
+配合test/mock_llm_server.py使用时测得的是应用自身的开销：
+    python test/mock_llm_server.py --port 8900
+    MODEL_URL=http://127.0.0.1:8900/v1 MODEL_KEY=mock python system_come.py
+    python test/run_benchmark.py --url http://127.0.0.1:5566 --sessions 50 --concurrency 10
+
+可以用--output保存结果，再用--baseline对比，p95退化超过--max-regression时返回非零退出码。
+"""
+from collections import defaultdict
+from typing import Dict, List, Optional
+import aiohttp
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+import uuid
+from urllib.parse import quote
+
+DEFAULT_SCRIPT = [
+    "/start",
+    "你好，我是系统，以后我会帮助你",
+    "/qu 学校附近最近有什么异常",
+    "/st",
+    "/md 主角获得了一把结实的雨伞",
+    "/th",
+    "/st 1h",
+    "/des",
+    "/savef bench_{session}",
+]
+
+
+def command_name(message: str) -> str:
+    """把消息归类为命令名，普通对话记为chat"""
+    if not message.startswith("/"):
+        return "chat"
+    return message.split()[0]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近秩法计算百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+async def fetch_stats(http: aiohttp.ClientSession, url: str) -> Optional[dict]:
+    try:
+        async with http.get(f"{url}/stats") as response:
+            return await response.json()
+    except Exception:
+        return None
+
+
+async def send(http: aiohttp.ClientSession, url: str, session_id: str, message: str) -> dict:
+    """发送一条消息并读取完整的SSE响应"""
+    start = time.perf_counter()
+    first_token = None
+    error = None
+    try:
+        params = f"query={quote(message)}&conversation_id={session_id}"
+        async with http.get(f"{url}/chatstream?{params}") as response:
+            async for raw in response.content:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data: "):
+                    continue
+                data = json.loads(line[6:])
+                content = data.get("content")
+                if content == "[DONE]":
+                    break
+                if content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    if content.startswith("Error:"):
+                        error = content
+    except Exception as e:
+        error = str(e)
+    latency = time.perf_counter() - start
+    return {
+        "command": command_name(message),
+        "latency": latency,
+        "ttft": first_token if first_token is not None else latency,
+        "error": error,
+    }
+
+
+async def run_session(http: aiohttp.ClientSession, url: str, index: int, script: List[str],
+                      limiter: asyncio.Semaphore, results: List[dict]):
+    session_id = f"bench_{index}_{uuid.uuid4().hex[:8]}"
+    async with limiter:
+        for message in script:
+            results.append(await send(http, url, session_id, message.format(session=index)))
+
+
+def summarize(results: List[dict], wall_time: float, sessions: int,
+              stats_before: Optional[dict], stats_after: Optional[dict]) -> dict:
+    by_command: Dict[str, List[dict]] = defaultdict(list)
+    for result in results:
+        by_command[result["command"]].append(result)
+        by_command["all"].append(result)
+
+    commands = {}
+    for name, items in by_command.items():
+        latencies = [r["latency"] for r in items]
+        ttfts = [r["ttft"] for r in items]
+        commands[name] = {
+            "count": len(items),
+            "errors": sum(1 for r in items if r["error"]),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_p99": percentile(latencies, 99),
+            "ttft_p50": percentile(ttfts, 50),
+            "ttft_p95": percentile(ttfts, 95),
+            "ttft_p99": percentile(ttfts, 99),
+        }
+
+    summary = {
+        "sessions": sessions,
+        "requests": len(results),
+        "wall_time": wall_time,
+        "throughput_rps": len(results) / wall_time if wall_time else 0.0,
+        "commands": commands,
+    }
+    rss_before = (stats_before or {}).get("process", {}).get("rss_mb")
+    rss_after = (stats_after or {}).get("process", {}).get("rss_mb")
+    if rss_before is not None and rss_after is not None and sessions:
+        summary["memory_per_session_mb"] = (rss_after - rss_before) / sessions
+    return summary
+
+
+def print_report(summary: dict):
+    print(f"会话数: {summary['sessions']}  请求数: {summary['requests']}  "
+          f"耗时: {summary['wall_time']:.2f}s  吞吐: {summary['throughput_rps']:.2f} req/s")
+    if "memory_per_session_mb" in summary:
+        print(f"每会话内存: {summary['memory_per_session_mb']:.3f} MB")
+    header = f"{'命令':<10}{'次数':>6}{'错误':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'首字p50':>10}{'首字p95':>10}{'首字p99':>10}"
+    print(header)
+    for name, item in sorted(summary["commands"].items()):
+        print(f"{name:<10}{item['count']:>6}{item['errors']:>6}"
+              f"{item['latency_p50']:>9.3f}{item['latency_p95']:>9.3f}{item['latency_p99']:>9.3f}"
+              f"{item['ttft_p50']:>10.3f}{item['ttft_p95']:>10.3f}{item['ttft_p99']:>10.3f}")
+
+
+def compare_with_baseline(summary: dict, baseline: dict, max_regression: float) -> List[str]:
+    """与基线对比各命令的p95延迟，返回退化超过阈值的命令说明"""
+    regressions = []
+    for name, item in summary["commands"].items():
+        base = baseline.get("commands", {}).get(name)
+        if not base or base["latency_p95"] <= 0:
+            continue
+        ratio = item["latency_p95"] / base["latency_p95"] - 1
+        if ratio > max_regression:
+            regressions.append(f"{name}: p95 {base['latency_p95']:.3f}s -> {item['latency_p95']:.3f}s (+{ratio:.0%})")
+    return regressions
+
+
+async def run(args) -> dict:
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            script = json.load(f)
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(timeout=timeout) as http:
+        stats_before = await fetch_stats(http, args.url)
+        limiter = asyncio.Semaphore(args.concurrency)
+        results: List[dict] = []
+        start = time.perf_counter()
+        await asyncio.gather(*[run_session(http, args.url, i, script, limiter, results)
+                               for i in range(args.sessions)])
+        wall_time = time.perf_counter() - start
+        stats_after = await fetch_stats(http, args.url)
+    return summarize(results, wall_time, args.sessions, stats_before, stats_after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SystemCome端到端基准测试")
+    parser.add_argument("--url", default="http://127.0.0.1:5566", help="应用地址")
+    parser.add_argument("--sessions", type=int, default=20, help="回放的会话数")
+    parser.add_argument("--concurrency", type=int, default=5, help="同时进行的会话数")
+    parser.add_argument("--script", help="JSON格式的消息列表，{session}会替换为会话序号")
+    parser.add_argument("--timeout", type=float, default=300, help="单个请求超时（秒）")
+    parser.add_argument("--output", help="保存结果的JSON文件")
+    parser.add_argument("--baseline", help="用于对比的基线结果JSON文件")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允许的p95退化比例")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    print_report(summary)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(summary, json.load(f), args.max_regression)
+        if regressions:
+            print("性能退化：")
+            for line in regressions:
+                print(f"- {line}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
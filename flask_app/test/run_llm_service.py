@@ -1,16 +1,16 @@
 from core.llm_service import LLMService
 import asyncio
 
+# 可配合test/mock_llm_server.py离线运行：MODEL_URL=http://127.0.0.1:8900/v1 MODEL_KEY=mock
 service = LLMService()
 prompt = "你好"
 response = asyncio.run(service.generate_response(prompt))
 print(response)
 
-action_type = "modify"
-context = "修改世界状态"
-energy_cost = asyncio.run(service.calculate_energy_cost(action_type, context))
-print(energy_cost)
+message = "系统发布任务：三天内找到城北药房的银翘草，奖励：体力+10"
+has_task, task_desc = asyncio.run(service.detect_task(message))
+print(has_task, task_desc)
 
-task_description = "完成一个简单的任务，奖励是提升1级"
-task, reward = asyncio.run(service.format_task(task_description))
-print(task, reward)
\ No newline at end of file
+context = "主角在城北药房买到了银翘草"
+is_completed, result = asyncio.run(service.check_task_status(task_desc, context))
+print(is_completed, result)
@@ -0,0 +1,50 @@
+from datetime import datetime
+import pytest
+from core.local_rules import classify_modification, parse_time_span, shift_time
+
+HOUR = 3600
+DAY = 86400
+
+
+@pytest.mark.parametrize("text, span", [
+    ("10m", (0, 600)),
+    ("1h30m", (0, HOUR + 1800)),
+    ("1M", (1, 0)),
+    ("三天后", (0, 3 * DAY)),
+    ("十五天", (0, 15 * DAY)),
+    ("再过二十五分钟", (0, 1500)),
+    ("一个半小时", (0, HOUR + 1800)),
+    ("两天半", (0, 2 * DAY + DAY // 2)),
+    ("一年零三个月", (15, 0)),
+    ("1.5个月", (1, 15 * DAY)),
+    ("明天", (0, DAY)),
+    ("下个月", (1, 0)),
+    ("2 hours", (0, 2 * HOUR)),
+])
+def test_parse_time_span(text, span):
+    assert parse_time_span(text) == span
+
+
+@pytest.mark.parametrize("text", ["", "随便走走", "三天然后吃饭", "个小时"])
+def test_parse_time_span_rejects_partial_matches(text):
+    assert parse_time_span(text) is None
+
+
+def test_shift_time_clamps_to_month_end():
+    assert shift_time(datetime(2024, 1, 31, 8), (1, 0)) == datetime(2024, 2, 29, 8)
+    assert shift_time(datetime(2024, 11, 30), (2, DAY)) == datetime(2025, 1, 31)
+
+
+@pytest.mark.parametrize("modification, expected", [
+    ("主角获得了一把剑", "character"),
+    ("全城开始下雨", "world"),
+    ("主角所在的城市下雪了", None),
+    ("一只猫走了过去", None),
+])
+def test_classify_modification(modification, expected):
+    assert classify_modification(modification) == expected
+
+
+def test_classify_modification_uses_character_name():
+    assert classify_modification("小明摔了一跤") is None
+    assert classify_modification("小明摔了一跤", "名字：小明\n年龄：18") == "character"
@@ -0,0 +1,53 @@
+from core.provider_pool import CircuitBreaker
+
+
+def _expire(breaker):
+    breaker.opened_at -= breaker.cooldown + 1
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.available()
+    assert not breaker.allow()
+
+
+def test_half_open_allows_one_trial():
+    breaker = CircuitBreaker(threshold=1, cooldown=60)
+    breaker.record_failure()
+    _expire(breaker)
+    assert breaker.available()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.available()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_trial_reopens():
+    breaker = CircuitBreaker(threshold=3, cooldown=60)
+    for _ in range(3):
+        breaker.record_failure()
+    _expire(breaker)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_abandoned_trial_returns_slot():
+    breaker = CircuitBreaker(threshold=1, cooldown=60)
+    breaker.record_failure()
+    _expire(breaker)
+    assert breaker.allow()
+    breaker.record_abandoned()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
@@ -0,0 +1,35 @@
+from core.retrieval import BM25Index
+
+
+def _top(index, query):
+    return index.search(query, top_k=1)[0][0]
+
+
+def test_sync_indexes_appended_documents():
+    documents = ["主角在城北药房买药", "城南下起了大雨"]
+    index = BM25Index()
+    index.sync(documents)
+    documents.append("主角学会了剑术")
+    index.sync(documents)
+    assert len(index) == 3
+    assert _top(index, "剑术") == 2
+
+
+def test_sync_rebuilds_when_list_is_replaced():
+    index = BM25Index()
+    index.sync(["主角在城北药房买药", "城南下起了大雨"])
+    # 长度相同的新列表，不能沿用旧列表的索引
+    index.sync(["城南下起了大雨", "主角在城北药房买药"])
+    assert len(index) == 2
+    assert _top(index, "药房") == 1
+
+
+def test_sync_rebuilds_when_list_shrinks():
+    documents = ["主角在城北药房买药", "城南下起了大雨", "主角学会了剑术"]
+    index = BM25Index()
+    index.sync(documents)
+    del documents[:2]
+    documents.append("城北的药房关门了")
+    index.sync(documents)
+    assert len(index) == 2
+    assert _top(index, "药房") == 1
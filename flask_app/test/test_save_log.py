@@ -0,0 +1,63 @@
+import os
+from core.save_log import SaveLog, SaveTracker
+
+
+def _state():
+    return {
+        "timestamp": "2026-10-17 12:00:00",
+        "story_name": "测试",
+        "character": {"profile": "名字：小明", "dialogue_history": [{"system": "你好", "character": "你好"}]},
+        "world": {"time": "2026-10-17 08:00:00", "history": ["第一天"]},
+    }
+
+
+def test_append_round_trip(tmp_path):
+    log = SaveLog(str(tmp_path / "save"))
+    tracker = SaveTracker()
+    state = _state()
+    assert log.save(state, tracker) == "snapshot"
+
+    state["world"]["history"].append("第二天")
+    state["character"]["profile"] = "名字：小明\n体力：8"
+    state["character"]["mood"] = "平静"
+    assert log.save(state, tracker) == "append"
+
+    # 压缩：从开头移除再追加
+    del state["character"]["dialogue_history"][0]
+    state["character"]["dialogue_history"].append({"system": "再见", "character": "再见"})
+    del state["character"]["mood"]
+    assert log.save(state, tracker) == "append"
+
+    assert log.load() == state
+    assert log.read_manifest()["log_records"] == 2
+
+
+def test_load_ignores_truncated_append(tmp_path):
+    log = SaveLog(str(tmp_path / "save"))
+    tracker = SaveTracker()
+    state = _state()
+    log.save(state, tracker)
+    state["world"]["history"].append("第二天")
+    log.save(state, tracker)
+
+    # 模拟写到一半中断：日志中有manifest未记录的内容
+    manifest = log.read_manifest()
+    with open(os.path.join(log.directory, manifest["log"]), "ab") as f:
+        f.write(b"\x1f\x8b\x08\x00partial")
+    assert log.load() == state
+
+    state["world"]["history"].append("第三天")
+    assert log.save(state, tracker) == "append"
+    assert log.load() == state
+
+
+def test_stale_tracker_writes_snapshot(tmp_path):
+    log = SaveLog(str(tmp_path / "save"))
+    state = _state()
+    log.save(state, SaveTracker())
+    other = SaveTracker()
+    log.save(state, other)
+    # 存档已被其他会话写过，旧的写入记录不能用于计算增量
+    state["world"]["history"].append("第二天")
+    assert log.save(state, SaveTracker(revision=1, state=_state())) == "snapshot"
+    assert log.load() == state
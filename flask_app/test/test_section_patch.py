@@ -0,0 +1,28 @@
+from core.section_patch import apply_patch, parse_patch
+
+PROFILE = "名字：小明\n\n[属性]\n体力：10\n\n[技能]\n无\n"
+
+
+def test_parse_patch_no_change():
+    assert parse_patch("无变化") == {}
+    assert parse_patch("---\n无变化\n---") == {}
+
+
+def test_parse_patch_sections():
+    assert parse_patch("以下是修改：\n[技能]\n剑术\n") == {"技能": "剑术"}
+    assert parse_patch("[属性]\n体力：8\n[技能]\n剑术\n") == {"属性": "体力：8\n", "技能": "剑术"}
+
+
+def test_parse_patch_rejects_malformed():
+    assert parse_patch("体力下降\n学会了剑术") is None
+    assert parse_patch("说明\n多余的说明\n[技能]\n剑术") is None
+    assert parse_patch("[技能]\n\n") is None
+
+
+def test_apply_patch_replaces_only_patched_sections():
+    assert apply_patch(PROFILE, {"技能": "剑术"}) == "名字：小明\n\n[属性]\n体力：10\n\n[技能]\n剑术\n\n"
+
+
+def test_apply_patch_preamble_and_new_section():
+    patched = apply_patch(PROFILE, {"基本信息": "名字：小红", "装备": "木剑\n"})
+    assert patched == "名字：小红\n\n[属性]\n体力：10\n\n[技能]\n无\n[装备]\n木剑\n\n"
@@ -0,0 +1,134 @@
+import asyncio
+import pytest
+from core.single_flight import FlightAbandoned, SingleFlight
+
+
+def test_call_coalesces_identical_calls():
+    flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "结果"
+
+    async def main():
+        return await asyncio.gather(*(flight.call("k", compute) for _ in range(3)))
+
+    assert asyncio.run(main()) == ["结果"] * 3
+    assert len(calls) == 1
+    stats = flight.stats()
+    assert (stats["leaders"], stats["followers"], stats["in_flight"]) == (1, 2, 0)
+
+
+def test_call_shares_errors():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("失败")
+
+    async def main():
+        return await asyncio.gather(flight.call("k", fail), flight.call("k", fail), return_exceptions=True)
+
+    assert [type(e) for e in asyncio.run(main())] == [ValueError, ValueError]
+
+
+def test_leader_leaving_does_not_cancel_followers():
+    flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return 1
+
+    async def main():
+        leader = asyncio.ensure_future(flight.call("k", compute))
+        follower = asyncio.ensure_future(flight.call("k", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == 1
+    assert flight.stats()["leaders"] == 1
+
+
+def test_last_subscriber_leaving_cancels_call():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def compute():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main():
+        tasks = [asyncio.ensure_future(flight.call("k", compute)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(main())
+    assert cancelled == [1]
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "followers": 1, "abandoned": 0, "coalesce_rate": 0.5}
+
+
+def test_abandoned_call_is_retried():
+    flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def main():
+        follower = asyncio.ensure_future(flight.call("k", compute))
+        await asyncio.sleep(0)
+        # 执行调用的任务被取消（如其事件循环关闭）时仍有订阅者
+        flight._flights["k"].task.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == 2
+    assert flight.stats()["abandoned"] == 1
+
+
+def test_stream_followers_receive_all_chunks():
+    flight = SingleFlight()
+
+    async def produce():
+        for chunk in "abc":
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    async def consume():
+        return "".join([chunk async for chunk in flight.stream("k", produce)])
+
+    async def main():
+        leader = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.015)  # 已输出第一个chunk后加入
+        return await asyncio.gather(leader, consume())
+
+    assert asyncio.run(main()) == ["abc", "abc"]
+    assert flight.stats()["followers"] == 1
+
+
+def test_stream_abandoned_after_output():
+    flight = SingleFlight()
+
+    async def produce():
+        yield "a"
+        await asyncio.sleep(10)
+        yield "b"
+
+    async def main():
+        chunks = []
+        with pytest.raises(FlightAbandoned):
+            async for chunk in flight.stream("k", produce):
+                chunks.append(chunk)
+                flight._flights["k"].task.cancel()
+        return chunks
+
+    assert asyncio.run(main()) == ["a"]
@@ -0,0 +1,34 @@
+import json
+import pytest
+from core.structured import JsonStreamParser
+
+TEXT = ('{"reply": "他说：\\"好\\"\\n\\u4f60\\ud83d\\ude00\\/", "plans": ["a\\"]", {"b": "}"}], '
+        '"thoughts": "\\t结束"}')
+
+
+def _collect(chunks):
+    parser = JsonStreamParser()
+    fields = {}
+    for chunk in chunks:
+        for field, text in parser.feed(chunk):
+            fields[field] = fields.get(field, "") + text
+    return parser, fields
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(TEXT)])
+def test_string_fields_match_json(size):
+    parser, fields = _collect(TEXT[i:i + size] for i in range(0, len(TEXT), size))
+    expected = json.loads(TEXT)
+    assert fields == {"reply": expected["reply"], "thoughts": expected["thoughts"]}
+    assert parser.text == TEXT
+
+
+def test_lone_surrogate_is_dropped():
+    _, fields = _collect(['{"reply": "a\\ud83d', 'b"}'])
+    assert fields == {"reply": "ab"}
+
+
+def test_events_merge_adjacent_text():
+    parser = JsonStreamParser()
+    assert parser.feed('{"reply": "你好') == [("reply", "你好")]
+    assert parser.feed('呀", "thoughts": "想') == [("reply", "呀"), ("thoughts", "想")]
@@ -0,0 +1,440 @@
+"""WSGI（system_come.py，Flask）和ASGI（system_come_asgi.py，Quart）两种服务方式共用的请求处理逻辑
+
+这里的函数不依赖具体框架：命令处理返回普通响应或异步生成器，SSE事件统一由sse_events产生，
+WSGI模式下在线程中逐步驱动，ASGI模式下直接交给服务器在常驻事件循环中流式发送。
+"""
+from core import SessionManager
+from core.llm_service import get_pool_metrics
+from core.local_rules import fast_path_stats
+from core.speculation import speculation_stats
+from core.system import DEFAULT_STORY_SPAN
+from core.logger import setup_logger, log_text
+from core.tracing import Span, tracer, activate_stream
+from contextlib import aclosing
+import asyncio
+import atexit
+import json
+import logging
+import os
+
+logger = setup_logger('WebApp')
+
+# 初始化会话管理器，每个会话拥有独立的System
+sessions = SessionManager()
+atexit.register(sessions.flush)
+
+SESSION_COOKIE = 'session_id'
+
+# 流式响应等待模型输出期间发送SSE注释心跳的间隔（秒），0表示不发送
+# WSGI模式下只有写入时才能发现客户端已断开，心跳保证长时间没有输出时也能及时发现并取消LLM调用
+SSE_HEARTBEAT_INTERVAL = float(os.getenv('SSE_HEARTBEAT_INTERVAL', '2'))
+
+# 已知命令，其他以/开头的消息在指标中统一记为unknown，避免标签数量无限增长
+KNOWN_COMMANDS = {'/story', '/help', '/load', '/ls', '/start', '/md', '/qu', '/st', '/th', '/en', '/ch',
+                  '/world', '/world_info', '/des', '/reset', '/savef', '/save', '/undo', '/branch', '/checkout'}
+
+# 会修改游戏状态的命令（含普通对话），执行前记录撤销点
+UNDOABLE_COMMANDS = {'chat', '/story', '/load', '/start', '/md', '/qu', '/st', '/des', '/reset'}
+
+# 会使预生成结果失效的命令：修改状态的命令（/qu记录的查询事件也会出现在提示中）以及撤销和切换分支
+INVALIDATING_COMMANDS = UNDOABLE_COMMANDS | {'/undo', '/checkout'}
+
+
+def get_session_id(request) -> str:
+    """从请求中获取会话ID，没有或非法时生成新的"""
+    session_id = request.args.get('conversation_id') or request.cookies.get(SESSION_COOKIE)
+    if not SessionManager.is_valid_session_id(session_id):
+        session_id = SessionManager.new_session_id()
+    return session_id
+
+
+def with_session_cookie(response, session_id: str):
+    """在响应中写入会话cookie"""
+    response.set_cookie(SESSION_COOKIE, session_id, max_age=30 * 24 * 3600, httponly=True, samesite='Lax')
+    return response
+
+
+def speculation_kind(message: str):
+    """消息会用到的预生成结果：默认时长的/st为st，/des为des，其他为None"""
+    if message == '/des':
+        return 'des'
+    if message.startswith('/st') and message[3:].strip() in ('', DEFAULT_STORY_SPAN):
+        return 'st'
+    return None
+
+
+def cancel_speculation(system, message: str):
+    """执行会改变状态的命令前，取消该命令用不到的预生成"""
+    if command_name(message) in INVALIDATING_COMMANDS and message != '/story':
+        system.speculation.cancel(keep=speculation_kind(message))
+
+
+def command_name(message: str) -> str:
+    """把消息归类为命令名，用于span名称，普通对话记为chat"""
+    if not message.startswith('/'):
+        return 'chat'
+    # 与路由一致按前缀匹配（如"/story剧本名"），较长的命令优先
+    for command in sorted(KNOWN_COMMANDS, key=len, reverse=True):
+        if message.startswith(command):
+            return command
+    return 'unknown'
+
+
+def process_memory_mb() -> float:
+    """当前进程的常驻内存（MB），非Linux系统退化为峰值内存"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def stats_payload() -> str:
+    """会话、LLM并发队列和进程内存的统计信息（JSON）"""
+    return json.dumps({
+        "sessions": sessions.stats(),
+        "llm": get_pool_metrics(),
+        "fast_paths": fast_path_stats.snapshot(),
+        "speculation": speculation_stats.snapshot(),
+        "process": {"rss_mb": round(process_memory_mb(), 2)}
+    })
+
+
+def metrics_text() -> str:
+    """Prometheus文本格式的指标：各操作的耗时分布、LLM调用统计和当前并发状态"""
+    pool = get_pool_metrics()
+    session_stats = sessions.stats()
+    lines = [tracer.metrics.render().rstrip("\n")]
+    gauges = {
+        "systemcome_llm_in_flight": pool["global"]["in_flight"],
+        "systemcome_llm_queue_depth": pool["global"]["queue_depth"],
+        "systemcome_sessions_hot": session_stats["hot_sessions"],
+        "systemcome_sessions_stored": session_stats["stored_sessions"],
+        "systemcome_process_rss_mb": round(process_memory_mb(), 2),
+    }
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    # 本地规则命中率 = hit / (hit + fallback)
+    lines.append("# TYPE systemcome_fast_path_total counter")
+    for path, counts in fast_path_stats.snapshot().items():
+        lines.append(f'systemcome_fast_path_total{{path="{path}",result="hit"}} {counts["hits"]}')
+        lines.append(f'systemcome_fast_path_total{{path="{path}",result="fallback"}} {counts["fallbacks"]}')
+    speculation = speculation_stats.snapshot()
+    lines.append("# TYPE systemcome_speculation_in_flight gauge")
+    lines.append(f"systemcome_speculation_in_flight {speculation['in_flight']}")
+    lines.append("# TYPE systemcome_speculation_total counter")
+    for result, count in sorted(speculation["counts"].items()):
+        lines.append(f'systemcome_speculation_total{{result="{result}"}} {count}')
+    # 各LLM接口：up为0表示已熔断（open）；对冲胜率 = hedge_wins / hedged
+    lines.append("# TYPE systemcome_llm_endpoint_up gauge")
+    for endpoint in pool["endpoints"]:
+        lines.append(f'systemcome_llm_endpoint_up{{endpoint="{endpoint["name"]}"}} '
+                     f'{0 if endpoint["state"] == "open" else 1}')
+    for counter in ("requests", "failures", "hedged", "hedge_wins"):
+        lines.append(f"# TYPE systemcome_llm_endpoint_{counter}_total counter")
+        for endpoint in pool["endpoints"]:
+            lines.append(f'systemcome_llm_endpoint_{counter}_total{{endpoint="{endpoint["name"]}"}} '
+                         f'{endpoint[counter]}')
+    # 合并率 = follower / (leader + follower)
+    coalesce = pool["coalesce"]
+    lines.append("# TYPE systemcome_llm_flights_total counter")
+    for role, key in (("leader", "leaders"), ("follower", "followers"), ("abandoned", "abandoned")):
+        lines.append(f'systemcome_llm_flights_total{{role="{role}"}} {coalesce[key]}')
+    return "\n".join(lines) + "\n"
+
+
+def traces_body(limit: int) -> str:
+    """最近结束的span，每行一个JSON"""
+    return "".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n"
+                   for span in tracer.recent(limit))
+
+
+def sse(data: dict) -> str:
+    return 'data: {}\n\n'.format(json.dumps(data))
+
+
+def error_events(session_id: str, error_msg: str) -> str:
+    """处理请求出错时返回的完整SSE内容"""
+    return (sse({'content': f"Error: {error_msg}"})
+            + sse({'conversation_id': session_id})
+            + sse({'content': '[DONE]'}))
+
+
+async def sse_events(session_id: str, response: str = None, stream=None, span: Span = None):
+    """产生一次流式对话的SSE事件，结束时关闭请求span
+
+    Args:
+        session_id: 会话ID
+        response: 普通响应文本
+        stream: 需要逐块转发的异步生成器（与response二选一）
+        span: 请求span，覆盖到流式响应结束
+    """
+    error = None
+    try:
+        if stream is None:
+            # 普通响应转换为流式
+            log_text(logger, "开始流式响应", response, logging.INFO)
+            yield sse({'content': response})
+        else:
+            # 逐块转发模型输出
+            chunks = []
+            try:
+                async with aclosing(activate_stream(span, stream) if span else stream) as chunk_stream, \
+                        aclosing(with_heartbeat(chunk_stream, SSE_HEARTBEAT_INTERVAL)) as beating_stream:
+                    async for chunk in beating_stream:
+                        if chunk is None:
+                            yield ': ping\n\n'  # SSE注释，客户端忽略
+                            continue
+                        chunks.append(chunk)
+                        yield sse({'content': chunk})
+                log_text(logger, "流式响应完成", "".join(chunks), logging.INFO)
+            except Exception as e:
+                error = e
+                logger.error(f"流式响应时出错: {str(e)}", exc_info=True)
+                yield sse({'content': f"Error: {str(e)}"})
+        yield sse({'conversation_id': session_id})
+        yield sse({'content': '[DONE]'})
+    except BaseException as e:
+        # 客户端断开时生成器被关闭或取消
+        error = e
+        raise
+    finally:
+        # 写回会话状态（后台执行，排在本条命令触发的状态更新之后）
+        sessions.persist_later(session_id)
+        if span is not None:
+            tracer.finish(span, error)
+
+
+async def with_heartbeat(agen, interval: float):
+    """转发异步生成器的输出，等待下一块超过interval秒时产生None（用于发送心跳）
+
+    下一块在单独的任务中等待，本生成器被关闭或取消时取消该任务，正在进行的LLM调用随之取消。
+
+    Args:
+        agen: 异步生成器
+        interval: 心跳间隔（秒），不大于0时不产生心跳
+    """
+    if interval <= 0:
+        async for chunk in agen:
+            yield chunk
+        return
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(agen.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=interval)
+            if not done:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                pending.exception()  # 取消前已结束时取走异常，避免未处理异常的警告
+
+
+async def prepend(prefix: str, agen):
+    """在异步生成器的输出前加上固定内容"""
+    yield prefix
+    async with aclosing(agen) as chunks:
+        async for chunk in chunks:
+            yield chunk
+
+
+async def get_system(session_id: str):
+    """获取会话的System，并等待上一条命令的后台更新完成"""
+    # 换入换出会话可能读写磁盘并等待后台任务，放到线程中执行，不阻塞事件循环
+    system = await asyncio.to_thread(sessions.get, session_id)
+    await system.jobs.join()
+    return system
+
+
+async def handle_chat(session_id: str, message: str):
+    """处理普通对话请求
+
+    Returns:
+        tuple: (主角的回复, 追踪ID)
+    """
+    with tracer.span("/chat", session_id=session_id) as span:
+        system = await get_system(session_id)
+        cancel_speculation(system, message)
+        rollback_point = system.checkpoint(message)
+        try:
+            response = await system.communicate(message)
+        except BaseException:
+            system.rollback(rollback_point)
+            raise
+        sessions.persist_later(session_id)
+        return response, span.trace_id
+
+
+async def handle_stream_message(session_id: str, message: str):
+    """执行一条流式对话消息
+
+    Returns:
+        tuple: (普通响应文本, 需要逐块转发的异步生成器)，两者只有一个不为None
+    """
+    logger.info(f"收到流式对话请求，会话: {session_id}")
+    system = await get_system(session_id)  # 上一条命令的后台更新完成后再处理新命令
+    cancel_speculation(system, message)
+    if not (command_name(message) in UNDOABLE_COMMANDS and message != '/story'):
+        return await dispatch_stream_message(system, message)
+
+    # 修改状态的命令要么完整执行，要么回滚到执行前：出错或客户端断开（请求被取消、流被关闭）时撤回已做的修改
+    rollback_point = system.checkpoint(message)
+    try:
+        response, stream = await dispatch_stream_message(system, message)
+    except BaseException:
+        system.rollback(rollback_point)
+        raise
+    if stream is not None:
+        stream = rollback_unless_finished(system, rollback_point, stream)
+    return response, stream
+
+
+async def rollback_unless_finished(system, rollback_point, stream):
+    """转发命令的流式输出，没有完整输出（出错或客户端断开）时回滚状态
+
+    命令在输出结束后才提交状态（记录历史、提交后台任务），因此流正常结束即视为已提交。
+    """
+    finished = False
+    try:
+        async with aclosing(stream) as chunks:
+            async for chunk in chunks:
+                yield chunk
+        finished = True
+    finally:
+        if not finished:
+            system.rollback(rollback_point)
+
+
+async def dispatch_stream_message(system, message: str):
+    """按命令分派流式对话消息
+
+    Returns:
+        tuple: (普通响应文本, 需要逐块转发的异步生成器)，两者只有一个不为None
+    """
+    response = None
+    stream = None  # 需要逐块转发的异步生成器
+    if message.startswith('/story'):
+        if len(message) > 6:
+            story_name = message[6:].strip()
+            response = await system.switch_story(story_name)  # 切换剧本后，需要重新/start
+            logger.info(f"切换剧本成功: {story_name}")
+        else:
+            # 获取可用剧本列表
+            stories = system.get_available_stories()
+            response = "可用剧本列表：\n" + "\n".join([f"- {story}" for story in stories])
+            logger.info("获取剧本列表成功")
+    elif message == '/help':
+        response = system.get_help_info()
+        logger.info("获取帮助信息成功")
+    elif message.startswith('/load'):
+        save_name = message[5:].strip() if len(message) > 5 else ""
+        if save_name == "":
+            response = await system.load_game()
+        else:
+            response = await system.load_game(save_name)  # 加载存档后自动设置为started状态
+        logger.info(f"加载游戏状态: {save_name}")
+    elif message == '/undo':
+        response = system.undo()
+        logger.info("撤销操作")
+    elif message.startswith('/branch'):
+        branch_name = message[7:].strip()
+        response = system.create_branch(branch_name) if branch_name else system.list_branches()
+        logger.info(f"分支操作: {branch_name}")
+    elif message.startswith('/checkout'):
+        branch_name = message[9:].strip()
+        response = system.checkout_branch(branch_name) if branch_name else "请指定分支名称"
+        logger.info(f"切换分支: {branch_name}")
+    elif message == '/ls' or message.startswith('/ls '):
+        page, sort = 1, "time"
+        for arg in message[3:].split():
+            if arg.isdigit():
+                page = max(int(arg), 1)
+            else:
+                sort = arg
+        response = await asyncio.to_thread(system.list_saves, page, sort)  # 可能需要同步存档索引
+        logger.info(f"获取存档列表，第{page}页")
+    elif not system.started:
+        if message == "/start":
+            system.started = True
+            prefix = f"{system.world.story_readme}\n\n"
+            prefix += "\n\n【作为玩家的你将扮演系统，你可以向主角发布对话、修改世界任务状态，或者推动故事发展。】\n【即将进入开始场景，请尽情发挥你的想象力帮助主角或者...】\n\n---\n\n"
+            stream = prepend(prefix, system.generate_scene_description_stream())
+            logger.info("生成开始场景")
+        else:
+            response = "选择剧本，并点击 /start 开始游戏"
+    else:
+        # 处理特殊指令
+        if message.startswith('/'):
+            if message.startswith('/md '):
+                modification = message[3:].strip()
+                response = await system.modify_state(modification)
+                logger.info("修改世界状态")
+            elif message.startswith('/qu '):
+                query = message[3:].strip()
+                stream = system.confirm_world_state_stream(query)
+                logger.info("查询世界状态")
+            elif message.startswith('/st'):
+                if len(message) > 3:
+                    query = message[3:].strip()
+                else:
+                    query = ""
+                stream = system.advance_story_stream(query)
+                logger.info("故事演进")
+            elif message == '/th':
+                response = system.character.get_current_thoughts()
+                logger.info("获取主角心理活动成功")
+            elif message == '/en':
+                logger.info(f"查询系统能量成功: {system.energy}")
+                response = f"当前系统能量：{system.energy}"
+            elif message == '/ch':
+                response = system.character.get_character_info_str()
+                logger.info("获取角色信息成功")
+            elif message == '/world':
+                response = system.world.story_readme
+                logger.info("获取世界信息成功")
+                logger.info("更新角色档案成功")
+            elif message == '/world_info':
+                response = system.world.get_world_info()
+                logger.info("获取世界信息成功")
+                logger.info("更新角色档案成功")
+            elif message == '/des':
+                stream = system.generate_scene_description_stream()
+                logger.info("生成场景描述成功")
+            elif message == '/reset':
+                response = await system.reset()  # 重置游戏状态后，需要重新/start
+                logger.info("重置游戏状态成功")
+            elif message.startswith('/savef'):
+                save_name = message[6:].strip() if len(message) > 6 else ""
+                if save_name == "":
+                    response = await system.save_game(force=True)
+                else:
+                    response = await system.save_game(save_name, force=True)
+                logger.info(f"强制保存游戏状态: {save_name}")
+            elif message.startswith('/save'):
+                save_name = message[5:].strip() if len(message) > 5 else ""
+                if save_name == "":
+                    response = await system.save_game()
+                else:
+                    response = await system.save_game(save_name)
+                logger.info(f"保存游戏状态: {save_name}")
+            else:
+                logger.warning(f"收到未知指令: {message}")
+                response = "无效指令请重新输入"
+        else:
+            # 支持普通对话
+            stream = system.communicate_stream(message)
+
+    return response, stream